@@ -1,10 +1,26 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
 import serial
 import threading
 import time
 import logging
 import math 
 import os
+import json
+import queue
+import struct
+import binascii
+import functools
+import bisect
+import re
+import statistics
+import uuid
+import heapq
+import itertools
+from array import array
+from datetime import datetime, timedelta
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 import requests
 from pyngrok import ngrok, conf
 import sqlite3
@@ -15,47 +31,378 @@ ngrok.set_auth_token(NGROK_AUTH_TOKEN)
 
 # Cloud sync server URL, set via environment variable `CLOUD_SERVER_URL`
 CLOUD_SERVER_URL = os.environ.get('CLOUD_SERVER_URL', 'https://your-cloud-server.com/api/consumption')
+CLOUD_SYNC_BATCH_SIZE = int(os.environ.get('CLOUD_SYNC_BATCH_SIZE', 50))  # Records per POST
+CLOUD_SYNC_TIMEOUT = (3, 10)            # (connect, read) seconds
+CLOUD_SYNC_BACKOFF_BASE = 2             # Seconds; doubles per consecutive failure
+CLOUD_SYNC_BACKOFF_MAX = 300
+CLOUD_SYNC_IDLE_INTERVAL = 60           # Seconds between outbox checks when nothing wakes the worker
 
 # Configuration
 SERIAL_PORT = 'COM3'  # Modify as needed
 BAUD_RATE = 9600
+# Pillboxes served by this process as "device_id=port" pairs, e.g. "ward1=COM3,ward2=COM4".
+# Unset means one device, "default", on SERIAL_PORT; unscoped routes address the first device.
+PILLBOX_DEVICES = os.environ.get('PILLBOX_DEVICES', '')
+ARDUINO_RX_BUFFER_BYTES = 64  # Arduino hardware serial RX buffer; bytes allowed in flight unacknowledged
+ARDUINO_ACK_TIMEOUT = 1.0     # Seconds before an unacknowledged command's buffer credit is released
+# DATA sample encoding requested from the Arduino at connect: 'text' CSV lines or 'binary' frames
+DATA_FORMAT = os.environ.get('PILLBOX_DATA_FORMAT', 'text')
+DATA_INTERVAL_MS = os.environ.get('PILLBOX_DATA_INTERVAL_MS')  # Optional DATA period override (>= 20 ms)
+# Per-compartment scales the Arduino reports in every DATA sample (SET_COMPARTMENTS); 0 keeps the
+# single box weight. Medications are assigned to a compartment index in the inventory.
+MAX_COMPARTMENTS = 3  # HX711 modules answer at 0x64-0x67 and the box scale holds 0x64
+PILLBOX_COMPARTMENTS = min(MAX_COMPARTMENTS, int(os.environ.get('PILLBOX_COMPARTMENTS', 0)))
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)  # Set logging level
 logger = logging.getLogger(__name__)
 
 # --- Global State ---
-arduino_raw_state = {  # Data directly from Arduino
-    "stage_name": "Initializing",
-    "total_weight_in_box_arduino": 0.0, 
-    "pill_count_arduino_current_med": 0, 
-    "current_med_on_arduino": "N/A",    
-    "wpp_arduino_current_med": 0.25,    
-    "lid_distance_cm": None,    # Lid distance
-    "lid_open": False,         # Lid status
-    "last_update": time.time(),
-    "raw_data": ""
-}
-data_lock = threading.Lock() 
-current_mode_is_simulation = True 
-ser = None 
-
-pc_managed_medication_details = {}
-pc_active_medication_name = None
-
-# Add sequential medication session state variables
-medication_session_active = False
-medication_session_data = {
-    "start_weight": 0.0,
-    "current_medication": None,
-    "compartment_unlocked": False,
-    "session_start_time": None
-}
+def idle_session_data():
+    return {
+        "start_weight": 0.0,
+        "current_medication": None,
+        "compartment_unlocked": False,
+        "session_start_time": None
+    }
+
+StateSnapshot = namedtuple("StateSnapshot", [
+    "arduino_raw_state", "current_mode_is_simulation", "pc_managed_medication_details",
+    "pc_active_medication_name", "medication_session_active", "medication_session_data", "compartment_sessions"])
+
+DEFAULT_PILL_TOLERANCE = 0.5  # Fraction of a pill below which the remaining weight counts as an empty box
+
+def pill_count(total_weight, wpp, tolerance):
+    if wpp <= 0.0001 or total_weight < wpp * tolerance:
+        return 0
+    return int(round(total_weight / wpp))
+
+class MedicationRow:
+    """View of one InventoryTable row with the old per-medication dict interface (details['wpp'])."""
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, field):
+        if field not in InventoryTable.FIELDS:
+            raise KeyError(field)
+        return getattr(self.table, field)[self.index]
+
+    def __setitem__(self, field, value):
+        if field not in InventoryTable.FIELDS:
+            raise KeyError(field)
+        if self.table.frozen:
+            raise TypeError("Inventory snapshot is read-only")
+        getattr(self.table, field)[self.index] = int(value) if field in InventoryTable.INT_FIELDS else float(value)
+
+    def get(self, field, default=None):
+        return self[field] if field in InventoryTable.FIELDS else default
+
+class InventoryTable:
+    """Medication inventory stored column-wise, one array per field and one row per medication.
+    `table[name]` gives a MedicationRow view for reading and writing fields in place; recalculate()
+    recomputes pill counts for many rows in one pass. Lives in the inventory part of PillboxState;
+    snapshot() returns the frozen copy that lock-free readers see."""
+    FIELDS = ('wpp', 'total_weight_in_box', 'count_in_box', 'tolerance', 'compartment')
+    INT_FIELDS = ('count_in_box', 'compartment')
+    DEFAULTS = {'wpp': 0.0, 'total_weight_in_box': 0.0, 'count_in_box': 0, 'tolerance': DEFAULT_PILL_TOLERANCE,
+                'compartment': -1}  # compartment: scale index the medication sits on, -1 for none
+
+    def __init__(self):
+        self.names = []
+        self.rows = {}      # Medication name -> row index
+        self.wpp = array('d')
+        self.total_weight_in_box = array('d')
+        self.count_in_box = array('q')
+        self.tolerance = array('d')
+        self.compartment = array('q')
+        self.frozen = False
+        self._dict = None   # Cached to_dict() of a frozen snapshot
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __getitem__(self, name):
+        return MedicationRow(self, self.rows[name])
+
+    def get(self, name, default=None):
+        index = self.rows.get(name)
+        return default if index is None else MedicationRow(self, index)
+
+    def items(self):
+        return ((name, MedicationRow(self, i)) for i, name in enumerate(self.names))
+
+    def add(self, name, wpp=0.0, total_weight=0.0, count=0, tolerance=DEFAULT_PILL_TOLERANCE, compartment=-1):
+        if self.frozen:
+            raise TypeError("Inventory snapshot is read-only")
+        if name in self.rows:
+            raise KeyError(f"Medication already in inventory: {name}")
+        self.rows[name] = len(self.names)
+        self.names.append(name)
+        self.wpp.append(wpp)
+        self.total_weight_in_box.append(total_weight)
+        self.count_in_box.append(count)
+        self.tolerance.append(tolerance)
+        self.compartment.append(compartment)
+        return MedicationRow(self, self.rows[name])
+
+    def clear(self):
+        if self.frozen:
+            raise TypeError("Inventory snapshot is read-only")
+        self.names.clear()
+        self.rows.clear()
+        for field in self.FIELDS:
+            del getattr(self, field)[:]
+
+    def recalculate(self, names=None):
+        """Recompute count_in_box from total weight and WPP for `names`, or for every row in one pass."""
+        if names is None:
+            self.count_in_box = array('q', map(pill_count, self.total_weight_in_box, self.wpp, self.tolerance))
+            return
+        for name in names:
+            i = self.rows.get(name)
+            if i is not None:
+                self.count_in_box[i] = pill_count(self.total_weight_in_box[i], self.wpp[i], self.tolerance[i])
+
+    def snapshot(self):
+        """Read-only copy; copying the arrays is a flat memory copy per column."""
+        copy = InventoryTable.__new__(InventoryTable)
+        copy.names = list(self.names)
+        copy.rows = dict(self.rows)
+        for field in self.FIELDS:
+            setattr(copy, field, array(getattr(self, field).typecode, getattr(self, field)))
+        copy.frozen = True
+        copy._dict = None
+        return copy
+
+    def to_dict(self):
+        """{name: {field: value}} as sent to the web UI; built once per frozen snapshot."""
+        if self._dict is not None:
+            return self._dict
+        result = {name: dict(zip(self.FIELDS, values)) for name, *values in
+                  zip(self.names, *(getattr(self, field) for field in self.FIELDS))}
+        if self.frozen:
+            self._dict = result
+        return result
+
+    def compartments(self):
+        """{compartment index: medication name} for the medications assigned to a compartment."""
+        return {index: name for name, index in zip(self.names, self.compartment) if index >= 0}
+
+    def to_columns(self):
+        """Column-wise JSON-ready form: one list per field, in row order."""
+        columns = {"names": list(self.names)}
+        for field in self.FIELDS:
+            columns[field] = getattr(self, field).tolist()
+        return columns
+
+class PillboxState:
+    """Shared pillbox state, split into parts that each have their own lock:
+      telemetry (telemetry_lock): arduino_raw_state, written by the serial listener
+      inventory (inventory_lock): current_mode_is_simulation, pc_managed_medication_details, pc_active_medication_name
+      session   (session_lock):   medication_session_active, medication_session_data, compartment_sessions
+    Writers change a part inside its edit_*() block, which publishes a copy of that part on exit.
+    Readers use snapshot(): published copies are never mutated, so it takes no lock and never
+    waits behind a writer. When nesting, lock in the order session -> inventory -> telemetry."""
+    def __init__(self):
+        self.telemetry_lock = threading.Lock()
+        self.inventory_lock = threading.RLock()
+        self.session_lock = threading.RLock()
+        self.arduino_raw_state = {  # Data directly from Arduino
+            "stage_name": "Initializing",
+            "total_weight_in_box_arduino": 0.0,
+            "pill_count_arduino_current_med": 0,
+            "current_med_on_arduino": "N/A",
+            "wpp_arduino_current_med": 0.25,
+            "lid_distance_cm": None,    # Lid distance
+            "lid_open": False,         # Lid status
+            "filtered_weight": 0.0,    # PC-side filtered weight (WeightFilter)
+            "weight_settled": False,   # Filtered weight is on a plateau
+            "compartment_weights": [],  # Filtered weight per compartment scale (PILLBOX_COMPARTMENTS)
+            "compartment_settled": [],
+            "last_update": time.time(),
+            "raw_data": ""
+        }
+        self.current_mode_is_simulation = True
+        self.pc_managed_medication_details = InventoryTable()
+        self.pc_active_medication_name = None
+        # Sequential medication session state
+        self.medication_session_active = False
+        self.medication_session_data = idle_session_data()
+        # Sessions of compartment-assigned medications, by medication name; they run side by side
+        # and independently of the box-wide session above
+        self.compartment_sessions = {}
+        self.on_inventory_change = None  # Called with (previous, current) published inventory after each edit
+        self._publish_telemetry()
+        self._publish_inventory()
+        self._publish_session()
+
+    def _publish_telemetry(self):
+        self.published_telemetry = dict(self.arduino_raw_state)
+
+    def _publish_inventory(self):
+        self.published_inventory = (
+            self.current_mode_is_simulation,
+            self.pc_managed_medication_details.snapshot(),
+            self.pc_active_medication_name)
+
+    def _publish_session(self):
+        self.published_session = (self.medication_session_active, dict(self.medication_session_data),
+                                  {name: dict(data) for name, data in self.compartment_sessions.items()})
+
+    @contextmanager
+    def edit_telemetry(self):
+        with self.telemetry_lock:
+            try:
+                yield
+            finally:
+                self._publish_telemetry()
+
+    @contextmanager
+    def edit_inventory(self):
+        with self.inventory_lock:
+            try:
+                yield
+            finally:
+                previous = self.published_inventory
+                self._publish_inventory()
+                if self.on_inventory_change:
+                    self.on_inventory_change(previous, self.published_inventory)
+
+    @contextmanager
+    def edit_session(self):
+        with self.session_lock:
+            try:
+                yield
+            finally:
+                self._publish_session()
+
+    def reset_session(self):
+        """End the medication session. Caller is inside edit_session()."""
+        self.medication_session_active = False
+        self.medication_session_data = idle_session_data()
+
+    def snapshot(self):
+        return StateSnapshot(self.published_telemetry, *self.published_inventory, *self.published_session)
+
+# Server-push status stream settings (see /stream_status)
+STATUS_HEARTBEAT_INTERVAL = 15  # Seconds between SSE heartbeats when nothing changes
+STATUS_EVENT_BACKLOG = 256      # Deltas kept for Last-Event-ID replay after reconnect
 # --- End Global State ---
 
 # Local history SQLite database
 DB_PATH = os.environ.get('HISTORY_DB', 'history.db')
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+DB_POOL_SIZE = 8             # Idle connections kept for reuse by request/worker threads
+DB_STATEMENT_CACHE = 256     # Prepared statements cached per connection
+DB_WRITE_BATCH = 200         # Max queued writes folded into one commit
+
+class Database:
+    """SQLite access shared by request threads and workers. The file runs in WAL mode so readers
+    never block the writer. Reads borrow a pooled connection (each keeps its own prepared-statement
+    cache) for the duration of one query. Writes go through a queue drained by a single writer
+    thread that group-commits whatever has accumulated in one transaction."""
+    def __init__(self, path):
+        self.path = path
+        self.idle = queue.LifoQueue()
+        self.writes = queue.Queue()
+        self.writer_started = False
+        self.writer_start_lock = threading.Lock()
+
+    def open_connection(self, isolation_level=''):
+        connection = sqlite3.connect(self.path, check_same_thread=False, timeout=10,
+                                     cached_statements=DB_STATEMENT_CACHE, isolation_level=isolation_level)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.open_connection()
+
+    def _release(self, connection):
+        if self.idle.qsize() < DB_POOL_SIZE:
+            self.idle.put(connection)
+        else:
+            connection.close()
+
+    def query(self, sql, params=()):
+        connection = self._acquire()
+        try:
+            return connection.execute(sql, params).fetchall()
+        finally:
+            self._release(connection)
+
+    def query_one(self, sql, params=()):
+        rows = self.query(sql, params)
+        return rows[0] if rows else None
+
+    def write(self, sql, params=(), many=False):
+        """Queue a write; the returned Future resolves to the statement's lastrowid once committed."""
+        self._ensure_writer()
+        future = Future()
+        self.writes.put((sql, params, many, future))
+        return future
+
+    def write_many(self, sql, seq_of_params):
+        return self.write(sql, list(seq_of_params), many=True)
+
+    def _ensure_writer(self):
+        if self.writer_started:
+            return
+        with self.writer_start_lock:
+            if not self.writer_started:
+                threading.Thread(target=self.writer_loop, daemon=True).start()
+                self.writer_started = True
+
+    def writer_loop(self):
+        logger.info("Starting database writer thread.")
+        connection = self.open_connection(isolation_level=None)  # Transactions managed explicitly
+        while True:
+            batch = [self.writes.get()]
+            while len(batch) < DB_WRITE_BATCH:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            results = []
+            try:
+                connection.execute('BEGIN')  # One transaction (and one commit) for the whole batch
+                for sql, params, many, future in batch:
+                    # A failing statement is rolled back on its own without aborting the batch
+                    connection.execute('SAVEPOINT queued_write')
+                    try:
+                        cur = connection.executemany(sql, params) if many else connection.execute(sql, params)
+                        results.append((future, cur.lastrowid, None))
+                        connection.execute('RELEASE queued_write')
+                    except sqlite3.Error as e:
+                        connection.execute('ROLLBACK TO queued_write')
+                        connection.execute('RELEASE queued_write')
+                        results.append((future, None, e))
+                connection.execute('COMMIT')
+            except sqlite3.Error as e:
+                logger.error(f"Database batch commit failed: {e}")
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                results = [(future, None, e) for _, _, _, future in batch]
+            for future, lastrowid, error in results:
+                if error is not None:
+                    logger.error(f"Queued database write failed: {error}")
+                    future.set_exception(error)
+                else:
+                    future.set_result(lastrowid)
+
+db = Database(DB_PATH)
+conn = db.open_connection()  # Schema setup only; runtime access goes through `db`
 cursor = conn.cursor()
 cursor.execute('''
 CREATE TABLE IF NOT EXISTS history (
@@ -86,242 +433,1647 @@ CREATE TABLE IF NOT EXISTS reminders (
     frequency_type TEXT NOT NULL,   -- 'interval' or 'daily'
     frequency_value REAL NOT NULL   -- Small time interval or daily count
 )''')
-conn.commit()
 
+# --- Weight time-series rollups (1 s / 1 min / 1 h buckets) ---
+# Rollups created before multi-device support have no device column; they are moved to 'default'
+rollup_columns = [r[1] for r in cursor.execute('PRAGMA table_info(weight_rollup)')]
+if rollup_columns and 'device_id' not in rollup_columns:
+    cursor.execute('ALTER TABLE weight_rollup RENAME TO weight_rollup_single_device')
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS weight_rollup (
+    device_id TEXT NOT NULL,
+    resolution INTEGER NOT NULL,    -- Bucket width in seconds
+    bucket INTEGER NOT NULL,        -- Bucket start (unix seconds)
+    samples INTEGER NOT NULL,
+    weight_min REAL,
+    weight_max REAL,
+    weight_sum REAL,
+    weight_last REAL,
+    lid_open_samples INTEGER NOT NULL,
+    PRIMARY KEY (device_id, resolution, bucket)
+) WITHOUT ROWID''')
+if rollup_columns and 'device_id' not in rollup_columns:
+    cursor.execute("INSERT INTO weight_rollup SELECT 'default', * FROM weight_rollup_single_device")
+    cursor.execute('DROP TABLE weight_rollup_single_device')
+
+# History rows are tagged with the pillbox they were recorded on
+if 'device_id' not in [r[1] for r in cursor.execute('PRAGMA table_info(history)')]:
+    cursor.execute("ALTER TABLE history ADD COLUMN device_id TEXT NOT NULL DEFAULT 'default'")
+
+# History indexes for time-ordered keyset pagination and per-medication queries
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp)')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_medication_timestamp ON history (medication_name, timestamp)')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_device_timestamp ON history (device_id, timestamp)')
+
+# Durable outbox of consumption records waiting to be posted to CLOUD_SERVER_URL
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS cloud_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,          -- JSON record
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+)''')
+
+# Discrete lid / pill removal events detected from the weight stream (see RemovalDetector)
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS removal_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    device_id TEXT NOT NULL,
+    event_type TEXT NOT NULL,       -- 'lid_opened', 'lid_closed', 'pills_removed' or 'pills_added'
+    timestamp REAL NOT NULL,
+    medication_name TEXT,
+    pills INTEGER,
+    weight_delta REAL,              -- Grams, settled weight after the lid closed minus before it opened
+    session_active INTEGER NOT NULL DEFAULT 0
+)''')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_removal_events_device_timestamp ON removal_events (device_id, timestamp)')
+
+# Medication inventory journal: append-only change log plus one compacted snapshot per device
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS inventory_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    device_id TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    op TEXT NOT NULL,               -- 'upsert', 'remove', 'clear', 'active' or 'mode'
+    payload TEXT NOT NULL           -- JSON
+)''')
+cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_log_device ON inventory_log (device_id, id)')
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS inventory_snapshot (
+    device_id TEXT PRIMARY KEY,
+    log_id INTEGER NOT NULL,        -- Last inventory_log id included in the snapshot
+    taken_at REAL NOT NULL,
+    state TEXT NOT NULL             -- JSON: is_simulation, active, columns
+)''')
+
+# Per-table change versions, bumped by triggers on every write. `reset_version` only moves on
+# UPDATE/DELETE, telling `since_id` clients that rows they already hold may have changed.
+VERSIONED_TABLES = ('history', 'messages', 'reminders', 'removal_events')
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS table_versions (
+    table_name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0,
+    reset_version INTEGER NOT NULL DEFAULT 0
+)''')
+for table in VERSIONED_TABLES:
+    cursor.execute('INSERT OR IGNORE INTO table_versions (table_name) VALUES (?)', (table,))
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {table}_version_insert AFTER INSERT ON {table} BEGIN
+        UPDATE table_versions SET version = version + 1 WHERE table_name = '{table}';
+    END''')
+    for action in ('UPDATE', 'DELETE'):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_version_{action.lower()} AFTER {action} ON {table} BEGIN
+            UPDATE table_versions SET version = version + 1, reset_version = version + 1 WHERE table_name = '{table}';
+        END''')
 conn.commit()
+conn.close()
+
+# --- Inventory persistence ---
+INVENTORY_SNAPSHOT_EVERY = int(os.environ.get('INVENTORY_SNAPSHOT_EVERY', 100))  # Log entries between compacted snapshots
+
+def inventory_changes(previous, current):
+    """Change log entries (op, payload) that turn one published inventory (mode, table, active) into the next."""
+    prev_sim, prev_table, prev_active = previous
+    sim, table, active = current
+    changes = []
+    if sim != prev_sim:
+        changes.append(('mode', {'is_simulation': sim}))
+    unchanged_rows = prev_table.names == table.names and \
+        all(getattr(prev_table, field) == getattr(table, field) for field in InventoryTable.FIELDS)
+    if not unchanged_rows:
+        if prev_table and not table:
+            changes.append(('clear', {}))
+        for name in prev_table:
+            if table and name not in table:
+                changes.append(('remove', {'name': name}))
+        for name, row in table.items():
+            old = prev_table.get(name)
+            if old is None or any(old[field] != row[field] for field in InventoryTable.FIELDS):
+                changes.append(('upsert', {'name': name, **{field: row[field] for field in InventoryTable.FIELDS}}))
+    if active != prev_active:
+        changes.append(('active', {'name': active}))
+    return changes
+
+def apply_inventory_change(state, op, payload):
+    """Replay one change log entry. Caller is inside state.edit_inventory()."""
+    table = state.pc_managed_medication_details
+    if op == 'mode':
+        state.current_mode_is_simulation = payload['is_simulation']
+    elif op == 'clear':
+        table.clear()
+    elif op == 'remove':
+        if payload['name'] in table:
+            # Rare; rebuild without the row so row indexes stay dense
+            remaining = [(name, [row[field] for field in InventoryTable.FIELDS]) for name, row in table.items() if name != payload['name']]
+            table.clear()
+            for name, values in remaining:
+                table.add(name, *values)
+    elif op == 'upsert':
+        row = table.get(payload['name']) or table.add(payload['name'])
+        for field in InventoryTable.FIELDS:
+            row[field] = payload.get(field, InventoryTable.DEFAULTS[field])  # Entries logged before the field existed
+    elif op == 'active':
+        state.pc_active_medication_name = payload['name'] if payload['name'] in table else None
+
+class InventoryJournal:
+    """Persists one device's inventory (mode, medications, active medication) across restarts.
+    Every published change is appended to inventory_log; every INVENTORY_SNAPSHOT_EVERY entries the
+    whole state is written to inventory_snapshot and the log up to it is deleted. Both go through
+    the database writer queue in edit order, so a crash between them only leaves log entries that
+    restore() skips."""
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.entries_since_snapshot = 0
+
+    def record(self, previous, current):
+        """PillboxState.on_inventory_change hook; runs inside edit_inventory() and only queues writes."""
+        try:
+            changes = inventory_changes(previous, current)
+            if not changes:
+                return
+            now = time.time()
+            db.write_many('INSERT INTO inventory_log (device_id, recorded_at, op, payload) VALUES (?, ?, ?, ?)',
+                          [(self.device_id, now, op, json.dumps(payload)) for op, payload in changes])
+            self.entries_since_snapshot += len(changes)
+            if self.entries_since_snapshot >= INVENTORY_SNAPSHOT_EVERY:
+                self.compact(current)
+        except Exception as e:
+            logger.error(f"[{self.device_id}] Failed to journal inventory change: {e}")
+
+    def compact(self, current):
+        is_simulation, table, active = current
+        state_json = json.dumps({"is_simulation": is_simulation, "active": active, "columns": table.to_columns()})
+        db.write('INSERT OR REPLACE INTO inventory_snapshot (device_id, log_id, taken_at, state) '
+                 'VALUES (?, (SELECT COALESCE(MAX(id), 0) FROM inventory_log WHERE device_id = ?), ?, ?)',
+                 (self.device_id, self.device_id, time.time(), state_json))
+        db.write('DELETE FROM inventory_log WHERE device_id = ? AND id <= '
+                 '(SELECT log_id FROM inventory_snapshot WHERE device_id = ?)', (self.device_id, self.device_id))
+        self.entries_since_snapshot = 0
+
+    def restore(self, state):
+        """Load the latest snapshot and the log entries after it into a fresh PillboxState."""
+        snapshot = db.query_one('SELECT log_id, state FROM inventory_snapshot WHERE device_id = ?', (self.device_id,))
+        log_id = snapshot[0] if snapshot else 0
+        log = db.query('SELECT op, payload FROM inventory_log WHERE device_id = ? AND id > ? ORDER BY id',
+                       (self.device_id, log_id))
+        with state.edit_inventory():
+            if snapshot:
+                saved = json.loads(snapshot[1])
+                columns = saved["columns"]
+                state.current_mode_is_simulation = saved["is_simulation"]
+                defaults = {field: [value] * len(columns["names"]) for field, value in InventoryTable.DEFAULTS.items()}
+                for name, *values in zip(columns["names"], *(columns.get(field, defaults[field]) for field in InventoryTable.FIELDS)):
+                    state.pc_managed_medication_details.add(name, *values)
+                state.pc_active_medication_name = saved["active"] if saved["active"] in state.pc_managed_medication_details else None
+            for op, payload in log:
+                apply_inventory_change(state, op, json.loads(payload))
+        self.entries_since_snapshot = len(log)
+        return bool(snapshot) or bool(log)
+
+# --- Weight time series ---
+WEIGHT_RING_CAPACITY = int(os.environ.get('WEIGHT_RING_CAPACITY', 65536))  # ~3.6 h of raw samples at 5 Hz
+WEIGHT_FLUSH_INTERVAL = 5    # Seconds between ring buffer flushes into weight_rollup
+WEIGHT_SERIES_MAX_POINTS = 2000
+# Rollup tier (bucket seconds) -> retention in seconds (None keeps forever)
+WEIGHT_ROLLUP_TIERS = {1: 2 * 86400, 60: 90 * 86400, 3600: None}
+
+class WeightSampleRing:
+    """Fixed-capacity ring buffer of raw weight/lid samples in preallocated arrays."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.weights = array('d', bytes(8 * capacity))
+        self.lid_open = array('b', bytes(capacity))
+        self.lid_distance = array('d', bytes(8 * capacity))
+        self.total = 0      # Samples ever appended; slot = total % capacity
+        self.flushed = 0    # Value of `total` at the last drain
+        self.committed = 0  # Samples before this index are committed to weight_rollup
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, weight, lid_open, lid_distance):
+        with self.lock:
+            slot = self.total % self.capacity
+            self.timestamps[slot] = timestamp
+            self.weights[slot] = weight
+            self.lid_open[slot] = 1 if lid_open else 0
+            self.lid_distance[slot] = lid_distance if lid_distance is not None else float('nan')
+            self.total += 1
+
+    def _samples_from(self, index):
+        """(t, weight, lid_open) from sample `index` (or the oldest still held) to the newest. Caller holds self.lock."""
+        return [(self.timestamps[i % self.capacity], self.weights[i % self.capacity], self.lid_open[i % self.capacity])
+                for i in range(max(index, self.total - self.capacity), self.total)]
+
+    def drain(self):
+        """Return (samples appended since the previous drain, oldest first, as (t, weight, lid_open),
+        index after the last of them); pass the index to mark_committed() once they are written."""
+        with self.lock:
+            samples = self._samples_from(self.flushed)
+            self.flushed = self.total
+            return samples, self.total
+
+    def mark_committed(self, upto):
+        with self.lock:
+            self.committed = max(self.committed, upto)
+
+    def uncommitted(self):
+        """(committed index, samples after it): what weight_rollup does not hold yet."""
+        with self.lock:
+            return self.committed, self._samples_from(self.committed)
+
+    def sample_rate(self, recent=256):
+        """Samples per second over the newest `recent` samples, or the configured DATA rate if too few."""
+        with self.lock:
+            n = min(recent, self.total, self.capacity)
+            if n >= 2:
+                span = self.timestamps[(self.total - 1) % self.capacity] - self.timestamps[(self.total - n) % self.capacity]
+                if span > 0:
+                    return (n - 1) / span
+        return 1000.0 / max(20, int(DATA_INTERVAL_MS)) if DATA_INTERVAL_MS else 5.0
+
+    def oldest_timestamp(self):
+        with self.lock:
+            if not self.total:
+                return None
+            return self.timestamps[max(0, self.total - self.capacity) % self.capacity]
+
+    def window(self, start, end):
+        """Raw samples with start <= t < end, located by binary search over the time-ordered ring."""
+        with self.lock:
+            lo, hi = max(0, self.total - self.capacity), self.total
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.timestamps[mid % self.capacity] < start: lo = mid + 1
+                else: hi = mid
+            points = []
+            for i in range(lo, self.total):
+                slot = i % self.capacity
+                if self.timestamps[slot] >= end:
+                    break
+                distance = self.lid_distance[slot]
+                points.append({"t": self.timestamps[slot], "weight": self.weights[slot],
+                               "lid_open": bool(self.lid_open[slot]),
+                               "lid_distance_cm": None if math.isnan(distance) else distance})
+            return points
+
+def rollup_samples(samples, resolution, buckets=None):
+    """Fold (t, weight, lid_open) samples into {bucket: [samples, min, max, sum, last, lid_open_samples]}."""
+    buckets = {} if buckets is None else buckets
+    for t, weight, lid_open in samples:
+        bucket = int(t // resolution) * resolution
+        agg = buckets.get(bucket)
+        if agg is None:
+            buckets[bucket] = [1, weight, weight, weight, weight, lid_open]
+        else:
+            agg[0] += 1
+            if weight < agg[1]: agg[1] = weight
+            if weight > agg[2]: agg[2] = weight
+            agg[3] += weight
+            agg[4] = weight
+            agg[5] += lid_open
+    return buckets
+
+def flush_weight_series(device):
+    """Aggregate the device's newly buffered samples into every rollup tier and prune expired buckets."""
+    samples, upto = device.weight_series.drain()
+    if not samples:
+        return 0
+    rows = []
+    for resolution in WEIGHT_ROLLUP_TIERS:
+        rows.extend((device.device_id, resolution, bucket, *agg) for bucket, agg in rollup_samples(samples, resolution).items())
+    upserted = db.write_many(
+        'INSERT INTO weight_rollup (device_id, resolution, bucket, samples, weight_min, weight_max, weight_sum, weight_last, lid_open_samples) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT(device_id, resolution, bucket) DO UPDATE SET '
+        'samples = samples + excluded.samples, '
+        'weight_min = min(weight_min, excluded.weight_min), '
+        'weight_max = max(weight_max, excluded.weight_max), '
+        'weight_sum = weight_sum + excluded.weight_sum, '
+        'weight_last = excluded.weight_last, '
+        'lid_open_samples = lid_open_samples + excluded.lid_open_samples',
+        rows)
+    now = time.time()
+    for resolution, retention in WEIGHT_ROLLUP_TIERS.items():
+        if retention:
+            db.write('DELETE FROM weight_rollup WHERE device_id = ? AND resolution = ? AND bucket < ?',
+                     (device.device_id, resolution, int(now - retention)))
+    # Readers merge the ring's uncommitted tail into the rollups, so only advance it once the upsert is in
+    upserted.result(timeout=10)
+    device.weight_series.mark_committed(upto)
+    return len(samples)
+
+def weight_series_flush_thread_function():
+    logger.info("Starting weight series flush thread.")
+    while True:
+        time.sleep(WEIGHT_FLUSH_INTERVAL)
+        for device in list(devices.values()):
+            try:
+                flush_weight_series(device)
+            except Exception as e:
+                logger.error(f"[{device.device_id}] Failed to flush weight series: {e}")
+
+# --- PC-side weight filtering ---
+# Filter stages applied in order to every DATA weight sample ('median', 'kalman'; empty disables filtering)
+WEIGHT_FILTER_STAGES = [s.strip() for s in os.environ.get('WEIGHT_FILTER_STAGES', 'median,kalman').split(',') if s.strip()]
+WEIGHT_MEDIAN_WINDOW = int(os.environ.get('WEIGHT_MEDIAN_WINDOW', 5))                  # Samples
+WEIGHT_KALMAN_PROCESS_NOISE = float(os.environ.get('WEIGHT_KALMAN_PROCESS_NOISE', 0.00005))  # g^2 per sample
+WEIGHT_KALMAN_MEASUREMENT_NOISE = float(os.environ.get('WEIGHT_KALMAN_MEASUREMENT_NOISE', 0.0004))  # g^2 (HX711 after the Arduino EMA)
+# Innovations beyond this many std devs on consecutive samples are a real step: the estimate jumps to it
+WEIGHT_KALMAN_STEP_SIGMAS = 3.0
+WEIGHT_KALMAN_STEP_SAMPLES = 2
+# Filtered weight counts as settled once it has stayed within the tolerance for this long
+WEIGHT_PLATEAU_SECONDS = float(os.environ.get('WEIGHT_PLATEAU_SECONDS', 0.8))
+WEIGHT_PLATEAU_TOLERANCE = float(os.environ.get('WEIGHT_PLATEAU_TOLERANCE', 0.05))     # Grams, max - min
+WEIGHT_PLATEAU_MIN_SAMPLES = 3
+WEIGHT_SETTLE_TIMEOUT = float(os.environ.get('WEIGHT_SETTLE_TIMEOUT', 3.0))  # Max seconds lock_and_record waits for a plateau
+
+class RunningMedian:
+    """Median of the last `window` samples: a FIFO plus a sorted copy kept up to date with bisect."""
+    def __init__(self, window):
+        self.window = max(1, window)
+        self.fifo = deque()
+        self.ordered = []
+
+    def __call__(self, value):
+        if len(self.fifo) == self.window:
+            del self.ordered[bisect.bisect_left(self.ordered, self.fifo.popleft())]
+        self.fifo.append(value)
+        bisect.insort(self.ordered, value)
+        n = len(self.ordered)
+        return self.ordered[n // 2] if n % 2 else (self.ordered[n // 2 - 1] + self.ordered[n // 2]) / 2.0
+
+class ScalarKalman:
+    """Constant-weight Kalman filter. A step far outside the expected noise (pills added or removed)
+    resets the estimate instead of being smoothed in over many samples."""
+    def __init__(self, process_noise, measurement_noise, step_sigmas=WEIGHT_KALMAN_STEP_SIGMAS,
+                 step_samples=WEIGHT_KALMAN_STEP_SAMPLES):
+        self.q = process_noise
+        self.r = measurement_noise
+        self.step_sigmas = step_sigmas
+        self.step_samples = step_samples
+        self.estimate = None
+        self.variance = measurement_noise
+        self.outliers = 0   # Consecutive out-of-gate innovations with the same sign (signed count)
+
+    def __call__(self, value):
+        if self.estimate is None:
+            self.estimate = value
+            return value
+        self.variance += self.q
+        innovation = value - self.estimate
+        innovation_variance = self.variance + self.r
+        if innovation * innovation > self.step_sigmas * self.step_sigmas * innovation_variance:
+            sign = 1 if innovation > 0 else -1
+            self.outliers = self.outliers + sign if self.outliers * sign >= 0 else sign
+            if abs(self.outliers) >= self.step_samples:
+                self.estimate = value
+                self.variance = self.r
+                self.outliers = 0
+                return value
+            self.variance -= self.q
+            return self.estimate  # Possible spike: hold until the next sample confirms or rejects it
+        self.outliers = 0
+        gain = self.variance / innovation_variance
+        self.estimate += gain * innovation
+        self.variance *= 1.0 - gain
+        return self.estimate
+
+WEIGHT_FILTER_TYPES = {
+    'median': lambda: RunningMedian(WEIGHT_MEDIAN_WINDOW),
+    'kalman': lambda: ScalarKalman(WEIGHT_KALMAN_PROCESS_NOISE, WEIGHT_KALMAN_MEASUREMENT_NOISE),
+}
 
-def connect_to_arduino():
-    global ser 
+class WeightFilter:
+    """Streaming filter over a device's DATA weights, plus step/plateau detection on its output.
+    A plateau is a run of filtered samples whose spread stays within WEIGHT_PLATEAU_TOLERANCE; a
+    sample outside it is a step and starts a new run. Each sample costs O(log window)."""
+    def __init__(self, stages=None, plateau_seconds=WEIGHT_PLATEAU_SECONDS, tolerance=WEIGHT_PLATEAU_TOLERANCE):
+        stages = WEIGHT_FILTER_STAGES if stages is None else stages
+        unknown = [name for name in stages if name not in WEIGHT_FILTER_TYPES]
+        if unknown:
+            raise ValueError(f"Unknown weight filter stage(s): {', '.join(unknown)}")
+        self.stages = [WEIGHT_FILTER_TYPES[name]() for name in stages]
+        self.plateau_seconds = plateau_seconds
+        self.tolerance = tolerance
+        self.cond = threading.Condition()
+        self.filtered = None
+        self.last_sample_at = None
+        self.run_start = None   # Time of the first sample in the current run
+        self.run_count = 0
+        self.run_sum = 0.0
+        self.run_min = self.run_max = 0.0
+        self.last_step = None   # (time, weight change) of the latest step between runs
+
+    def update(self, timestamp, weight):
+        """Feed one raw sample; returns (filtered weight, settled)."""
+        value = weight
+        for stage in self.stages:
+            value = stage(value)
+        with self.cond:
+            self.filtered = value
+            self.last_sample_at = timestamp
+            if self.run_count and max(self.run_max, value) - min(self.run_min, value) <= self.tolerance:
+                self.run_count += 1
+                self.run_sum += value
+                self.run_min = min(self.run_min, value)
+                self.run_max = max(self.run_max, value)
+            else:
+                if self.run_count:
+                    self.last_step = (timestamp, value - self.run_sum / self.run_count)
+                self.run_start, self.run_count, self.run_sum = timestamp, 1, value
+                self.run_min = self.run_max = value
+            settled = self._settled(timestamp)
+            if settled:
+                self.cond.notify_all()
+        return value, settled
+
+    def _settled(self, now):
+        return self.run_count >= WEIGHT_PLATEAU_MIN_SAMPLES and now - self.run_start >= self.plateau_seconds
+
+    def plateau(self):
+        """(settled, weight): the current plateau mean if settled, else the latest filtered weight."""
+        with self.cond:
+            return self._plateau()
+
+    def _plateau(self):
+        if self.run_count and self._settled(time.time()):
+            return True, self.run_sum / self.run_count
+        return False, self.filtered
+
+    def wait_for_plateau(self, timeout, since=None):
+        """Block until the filtered weight has settled on a sample received at or after `since`
+        (default: now), or until `timeout` passes. Returns (settled, weight) like plateau()."""
+        since = time.time() if since is None else since
+        deadline = since + timeout
+        with self.cond:
+            while True:
+                settled, weight = self._plateau()
+                settled = settled and self.last_sample_at is not None and self.last_sample_at >= since
+                remaining = deadline - time.time()
+                if settled or remaining <= 0:
+                    return settled, weight
+                self.cond.wait(min(remaining, self.plateau_seconds))
+
+# --- Pill removal detection ---
+class RemovalDetector:
+    """Turns a device's lid state and filtered weight into discrete events: lid_opened, then on
+    lid close lid_closed and, once the weight settles (or WEIGHT_SETTLE_TIMEOUT passes),
+    pills_removed / pills_added against the settled weight from before the lid opened.
+    Fed by the serial listener thread only."""
+    def __init__(self, plateau_seconds=WEIGHT_PLATEAU_SECONDS, settle_timeout=WEIGHT_SETTLE_TIMEOUT):
+        self.plateau_seconds = plateau_seconds
+        self.settle_timeout = settle_timeout
+        self.phase = "closed"       # closed -> open -> settling -> closed
+        self.baseline = None        # Settled weight while the lid is closed
+        self.opened_baseline = None
+        self.closed_at = None
+
+    def update(self, timestamp, lid_open, weight, settled, wpp):
+        """Feed one sample; returns the events it completes as (event_type, fields) pairs."""
+        events = []
+        if self.phase == "closed":
+            if lid_open:
+                self.opened_baseline = self.baseline if self.baseline is not None else weight
+                self.phase = "open"
+                events.append(("lid_opened", {"weight": self.opened_baseline}))
+            elif settled:
+                self.baseline = weight
+        elif self.phase == "open":
+            if not lid_open:
+                self.phase = "settling"
+                self.closed_at = timestamp
+                events.append(("lid_closed", {"weight": weight}))
+        elif lid_open:
+            # Reopened before the weight settled: still the same removal
+            self.phase = "open"
+            events.append(("lid_opened", {"weight": self.opened_baseline}))
+        elif (settled and timestamp - self.closed_at >= self.plateau_seconds) or \
+                timestamp - self.closed_at >= self.settle_timeout:
+            # Settled for a full plateau after closing, so the filter is no longer showing the lid-open weight
+            delta = weight - self.opened_baseline
+            pills = int(round(abs(delta) / wpp)) if wpp and wpp > 0.0001 else 0
+            if pills > 0:
+                events.append(("pills_removed" if delta < 0 else "pills_added",
+                               {"pills": pills, "weight_delta": delta, "settled": settled}))
+            self.baseline = weight
+            self.phase = "closed"
+        return events
+
+def detect_removal_events(device, timestamp, lid_open, weight, settled):
+    """Run the device's RemovalDetector on one sample; store and push any events it produces."""
+    if weight is None:
+        return
+    snap = device.state.snapshot()
+    med_name = snap.pc_active_medication_name
+    details = snap.pc_managed_medication_details.get(med_name) if med_name else None
+    wpp = details['wpp'] if details and details['wpp'] > 0.0001 else snap.arduino_raw_state["wpp_arduino_current_med"]
+    for event_type, fields in device.removal_detector.update(timestamp, lid_open, weight, settled, wpp):
+        event = {"device_id": device.device_id, "event_type": event_type, "timestamp": timestamp,
+                 "medication_name": med_name, "session_active": snap.medication_session_active, **fields}
+        if event_type in ("pills_removed", "pills_added"):
+            logger.info(f"[{device.device_id}] {event_type.replace('_', ' ').capitalize()}: {fields['pills']} "
+                        f"of '{med_name}' ({fields['weight_delta']:+.2f}g)")
+        db.write(
+            'INSERT INTO removal_events (device_id, event_type, timestamp, medication_name, pills, weight_delta, session_active) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (device.device_id, event_type, timestamp, med_name, fields.get("pills"), fields.get("weight_delta"),
+             1 if snap.medication_session_active else 0))
+        publish_device_event(device, "removal", event)
+
+# --- Compartments ---
+def update_compartment_weights(device, raw, timestamp, weights):
+    """Filter one vector of compartment weights. Caller is inside device.state.edit_telemetry()."""
+    while len(device.compartment_filters) < len(weights):
+        device.compartment_filters.append(WeightFilter())
+    filtered, settled = [], []
+    for weight_filter, weight in zip(device.compartment_filters, weights):
+        value, is_settled = weight_filter.update(timestamp, weight)
+        filtered.append(value)
+        settled.append(is_settled)
+    raw["compartment_weights"] = filtered
+    raw["compartment_settled"] = settled
+
+def compartment_status(snap):
+    """Live weight and pill count of every reported compartment, from a state snapshot (no locks)."""
+    table = snap.pc_managed_medication_details
+    assigned = table.compartments()
+    result = []
+    for index, (weight, settled) in enumerate(zip(snap.arduino_raw_state["compartment_weights"],
+                                                  snap.arduino_raw_state["compartment_settled"])):
+        name = assigned.get(index)
+        row = table.get(name) if name else None
+        result.append({
+            "index": index,
+            "weight": weight,
+            "settled": settled,
+            "medication": name,
+            "pill_count": pill_count(max(weight, 0.0), row['wpp'], row['tolerance']) if row else None,
+            "session_active": name in snap.compartment_sessions
+        })
+    return result
+
+def sync_compartment_inventory(device):
+    """Real mode: copy every settled compartment weight into its medication's inventory row, so all
+    compartment pill counts update from one sample. Medications in a running compartment session
+    are left for lock_and_record. The inventory lock is only taken when something changed."""
+    snap = device.state.snapshot()
+    if snap.current_mode_is_simulation:
+        return  # The PC drives simulated weights, the inventory stays the source of truth
+    changed = []
+    for entry in compartment_status(snap):
+        name = entry["medication"]
+        if name is None or not entry["settled"] or entry["session_active"]:
+            continue
+        weight = max(entry["weight"], 0.0)
+        if abs(snap.pc_managed_medication_details[name]['total_weight_in_box'] - weight) > WEIGHT_PLATEAU_TOLERANCE:
+            changed.append((name, weight))
+    if not changed:
+        return
+    with device.state.edit_inventory():
+        table = device.state.pc_managed_medication_details
+        for name, weight in changed:
+            if name in table:
+                table[name]['total_weight_in_box'] = weight
+        table.recalculate([name for name, _ in changed])
+
+def push_simulated_compartment_weights(device, names=None):
+    """Simulation mode: send the inventory weight of compartment medications (`names`, or all) to the Arduino."""
+    snap = device.state.snapshot()
+    if not snap.current_mode_is_simulation:
+        return
+    table = snap.pc_managed_medication_details
+    send_commands_to_arduino(device, [
+        f"SET_COMPARTMENT_WEIGHT:{index}:{table[name]['total_weight_in_box']:.2f}"
+        for index, name in sorted(table.compartments().items())
+        if index < PILLBOX_COMPARTMENTS and (names is None or name in names)])
+
+def wait_for_compartment_plateau(device, index, timeout=WEIGHT_SETTLE_TIMEOUT):
+    """(settled, weight) of one compartment, waiting up to `timeout` for its weight to settle."""
+    if index >= len(device.compartment_filters):
+        return False, None
+    return device.compartment_filters[index].wait_for_plateau(timeout)
+
+# --- Single-pill WPP measurement jobs ---
+MEASUREMENT_ROUND_TIMEOUT = 10    # Seconds for the Arduino to finish one MEASURE_SINGLE_PILL_WEIGHT round
+MEASUREMENT_MAX_ROUNDS = 5
+MEASUREMENT_OUTLIER_MADS = 3.0    # Samples further than this many scaled MADs from the median are rejected
+MEASUREMENT_MAD_FLOOR_RATIO = 0.01  # Smallest spread used for rejection, relative to the median...
+MEASUREMENT_MAD_FLOOR_GRAMS = 0.001  # ...and in grams (one step of the 3-decimal readings)
+MEASUREMENT_MIN_INLIER_RATIO = 0.7  # Fewer samples than this surviving rejection means the readings were disturbed
+MEASUREMENT_JOBS_KEPT = 20        # Jobs kept per device for status lookups
+MEASUREMENT_LONG_POLL_MAX = 30    # Seconds a GET may wait for a job to finish
+MEASUREMENT_SAMPLE_RE = re.compile(r"Measurement sample (\d+): (-?[\d.]+)g")
+MEASUREMENT_RESULT_RE = re.compile(r"Measured single pill weight for '(.*)': (-?[\d.]+)g")
+MEASUREMENT_ERRORS = ("Error: No medication selected for measurement", "Error: Measured weight too small")
+
+def summarize_wpp_samples(samples):
+    """Mean and standard deviation of single-pill readings after rejecting outliers by median
+    absolute deviation (robust with the handful of samples one measurement produces)."""
+    median = statistics.median(samples)
+    mad = statistics.median(abs(x - median) for x in samples) * 1.4826  # Scaled to a normal std dev
+    # Floor the spread: with identical readings the MAD is 0 and would let any gross outlier through
+    limit = MEASUREMENT_OUTLIER_MADS * max(mad, abs(median) * MEASUREMENT_MAD_FLOOR_RATIO, MEASUREMENT_MAD_FLOOR_GRAMS)
+    keep = [abs(x - median) <= limit for x in samples]  # Per index, so duplicate readings are judged individually
+    kept = [x for x, k in zip(samples, keep) if k]
+    return {
+        "mean": statistics.fmean(kept),
+        "stddev": statistics.stdev(kept) if len(kept) > 1 else 0.0,
+        "median": median,
+        "samples": len(samples),
+        "used": len(kept),
+        "rejected": [x for x, k in zip(samples, keep) if not k]
+    }
+
+class MeasurementJob:
+    """One asynchronous WPP calibration: runs `rounds` MEASURE_SINGLE_PILL_WEIGHT commands, collects the
+    "Measurement sample i" lines the listener feeds it, and sets the medication's WPP to the outlier-
+    filtered mean. Progress and the result are pushed as "measurement" events on the status stream."""
+    def __init__(self, device, medication, rounds):
+        self.device = device
+        self.job_id = uuid.uuid4().hex[:12]
+        self.medication = medication
+        self.rounds = rounds
+        self.status = "running"     # running -> completed | failed | cancelled
+        self.samples = []
+        self.arduino_results = []   # WPP the Arduino computed for each round
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cond = threading.Condition()
+
+    def feed(self, line):
+        """Listener thread: take a measurement reply line. Returns True if the line belonged to this job."""
+        with self.cond:
+            if self.status != "running":
+                return False
+            sample = MEASUREMENT_SAMPLE_RE.match(line)
+            result = MEASUREMENT_RESULT_RE.match(line) if not sample else None
+            if sample:
+                self.samples.append(float(sample.group(2)))
+            elif result:
+                self.arduino_results.append(float(result.group(2)))
+            elif line.startswith(MEASUREMENT_ERRORS):
+                self.error = line
+            elif not line.startswith(("Starting single pill weight measurement", "Current reading:")):
+                return False
+            self.cond.notify_all()
+        publish_device_event(self.device, "measurement", self.to_dict())
+        return True
+
+    def run(self):
+        for round_index in range(self.rounds):
+            with self.cond:
+                if self.status != "running":
+                    return  # Cancelled
+                results_before = len(self.arduino_results)
+            if not send_to_arduino_command(self.device, "MEASURE_SINGLE_PILL_WEIGHT"):
+                return self._finish("failed", "Unable to send measurement command to Arduino")
+            with self.cond:
+                done = self.cond.wait_for(
+                    lambda: len(self.arduino_results) > results_before or self.error or self.status != "running",
+                    timeout=MEASUREMENT_ROUND_TIMEOUT)
+                error = self.error
+                if self.status != "running":
+                    return  # Cancelled
+            if error:
+                return self._finish("failed", error)
+            if not done:
+                return self._finish("failed", f"Arduino did not report round {round_index + 1} within {MEASUREMENT_ROUND_TIMEOUT}s")
+        with self.cond:
+            samples = list(self.samples)
+        if not samples:
+            return self._finish("failed", "No valid measurement samples received")
+        result = summarize_wpp_samples(samples)
+        wpp = result["mean"]
+        if result["used"] < MEASUREMENT_MIN_INLIER_RATIO * result["samples"]:
+            return self._finish("failed", f"Readings too unstable: only {result['used']} of {result['samples']} samples agree",
+                                result=result)
+        if wpp <= 0.0001:
+            return self._finish("failed", f"Measured weight too small ({wpp:.4f}g)")
+        # Held while the WPP is applied, so a concurrent cancel() lands either before it or after the job completed
+        with self.cond:
+            if self.status != "running":
+                return
+            with self.device.state.edit_inventory():
+                if self.medication not in self.device.state.pc_managed_medication_details:
+                    self._record("failed", f"Medication '{self.medication}' no longer exists")
+                else:
+                    self.device.state.pc_managed_medication_details[self.medication]['wpp'] = wpp
+                    recalculate_pill_count_for_med(self.device, self.medication)
+                    if self.medication == self.device.state.pc_active_medication_name:
+                        # The Arduino used its own plain mean; align it with the filtered value
+                        send_to_arduino_command(self.device, f"SET_PILL_WEIGHT:{wpp:.4f}")
+                    logger.info(f"[{self.device.device_id}] Measured WPP for '{self.medication}': {wpp:.4f}g "
+                                f"(sd {result['stddev']:.4f}g, {result['used']}/{result['samples']} samples)")
+                    self._record("completed", result=result)
+        self._announce()
+
+    def cancel(self):
+        """Stop a running job without changing the WPP. Returns False if it had already finished."""
+        if not self._finish("cancelled"):
+            return False
+        commands = ["CANCEL_MEASURE"]
+        with self.device.state.edit_inventory():
+            details = self.device.state.pc_managed_medication_details
+            if self.medication == self.device.state.pc_active_medication_name and self.medication in details:
+                # The Arduino applies its own mean when the round in progress ends; restore the stored WPP after it
+                commands.append(f"SET_PILL_WEIGHT:{details[self.medication]['wpp']:.4f}")
+        send_commands_to_arduino(self.device, commands)
+        return True
+
+    def _finish(self, status, error=None, result=None):
+        """Record the outcome and announce it, unless the job already finished (e.g. was cancelled)."""
+        with self.cond:
+            if self.status != "running":
+                return False
+            self._record(status, error, result)
+        self._announce()
+        return True
+
+    def _record(self, status, error=None, result=None):
+        """Caller holds self.cond."""
+        self.status = status
+        self.error = error
+        self.result = result
+        self.finished_at = time.time()
+        self.cond.notify_all()
+
+    def _announce(self):
+        if self.error:
+            logger.warning(f"[{self.device.device_id}] Measurement job {self.job_id} failed: {self.error}")
+        publish_device_event(self.device, "measurement", self.to_dict())
+        publish_status_change(self.device)
+
+    def wait(self, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.status != "running", timeout=timeout)
+
+    def to_dict(self):
+        with self.cond:
+            return {
+                "job_id": self.job_id,
+                "device_id": self.device.device_id,
+                "medication_name": self.medication,
+                "status": self.status,
+                "rounds": self.rounds,
+                "samples": list(self.samples),
+                "arduino_results": list(self.arduino_results),
+                "result": self.result,
+                "wpp": self.result["mean"] if self.status == "completed" else None,
+                "error": self.error,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at
+            }
+
+# --- Cloud sync outbox ---
+def cloud_sync_enabled():
+    # Skip default placeholder address
+    return bool(CLOUD_SERVER_URL) and "your-cloud-server.com" not in CLOUD_SERVER_URL
+
+class CloudSyncWorker:
+    """Posts outbox records to CLOUD_SERVER_URL in batches over one pooled HTTP session.
+    Records are deleted only after a 2xx response; failures back off exponentially and the
+    records stay in the outbox, so nothing is lost across outages or restarts."""
+    def __init__(self):
+        self.session = requests.Session()
+        self.wakeup = threading.Event()
+        self.consecutive_failures = 0
+        self.next_attempt_at = 0.0
+        self.last_success_at = None
+        self.last_error = None
+        self.records_sent = 0
+        self.batches_sent = 0
+
+    def enqueue(self, record):
+        if not cloud_sync_enabled():
+            logger.info("Skipped default cloud sync address, please configure valid CLOUD_SERVER_URL")
+            return
+        future = db.write('INSERT INTO cloud_outbox (payload, created_at) VALUES (?, ?)',
+                          (json.dumps(record), time.time()))
+        future.add_done_callback(lambda _: self.wakeup.set())
+
+    def send_pending_batch(self):
+        """Post up to CLOUD_SYNC_BATCH_SIZE records. Returns the number sent, or None on failure."""
+        rows = db.query('SELECT id, payload FROM cloud_outbox ORDER BY id LIMIT ?', (CLOUD_SYNC_BATCH_SIZE,))
+        if not rows:
+            return 0
+        # outbox_id lets the server drop duplicates if a response is lost and the batch is retried
+        records = [dict(json.loads(payload), outbox_id=row_id) for row_id, payload in rows]
+        ids = [row_id for row_id, _ in rows]
+        try:
+            response = self.session.post(CLOUD_SERVER_URL, json={"records": records}, timeout=CLOUD_SYNC_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            self.consecutive_failures += 1
+            self.last_error = str(e)
+            delay = min(CLOUD_SYNC_BACKOFF_MAX, CLOUD_SYNC_BACKOFF_BASE * 2 ** (self.consecutive_failures - 1))
+            self.next_attempt_at = time.time() + delay
+            db.write(f'UPDATE cloud_outbox SET attempts = attempts + 1, last_error = ? WHERE id IN ({",".join("?" * len(ids))})',
+                     [self.last_error[:500]] + ids)
+            logger.error(f"Cloud sync of {len(ids)} records failed ({self.consecutive_failures} in a row), retrying in {delay:.0f}s: {e}")
+            return None
+        db.write(f'DELETE FROM cloud_outbox WHERE id IN ({",".join("?" * len(ids))})', ids).result(timeout=10)
+        self.consecutive_failures = 0
+        self.next_attempt_at = 0.0
+        self.last_success_at = time.time()
+        self.records_sent += len(ids)
+        self.batches_sent += 1
+        logger.info(f"Synced {len(ids)} medication consumption records to cloud server")
+        return len(ids)
+
+    def run(self):
+        logger.info("Starting cloud sync worker thread.")
+        while True:
+            wait = max(0.0, self.next_attempt_at - time.time()) if self.consecutive_failures else CLOUD_SYNC_IDLE_INTERVAL
+            self.wakeup.wait(timeout=wait)
+            self.wakeup.clear()
+            if not cloud_sync_enabled() or time.time() < self.next_attempt_at:
+                continue
+            try:
+                # Drain the backlog batch by batch; stop at the first failure and back off
+                while self.send_pending_batch():
+                    pass
+            except Exception as e:
+                logger.error(f"Cloud sync worker error: {e}")
+
+    def status(self):
+        pending, oldest = db.query_one('SELECT COUNT(*), MIN(created_at) FROM cloud_outbox')
+        now = time.time()
+        return {
+            "enabled": cloud_sync_enabled(),
+            "pending_records": pending,
+            "lag_seconds": (now - oldest) if oldest else 0.0,
+            "records_sent": self.records_sent,
+            "batches_sent": self.batches_sent,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_in_seconds": max(0.0, self.next_attempt_at - now) if self.consecutive_failures else None,
+            "last_success_at": self.last_success_at,
+            "last_error": self.last_error
+        }
+
+cloud_sync = CloudSyncWorker()
+
+def connect_to_arduino(device):
     try:
-        if ser and ser.is_open: ser.close() 
-        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
-        logger.info(f"Attempting to connect to Arduino on {SERIAL_PORT}...")
-        time.sleep(2) 
-        if ser.is_open:
-            logger.info(f"Successfully connected to Arduino on {SERIAL_PORT}")
-            send_to_arduino_command(f"SET_MODE:{1 if current_mode_is_simulation else 0}") 
-            if pc_active_medication_name and pc_active_medication_name in pc_managed_medication_details:
-                sync_pc_active_med_to_arduino(pc_active_medication_name)
+        if device.ser and device.ser.is_open: device.ser.close()
+        device.ser = serial.Serial(device.port, device.baud_rate, timeout=1)
+        logger.info(f"[{device.device_id}] Attempting to connect to Arduino on {device.port}...")
+        time.sleep(2)
+        if device.ser.is_open:
+            logger.info(f"[{device.device_id}] Successfully connected to Arduino on {device.port}")
+            send_to_arduino_command(device, f"SET_MODE:{1 if device.state.current_mode_is_simulation else 0}") 
+            # Firmware without binary support only echoes the command, so text DATA lines keep flowing
+            send_to_arduino_command(device, f"SET_DATA_FORMAT:{1 if DATA_FORMAT == 'binary' else 0}")
+            if DATA_INTERVAL_MS:
+                send_to_arduino_command(device, f"SET_DATA_INTERVAL:{int(DATA_INTERVAL_MS)}")
+            if PILLBOX_COMPARTMENTS:
+                send_to_arduino_command(device, f"SET_COMPARTMENTS:{PILLBOX_COMPARTMENTS}")
+                push_simulated_compartment_weights(device)
+            with device.state.edit_inventory():
+                if device.state.pc_active_medication_name in device.state.pc_managed_medication_details:
+                    sync_pc_active_med_to_arduino(device, device.state.pc_active_medication_name)
             return True
         return False
     except Exception as e:
-        logger.error(f"Error connecting to Arduino: {e}")
-        ser = None 
+        logger.error(f"[{device.device_id}] Error connecting to Arduino on {device.port}: {e}")
+        device.ser = None
         return False
 
-def read_from_arduino_thread_function():
-    global arduino_raw_state, ser 
-    logger.info("Starting Arduino listener thread.")
+ARDUINO_STAGE_NAMES = ["Weighing", "Medication", "Resetting"]
+DATA_FRAME_MAGIC = b'\xaa\x55'
+# magic, seq, stage, flags, weight, pill count, wpp, lid distance, crc (matches DataFrame in project.ino)
+DATA_FRAME = struct.Struct('<2sHBBfhfhH')
+# Compartment frame: the DATA_FRAME fields without the CRC, then a count byte, count float32
+# compartment weights and the CRC over seq..weights
+COMPARTMENT_FRAME_MAGIC = b'\xaa\x56'
+COMPARTMENT_FRAME_HEADER = struct.Struct('<2sHBBfhfhB')
+
+class DataFrame:
+    """One decoded binary DATA frame."""
+    __slots__ = ("seq", "stage_name", "lid_open", "weight", "pill_count", "wpp", "lid_distance_cm", "compartments")
+
+    def __init__(self, seq, stage_name, lid_open, weight, pill_count, wpp, lid_distance_cm, compartments=()):
+        self.seq = seq
+        self.stage_name = stage_name
+        self.lid_open = lid_open
+        self.weight = weight
+        self.pill_count = pill_count
+        self.wpp = wpp
+        self.lid_distance_cm = lid_distance_cm
+        self.compartments = compartments
+
+def data_frame_size(buffer):
+    """Size of the frame starting at buffer[0], None if more bytes are needed to tell, 0 if the
+    compartment count is impossible (corrupt header)."""
+    if buffer.startswith(DATA_FRAME_MAGIC):
+        return DATA_FRAME.size
+    if len(buffer) < COMPARTMENT_FRAME_HEADER.size:
+        return None
+    count = buffer[COMPARTMENT_FRAME_HEADER.size - 1]
+    return COMPARTMENT_FRAME_HEADER.size + 4 * count + 2 if count <= MAX_COMPARTMENTS else 0
+
+def find_frame_magic(buffer):
+    positions = [at for at in (buffer.find(DATA_FRAME_MAGIC), buffer.find(COMPARTMENT_FRAME_MAGIC)) if at >= 0]
+    return min(positions) if positions else -1
+
+def decode_data_frame(view, offset=0):
+    """Decode a binary DATA or compartment frame from a buffer without copying; returns None if the CRC does not match."""
+    compartments = ()
+    if view[offset + 1] == COMPARTMENT_FRAME_MAGIC[1]:
+        _, seq, stage, flags, weight, pill_count, wpp, lid_distance, count = COMPARTMENT_FRAME_HEADER.unpack_from(view, offset)
+        end = offset + COMPARTMENT_FRAME_HEADER.size + 4 * count
+        crc, = struct.unpack_from('<H', view, end)
+        if binascii.crc_hqx(view[offset + 2:end], 0xFFFF) != crc:
+            return None
+        compartments = tuple(round(w, 3) for w in struct.unpack_from(f'<{count}f', view, offset + COMPARTMENT_FRAME_HEADER.size))
+    else:
+        _, seq, stage, flags, weight, pill_count, wpp, lid_distance, crc = DATA_FRAME.unpack_from(view, offset)
+        if binascii.crc_hqx(view[offset + 2:offset + DATA_FRAME.size - 2], 0xFFFF) != crc:
+            return None
+    stage_name = ARDUINO_STAGE_NAMES[stage] if stage < len(ARDUINO_STAGE_NAMES) else f"Stage{stage}"
+    return DataFrame(seq, stage_name, bool(flags & 0x01), round(weight, 3), pill_count, wpp, float(lid_distance),
+                     compartments)
+
+class SerialLineFramer:
+    """Splits bulk serial reads into complete lines and binary DATA frames, remembering when each
+    unit's first byte arrived. Frames are recognised by their magic at a unit boundary."""
+    def __init__(self, max_line_length=512):
+        self.buffer = bytearray()
+        self.max_line_length = max_line_length
+        self.line_started_at = None
+        self.frames = 0
+        self.crc_errors = 0
+
+    def feed(self, chunk, now):
+        if chunk and not self.buffer:
+            self.line_started_at = now
+        self.buffer += chunk
+        units = []
+        while self.buffer:
+            if self.buffer.startswith(DATA_FRAME_MAGIC) or self.buffer.startswith(COMPARTMENT_FRAME_MAGIC):
+                size = data_frame_size(self.buffer)
+                if size == 0:
+                    # Impossible compartment count: drop the magic and resynchronise on the next unit
+                    self.crc_errors += 1
+                    del self.buffer[:2]
+                    continue
+                if size is None or len(self.buffer) < size:
+                    break
+                with memoryview(self.buffer) as view:
+                    frame = decode_data_frame(view)
+                if frame is None:
+                    # Corrupt frame: the size is known, so skip the whole frame to stay aligned
+                    self.crc_errors += 1
+                    del self.buffer[:size]
+                    continue
+                self.frames += 1
+                del self.buffer[:size]
+                units.append((frame, self.line_started_at))
+            else:
+                newline_at = self.buffer.find(b'\n')
+                magic_at = find_frame_magic(self.buffer)
+                if newline_at < 0 and magic_at < 0:
+                    break
+                end = newline_at if magic_at < 0 or 0 <= newline_at < magic_at else magic_at
+                raw = bytes(self.buffer[:end])
+                del self.buffer[:end + 1 if end == newline_at else end]
+                units.append((raw.decode('utf-8', errors='replace').strip(), self.line_started_at))
+            self.line_started_at = now if self.buffer else None
+        if len(self.buffer) > self.max_line_length:
+            logger.warning(f"Discarding {len(self.buffer)} bytes of unterminated serial data")
+            self.buffer.clear()
+            self.line_started_at = None
+        return units
+
+    def reset(self):
+        self.buffer.clear()
+        self.line_started_at = None
+
+# Per-line latency metrics for the serial reader (see /api/serial_metrics)
+SERIAL_METRICS_WINDOW = 500
+
+def new_serial_metrics():
+    return {
+        "lines": 0,
+        "bytes": 0,
+        "transfer_ms": deque(maxlen=SERIAL_METRICS_WINDOW),  # First byte of a line -> its newline
+        "dispatch_ms": deque(maxlen=SERIAL_METRICS_WINDOW),  # Newline -> state updated and published
+        "last_line_at": None,
+        "frames": 0,           # Binary DATA frames decoded
+        "frame_crc_errors": 0,
+        "frames_dropped": 0,   # Gaps in the frame sequence number
+        "data_format": "text"  # Format last confirmed by the Arduino
+    }
+
+def record_line_metrics(device, line_started_at, received_at, dispatched_at):
+    with device.serial_metrics_lock:
+        device.serial_metrics["lines"] += 1
+        device.serial_metrics["last_line_at"] = received_at
+        if line_started_at is not None:
+            device.serial_metrics["transfer_ms"].append((received_at - line_started_at) * 1000.0)
+        device.serial_metrics["dispatch_ms"].append((dispatched_at - received_at) * 1000.0)
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+def handle_arduino_line(device, line, received_at):
+    """Apply one framed line from the Arduino to the device state."""
+    sample = None
+    with device.state.edit_telemetry():
+        raw = device.state.arduino_raw_state
+        raw["last_update"] = received_at
+        raw["raw_data"] = line
+        if line.startswith("DATA:"):
+            logger.debug(f"Received DATA line: {line}")
+            parts = line[5:].split(',')
+            if len(parts) >= 5:
+                raw["stage_name"] = parts[0]
+                try: raw["total_weight_in_box_arduino"] = float(parts[1])
+                except ValueError: logger.warning(f"Unable to parse weight data: {parts[1]}")
+                try: raw["pill_count_arduino_current_med"] = int(parts[2])
+                except ValueError: logger.warning(f"Unable to parse pill count: {parts[2]}")
+                raw["current_med_on_arduino"] = parts[3]
+                try: raw["wpp_arduino_current_med"] = float(parts[4])
+                except ValueError: logger.warning(f"Unable to parse WPP: {parts[4]}")
+                # Parse ultrasonic sensor data: distance and status
+                if len(parts) >= 7:
+                    try: raw["lid_distance_cm"] = float(parts[5])
+                    except ValueError: raw["lid_distance_cm"] = None
+                    try: raw["lid_open"] = bool(int(parts[6]))
+                    except (ValueError, IndexError): raw["lid_open"] = False
+                # Per-compartment weights: "w0;w1;..."
+                if len(parts) >= 8 and parts[7]:
+                    try: update_compartment_weights(device, raw, received_at, [float(w) for w in parts[7].split(';')])
+                    except ValueError: logger.warning(f"Unable to parse compartment weights: {parts[7]}")
+                device.weight_series.append(received_at, raw["total_weight_in_box_arduino"],
+                                     raw["lid_open"], raw["lid_distance_cm"])
+                raw["filtered_weight"], raw["weight_settled"] = device.weight_filter.update(
+                    received_at, raw["total_weight_in_box_arduino"])
+                sample = (raw["lid_open"], raw["filtered_weight"], raw["weight_settled"])
+        elif line.startswith("WEIGHT:"):
+            # Handle response from GET_WEIGHT command
+            try:
+                raw["total_weight_in_box_arduino"] = float(line.split(':')[1].strip())
+                logger.debug(f"Received weight data: {raw['total_weight_in_box_arduino']}g")
+            except (ValueError, IndexError) as e:
+                logger.warning(f"Failed to parse weight data: {line}, error: {e}")
+    if line.startswith("DATA:"):
+        if sample:
+            detect_removal_events(device, received_at, *sample)
+            sync_compartment_inventory(device)
+    elif line.startswith("WEIGHT:"):
+        pass  # Stored above; GET_WEIGHT callers get the line through serial_mux
+    elif line.startswith("DATA_FORMAT:"):
+        with device.serial_metrics_lock:
+            device.serial_metrics["data_format"] = "binary" if line[12:].strip() == "1" else "text"
+        device.last_data_frame_seq = None
+        logger.info(f"Arduino DATA format: {device.serial_metrics['data_format']}")
+    elif "Arduino Pillbox Ready" in line: 
+        logger.info("Arduino confirmed ready")
+    elif device.measurement_job and device.measurement_job.feed(line):
+        # Sample/result lines of a running WPP measurement job
+        logger.info(f"Measurement info: {line}")
+    elif line: 
+        logger.info(f"Arduino message: {line}") 
+    publish_status_change(device)
+
+def handle_data_frame(device, frame, received_at):
+    """Apply one binary DATA frame. The medication name is not in the frame; it comes from the text
+    DATA line the Arduino sends after every command."""
+    if device.last_data_frame_seq is not None:
+        gap = (frame.seq - device.last_data_frame_seq - 1) & 0xFFFF
+        if 0 < gap < 0x8000:
+            with device.serial_metrics_lock:
+                device.serial_metrics["frames_dropped"] += gap
+    device.last_data_frame_seq = frame.seq
+    with device.state.edit_telemetry():
+        raw = device.state.arduino_raw_state
+        raw["last_update"] = received_at
+        raw["stage_name"] = frame.stage_name
+        raw["total_weight_in_box_arduino"] = frame.weight
+        raw["pill_count_arduino_current_med"] = frame.pill_count
+        raw["wpp_arduino_current_med"] = round(frame.wpp, 4)
+        raw["lid_distance_cm"] = frame.lid_distance_cm
+        raw["lid_open"] = frame.lid_open
+        raw["filtered_weight"], raw["weight_settled"] = device.weight_filter.update(received_at, frame.weight)
+        if frame.compartments:
+            update_compartment_weights(device, raw, received_at, frame.compartments)
+        sample = (raw["lid_open"], raw["filtered_weight"], raw["weight_settled"])
+    device.weight_series.append(received_at, frame.weight, frame.lid_open, frame.lid_distance_cm)
+    detect_removal_events(device, received_at, *sample)
+    sync_compartment_inventory(device)
+    publish_status_change(device)
+
+def read_from_arduino_thread_function(device):
+    logger.info(f"[{device.device_id}] Starting Arduino listener thread.")
     connection_retries = 0
     last_reconnect_attempt = 0
+    framer = SerialLineFramer()
     
     while True:
         # Check connection status, if not connected or last update exceeds 10 seconds, attempt to reconnect
         current_time = time.time()
-        connection_lost = not (ser and ser.is_open) or (current_time - arduino_raw_state.get("last_update", 0) > 10)
+        connection_lost = not is_serial_connected(device) or (current_time - device.state.snapshot().arduino_raw_state["last_update"] > 10)
         
         if connection_lost and current_time - last_reconnect_attempt > 5:  # At least 5 seconds between reconnection attempts
             last_reconnect_attempt = current_time
             connection_retries += 1
-            logger.warning(f"Arduino connection lost or timeout, attempting to reconnect (Attempt {connection_retries})")
-            
+            logger.warning(f"[{device.device_id}] Arduino connection lost or timeout, attempting to reconnect (Attempt {connection_retries})")
+
             # Close any existing old connection
-            if ser and ser.is_open:
+            if is_serial_connected(device):
                 try:
-                    ser.close()
+                    device.ser.close()
                 except:
                     pass
                     
             # Attempt to reconnect
-            if connect_to_arduino(): 
+            framer.reset()
+            if connect_to_arduino(device): 
                 connection_retries = 0
-                logger.info("Arduino reconnection successful")
+                logger.info(f"[{device.device_id}] Arduino reconnection successful")
             else:
-                logger.error("Arduino reconnection failed")
+                logger.error(f"[{device.device_id}] Arduino reconnection failed")
                 # Brief sleep to avoid too frequent reconnection attempts
                 time.sleep(1)
                 continue
                 
         try:
-            if ser and ser.is_open and ser.in_waiting > 0: 
-                line = ser.readline().decode('utf-8', errors='replace').strip()
-                with data_lock: 
-                    arduino_raw_state["last_update"] = time.time()
-                    arduino_raw_state["raw_data"] = line
-                if line.startswith("DATA:"): 
-                    logger.debug(f"Received DATA line: {line}")
-                    parts = line[5:].split(',')
-                    if len(parts) >= 5: 
-                        with data_lock:
-                            arduino_raw_state["stage_name"] = parts[0]
-                            try: arduino_raw_state["total_weight_in_box_arduino"] = float(parts[1])
-                            except ValueError: logger.warning(f"Unable to parse weight data: {parts[1]}")
-                            try: arduino_raw_state["pill_count_arduino_current_med"] = int(parts[2])
-                            except ValueError: logger.warning(f"Unable to parse pill count: {parts[2]}")
-                            arduino_raw_state["current_med_on_arduino"] = parts[3]
-                            try: arduino_raw_state["wpp_arduino_current_med"] = float(parts[4])
-                            except ValueError: logger.warning(f"Unable to parse WPP: {parts[4]}")
-                            # Parse ultrasonic sensor data: distance and status
-                            if len(parts) >= 7:
-                                try: arduino_raw_state["lid_distance_cm"] = float(parts[5])
-                                except ValueError: arduino_raw_state["lid_distance_cm"] = None
-                                try: arduino_raw_state["lid_open"] = bool(int(parts[6]))
-                                except (ValueError, IndexError): arduino_raw_state["lid_open"] = False
-                            
-                            if arduino_raw_state["current_med_on_arduino"] == pc_active_medication_name and \
-                               pc_active_medication_name in pc_managed_medication_details and \
-                               abs(pc_managed_medication_details[pc_active_medication_name]['wpp'] - arduino_raw_state["wpp_arduino_current_med"]) > 0.0001: 
-                                if "Measured single pill weight" in arduino_raw_state["raw_data"] or "MEASURE_SINGLE_PILL_WEIGHT" in arduino_raw_state["raw_data"]: 
-                                    logger.info(f"Arduino reported new WPP value for '{pc_active_medication_name}': {arduino_raw_state['wpp_arduino_current_med']:.3f}g. Updating PC record.")
-                                    pc_managed_medication_details[pc_active_medication_name]['wpp'] = arduino_raw_state["wpp_arduino_current_med"]
-                                    recalculate_pill_count_for_med(pc_active_medication_name) 
-                elif line.startswith("WEIGHT:"): 
-                    # Handle response from GET_WEIGHT command
-                    try:
-                        weight_value = float(line.split(':')[1].strip())
-                        with data_lock:
-                            arduino_raw_state["total_weight_in_box_arduino"] = weight_value
-                            arduino_raw_state["last_update"] = time.time()
-                        logger.debug(f"Received weight data: {weight_value}g")
-                    except (ValueError, IndexError) as e:
-                        logger.warning(f"Failed to parse weight data: {line}, error: {e}")
-                elif "Arduino Pillbox Ready" in line: 
-                    logger.info("Arduino confirmed ready")
-                elif "Measuring sample" in line or "Starting measurement" in line:
-                    # Record measurement process information
-                    logger.info(f"Measurement info: {line}")
-                elif line: 
-                    logger.info(f"Arduino message: {line}") 
-            else: 
-                time.sleep(0.05)  # Brief sleep to avoid excessive CPU usage
+            port = device.ser
+            if not (port and port.is_open):
+                time.sleep(0.5)
+                continue
+            # Blocks in the OS until at least one byte arrives (or the port timeout expires),
+            # then takes everything already buffered in one bulk read
+            chunk = port.read(port.in_waiting or 1)
+            if not chunk:
+                continue
+            received_at = time.time()
+            with device.serial_metrics_lock:
+                device.serial_metrics["bytes"] += len(chunk)
+            for unit, line_started_at in framer.feed(chunk, received_at):
+                if isinstance(unit, DataFrame):
+                    handle_data_frame(device, unit, received_at)
+                else:
+                    handle_arduino_line(device, unit, received_at)
+                    device.serial_mux.dispatch_line(unit)
+                record_line_metrics(device, line_started_at, received_at, time.time())
+            with device.serial_metrics_lock:
+                device.serial_metrics["frames"] = framer.frames
+                device.serial_metrics["frame_crc_errors"] = framer.crc_errors
         except serial.SerialException as e: 
-            logger.error(f"Serial communication error: {e}. Closing port and will attempt to reconnect in next cycle.")
+            logger.error(f"[{device.device_id}] Serial communication error: {e}. Closing port and will attempt to reconnect in next cycle.")
             try:
-                if ser: 
-                    ser.close()
+                if device.ser:
+                    device.ser.close()
             except:
                 pass
-            ser = None 
+            device.ser = None 
+            framer.reset()
             time.sleep(1)  # Brief sleep after error
         except Exception as e: 
-            logger.error(f"Arduino listener thread error: {e}")
+            logger.error(f"[{device.device_id}] Arduino listener thread error: {e}")
             time.sleep(0.5)
 
-def send_to_arduino_command(command_str):
-    if ser and ser.is_open:
+class SerialCommandMux:
+    """Single owner of serial writes. Commands are queued for the writer thread; callers that need
+    a reply register the expected line prefix(es) first, and the listener thread resolves the
+    oldest matching waiter when such a line arrives. Handlers never read or write `device.ser` directly."""
+    def __init__(self, device):
+        self.device = device
+        self.commands = queue.Queue()
+        self.waiters = []  # [prefixes, future] in submission order
+        self.waiters_lock = threading.Lock()
+
+    def send(self, command_str, expect=None):
+        """Queue a command. Returns a Future for the reply line if `expect` prefixes are given."""
+        future = self._expect(expect) if expect else None
+        self.commands.put(([command_str], future))
+        return future
+
+    def send_batch(self, commands):
+        """Queue a group of commands that is written back-to-back without other commands in between."""
+        if commands:
+            self.commands.put((list(commands), None))
+
+    def _expect(self, expect):
+        future = Future()
+        prefixes = (expect,) if isinstance(expect, str) else tuple(expect)
+        with self.waiters_lock:
+            self.waiters.append([prefixes, future])
+        return future
+
+    def request(self, command_str, expect, timeout=2.0):
+        """Send a command and wait for the first line starting with one of `expect`. None on timeout."""
+        if not is_serial_connected(self.device):
+            return None
+        future = self.send(command_str, expect)
         try:
-            logger.info(f"Sending to Arduino: {command_str}")
-            ser.write((command_str + '\n').encode('utf-8')) 
-            return True
-        except Exception as e:
-            logger.error(f"Error writing to serial port: {e}")
-            return False
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self._drop(future)
+            logger.warning(f"No reply to '{command_str}' within {timeout:.1f}s (expected {expect})")
+            return None
+
+    def dispatch_line(self, line):
+        """Called by the listener for every framed line; returns True if a waiter took it."""
+        with self.waiters_lock:
+            for index, (prefixes, future) in enumerate(self.waiters):
+                if line.startswith(prefixes):
+                    del self.waiters[index]
+                    break
+            else:
+                return False
+        if not future.done():
+            future.set_result(line)
+        return True
+
+    def _drop(self, future):
+        with self.waiters_lock:
+            self.waiters = [w for w in self.waiters if w[1] is not future]
+        if not future.done():
+            future.set_result(None)
+
+    def writer_loop(self):
+        """Write queued commands, packing as many as fit in the Arduino's receive buffer into one write.
+        Each command holds buffer credit until its "Arduino received:" ack (or ARDUINO_ACK_TIMEOUT)."""
+        logger.info(f"[{self.device.device_id}] Starting Arduino writer thread.")
+        in_flight = deque()  # (nbytes, ack_future, deadline)
+        while True:
+            commands, future = self.commands.get()
+            pending = [(c, (c + '\n').encode('utf-8')) for c in commands]
+            try:
+                while pending:
+                    port = self.device.ser
+                    if not (port and port.is_open):
+                        raise serial.SerialException("Serial port not connected")
+                    now = time.time()
+                    while in_flight and (in_flight[0][1].done() or in_flight[0][2] <= now):
+                        self._drop(in_flight.popleft()[1])
+                    used = sum(entry[0] for entry in in_flight)
+                    group = []
+                    while pending and (not in_flight and not group or used + len(pending[0][1]) <= ARDUINO_RX_BUFFER_BYTES):
+                        command_str, payload = pending.pop(0)
+                        # The Arduino echoes at most inputBuffer-1 characters of each command
+                        ack = self._expect(f"Arduino received: {command_str[:ARDUINO_RX_BUFFER_BYTES - 1]}")
+                        in_flight.append((len(payload), ack, now + ARDUINO_ACK_TIMEOUT))
+                        group.append((command_str, payload))
+                        used += len(payload)
+                    if not group:
+                        # Window full: wait for the oldest outstanding ack to free credit
+                        oldest = in_flight[0]
+                        try:
+                            oldest[1].result(timeout=max(0.0, oldest[2] - now))
+                        except FutureTimeoutError:
+                            logger.debug("Arduino ack timed out; releasing its buffer credit")
+                            self._drop(oldest[1])
+                        continue
+                    logger.info(f"[{self.device.device_id}] Sending to Arduino: {' | '.join(c for c, _ in group)}")
+                    port.write(b''.join(payload for _, payload in group))
+            except Exception as e:
+                logger.error(f"Error writing {commands} to serial port: {e}")
+                for _, ack, _ in in_flight:
+                    self._drop(ack)
+                in_flight.clear()
+                if future is not None:
+                    self._drop(future)
+
+def is_serial_connected(device):
+    port = device.ser
+    return bool(port and port.is_open)
+
+def send_to_arduino_command(device, command_str):
+    if is_serial_connected(device):
+        device.serial_mux.send(command_str)
+        return True
     logger.warning("Cannot send command: Serial port not connected.")
     return False
 
-def recalculate_pill_count_for_med(med_name):
-    if med_name in pc_managed_medication_details:
-        details = pc_managed_medication_details[med_name]
-        if details['wpp'] > 0.0001: 
-            if details['total_weight_in_box'] < (details['wpp'] / 2.0): 
-                details['count_in_box'] = 0
-            else:
-                details['count_in_box'] = int(round(details['total_weight_in_box'] / details['wpp'])) 
-        else:
-            details['count_in_box'] = 0 
+def send_commands_to_arduino(device, commands):
+    """Send a command group as one pipelined batch (flow-controlled by the Arduino's acks)."""
+    if is_serial_connected(device):
+        device.serial_mux.send_batch(commands)
+        return True
+    logger.warning("Cannot send commands: Serial port not connected.")
+    return False
+
+def recalculate_pill_count_for_med(device, med_name):
+    """Caller is inside device.state.edit_inventory()."""
+    if med_name in device.state.pc_managed_medication_details:
+        device.state.pc_managed_medication_details.recalculate([med_name])
+        details = device.state.pc_managed_medication_details[med_name]
         logger.debug(f"Recalculated PC count for {med_name}: {details['count_in_box']} (TotalW: {details['total_weight_in_box']:.2f}g, WPP: {details['wpp']:.3f}g)")
 
-def sync_pc_active_med_to_arduino(med_name_to_sync):
-    if med_name_to_sync and med_name_to_sync in pc_managed_medication_details:
-        details = pc_managed_medication_details[med_name_to_sync]
-        send_to_arduino_command(f"SELECT_MEDICATION:{med_name_to_sync}")
-        time.sleep(0.05) 
-        send_to_arduino_command(f"SET_PILL_WEIGHT:{details['wpp']:.4f}")
-        time.sleep(0.05)
-        if current_mode_is_simulation: 
-            send_to_arduino_command(f"SET_WEIGHT:{details['total_weight_in_box']:.2f}")
+def build_sync_commands(device, med_name):
+    """Commands that make the Arduino's active medication context match the PC record."""
+    details = device.state.pc_managed_medication_details[med_name]
+    commands = [f"SELECT_MEDICATION:{med_name}", f"SET_PILL_WEIGHT:{details['wpp']:.4f}"]
+    if device.state.current_mode_is_simulation:  
+        commands.append(f"SET_WEIGHT:{details['total_weight_in_box']:.2f}")
+    return commands
+
+def sync_pc_active_med_to_arduino(device, med_name_to_sync, extra_commands=()):
+    """Caller is inside device.state.edit_inventory(); commands are only queued, never written under the lock."""
+    if med_name_to_sync and med_name_to_sync in device.state.pc_managed_medication_details:
+        details = device.state.pc_managed_medication_details[med_name_to_sync]
+        if not send_commands_to_arduino(device, build_sync_commands(device, med_name_to_sync) + list(extra_commands)):
+            return False
         logger.info(f"Synced PC state for '{med_name_to_sync}' to Arduino (WPP: {details['wpp']:.3f}g, TotalW (if sim): {details['total_weight_in_box']:.2f}g).")
         return True
     logger.warning(f"Could not sync '{med_name_to_sync}' to Arduino: not found in PC details.")
     return False
 
+# --- Device registry ---
+class PillboxDevice:
+    """One pillbox on its own serial port. Each device has its own state, command mux, listener
+    and writer threads, weight sample ring and status stream, so a slow or disconnected box never
+    holds up another."""
+    def __init__(self, device_id, port, baud_rate=BAUD_RATE):
+        self.device_id = device_id
+        self.port = port
+        self.baud_rate = baud_rate
+        self.ser = None
+        self.state = PillboxState()
+        # Restore the persisted inventory before journaling starts, so the restore itself is not logged
+        self.inventory_journal = InventoryJournal(device_id)
+        if self.inventory_journal.restore(self.state):
+            logger.info(f"[{device_id}] Restored {len(self.state.pc_managed_medication_details)} medication(s) from the inventory journal")
+        self.state.on_inventory_change = self.inventory_journal.record
+        self.serial_mux = SerialCommandMux(self)
+        self.weight_series = WeightSampleRing(WEIGHT_RING_CAPACITY)
+        self.weight_filter = WeightFilter()
+        self.compartment_filters = []   # One WeightFilter per reported compartment
+        self.removal_detector = RemovalDetector()
+        self.measurement_job = None     # Running or most recent MeasurementJob
+        self.measurement_jobs = {}      # job_id -> MeasurementJob, oldest first
+        self.measurement_lock = threading.Lock()
+        self.serial_metrics_lock = threading.Lock()
+        self.serial_metrics = new_serial_metrics()
+        self.last_data_frame_seq = None
+        self.status_stream_cond = threading.Condition()
+        self.status_event_id = 0
+        self.status_event_log = deque(maxlen=STATUS_EVENT_BACKLOG)  # (event_id, event, data) triples
+        self.last_published_status = None
+
+    def start(self):
+        if not connect_to_arduino(self):
+            logger.warning(f"[{self.device_id}] Failed to connect to Arduino at startup, listener thread will retry continuously.")
+        threading.Thread(target=read_from_arduino_thread_function, args=(self,), daemon=True).start()
+        threading.Thread(target=self.serial_mux.writer_loop, daemon=True).start()
+
+def parse_device_config(spec):
+    """Parse PILLBOX_DEVICES ("id=port,id=port") into (device_id, port) pairs."""
+    if not spec.strip():
+        return [("default", SERIAL_PORT)]
+    pairs = []
+    for entry in spec.split(','):
+        device_id, sep, port = entry.strip().partition('=')
+        if not sep or not device_id.strip() or not port.strip():
+            raise ValueError(f"Invalid PILLBOX_DEVICES entry '{entry}', expected device_id=port")
+        pairs.append((device_id.strip(), port.strip()))
+    return pairs
+
+devices = {}  # device_id -> PillboxDevice, in configuration order
+for device_id, port in parse_device_config(PILLBOX_DEVICES):
+    devices[device_id] = PillboxDevice(device_id, port)
+DEFAULT_DEVICE_ID = next(iter(devices))
+
+def device_route(rule, **options):
+    """Register a device view at `rule` for the default device and at `/devices/<device_id><rule>`
+    for any registered device. The view receives the PillboxDevice as its first argument."""
+    def decorator(view):
+        @functools.wraps(view)
+        def scoped_view(*args, device_id=None, **kwargs):
+            device = devices.get(device_id or DEFAULT_DEVICE_ID)
+            if device is None:
+                return jsonify({"status": "error", "message": f"Unknown device: {device_id}"}), 404
+            g.device = device
+            return view(device, *args, **kwargs)
+        app.add_url_rule(rule, view.__name__, scoped_view, **options)
+        app.add_url_rule(f"/devices/<device_id>{rule}", f"{view.__name__}_for_device", scoped_view, **options)
+        return scoped_view
+    return decorator
+
+@app.route('/api/devices', methods=['GET'])
+def list_devices_api():
+    result = []
+    for device in devices.values():
+        raw = device.state.snapshot().arduino_raw_state
+        result.append({
+            "device_id": device.device_id,
+            "port": device.port,
+            "connected": is_serial_connected(device),
+            "stage_name": raw["stage_name"],
+            "last_update": raw["last_update"],
+            "default": device.device_id == DEFAULT_DEVICE_ID
+        })
+    return jsonify(result)
+
 @app.route('/')
 def index():
+    snap = devices[DEFAULT_DEVICE_ID].state.snapshot()
     return render_template('index.html', initial_state={
-        "is_simulation": current_mode_is_simulation,
-        "pc_active_medication_name": pc_active_medication_name,
-        "pc_managed_medication_details": dict(pc_managed_medication_details) 
+        "is_simulation": snap.current_mode_is_simulation,
+        "pc_active_medication_name": snap.pc_active_medication_name,
+        "pc_managed_medication_details": snap.pc_managed_medication_details.to_dict()
     })
 
-@app.route('/get_status')
-def get_status_api():
-    with data_lock: 
-        status_to_send = {
-            "arduino_state": dict(arduino_raw_state), 
-            "is_simulation": current_mode_is_simulation,
-            "pc_managed_medication_details": dict(pc_managed_medication_details), 
-            "pc_active_medication_name": pc_active_medication_name
+def build_status_snapshot(device):
+    """Build the status payload shared by /get_status and /stream_status from the published state (no locks)."""
+    snap = device.state.snapshot()
+    status = {
+        "arduino_state": dict(snap.arduino_raw_state),
+        "is_simulation": snap.current_mode_is_simulation,
+        "pc_managed_medication_details": snap.pc_managed_medication_details.to_dict(),
+        "pc_active_medication_name": snap.pc_active_medication_name
+    }
+    if PILLBOX_COMPARTMENTS:
+        status["compartments"] = compartment_status(snap)
+    if time.time() - snap.arduino_raw_state["last_update"] > 20 :
+        status["arduino_state"]["stage_name"] = "Disconnected"
+        status["arduino_state"]["raw_data"] = "Connection to Arduino potentially lost (stale data)."
+    return status
+
+def diff_status(old, new):
+    """Return the keys of `new` that differ from `old`, recursing one level into dicts.
+    `last_update` alone never counts as a change, but is carried along with any real change."""
+    delta = {}
+    for key, value in new.items():
+        old_value = old.get(key) if old else None
+        if isinstance(value, dict) and isinstance(old_value, dict) and key == "arduino_state":
+            sub = {k: v for k, v in value.items() if k != "last_update" and old_value.get(k) != v}
+            if sub:
+                sub["last_update"] = value.get("last_update")
+                delta[key] = sub
+        elif key not in (old or {}) or old_value != value:
+            delta[key] = value
+    return delta
+
+def publish_status_change(device):
+    """Diff current state against the last published snapshot and wake stream clients if it changed."""
+    with device.status_stream_cond:
+        # Built under the condition so concurrent publishers cannot publish an older snapshot last
+        snapshot = build_status_snapshot(device)
+        delta = diff_status(device.last_published_status, snapshot)
+        if not delta:
+            return False
+        device.last_published_status = snapshot
+        device.status_event_id += 1
+        device.status_event_log.append((device.status_event_id, "delta", delta))
+        device.status_stream_cond.notify_all()
+    return True
+
+def publish_device_event(device, event, data):
+    """Push a named event (e.g. "removal") to the device's status stream clients, in order with the deltas."""
+    with device.status_stream_cond:
+        device.status_event_id += 1
+        device.status_event_log.append((device.status_event_id, event, data))
+        device.status_stream_cond.notify_all()
+
+def format_sse(data, event=None, event_id=None):
+    msg = ""
+    if event_id is not None: msg += f"id: {event_id}\n"
+    if event: msg += f"event: {event}\n"
+    msg += f"data: {json.dumps(data)}\n\n"
+    return msg
+
+@device_route('/get_status')
+def get_status_api(device):
+    return jsonify(build_status_snapshot(device))
+
+@device_route('/stream_status')
+def stream_status_api(device):
+    """Server-Sent Events stream: one full snapshot, then deltas only when state changes, interleaved
+    with "removal" events (lid opened/closed, pills removed/added) as they are detected.
+    Reconnecting clients send Last-Event-ID and get missed events replayed when still buffered."""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id is not None else None
+    except ValueError:
+        last_event_id = None
+
+    def generate():
+        publish_status_change(device)
+        with device.status_stream_cond:
+            current_id = device.status_event_id
+            backlog = [entry for entry in device.status_event_log if last_event_id is not None and entry[0] > last_event_id]
+            can_replay = last_event_id is not None and last_event_id <= current_id and \
+                (last_event_id == current_id or (backlog and backlog[0][0] == last_event_id + 1))
+            snapshot = device.last_published_status
+        yield "retry: 3000\n\n"
+        if can_replay:
+            for eid, event, data in backlog:
+                yield format_sse(data, event, eid)
+        else:
+            yield format_sse(snapshot, "snapshot", current_id)
+        sent_id = current_id
+        while True:
+            with device.status_stream_cond:
+                if device.status_event_id == sent_id:
+                    device.status_stream_cond.wait(timeout=STATUS_HEARTBEAT_INTERVAL)
+                pending = [entry for entry in device.status_event_log if entry[0] > sent_id]
+                resync = pending and pending[0][0] != sent_id + 1
+                snapshot = device.last_published_status
+                latest_id = device.status_event_id
+            if resync:
+                # Client fell further behind than the backlog holds; send a fresh snapshot
+                yield format_sse(snapshot, "snapshot", latest_id)
+                sent_id = latest_id
+            elif pending:
+                for eid, event, data in pending:
+                    yield format_sse(data, event, eid)
+                sent_id = pending[-1][0]
+            else:
+                # Heartbeat: also lets the staleness check publish a "Disconnected" change
+                if not publish_status_change(device):
+                    yield ": heartbeat\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@device_route('/api/serial_metrics')
+def serial_metrics_api(device):
+    """Serial reader latency: wire transfer time per line and time from newline to published state."""
+    with device.serial_metrics_lock:
+        transfer = list(device.serial_metrics["transfer_ms"])
+        dispatch = list(device.serial_metrics["dispatch_ms"])
+        result = {
+            "lines": device.serial_metrics["lines"],
+            "bytes": device.serial_metrics["bytes"],
+            "last_line_age_s": (time.time() - device.serial_metrics["last_line_at"]) if device.serial_metrics["last_line_at"] else None,
+            "data_format": device.serial_metrics["data_format"],
+            "frames": device.serial_metrics["frames"],
+            "frame_crc_errors": device.serial_metrics["frame_crc_errors"],
+            "frames_dropped": device.serial_metrics["frames_dropped"]
+        }
+    for name, values in (("transfer_ms", transfer), ("dispatch_ms", dispatch)):
+        result[name] = {
+            "samples": len(values),
+            "p50": percentile(values, 50),
+            "p99": percentile(values, 99),
+            "max": max(values) if values else None
         }
-        if time.time() - arduino_raw_state.get("last_update", 0) > 20 :
-            status_to_send["arduino_state"]["stage_name"] = "Disconnected"
-            status_to_send["arduino_state"]["raw_data"] = "Connection to Arduino potentially lost (stale data)."
-    return jsonify(status_to_send)
-
-@app.route('/set_mode/<mode_name>', methods=['POST'])
-def set_mode_api(mode_name):
-    global current_mode_is_simulation
-    with data_lock: 
-        if mode_name == "simulation": current_mode_is_simulation = True
-        elif mode_name == "real": current_mode_is_simulation = False
-        else: return jsonify({"status": "error", "message": "Invalid mode."}), 400
-    send_to_arduino_command(f"SET_MODE:{1 if current_mode_is_simulation else 0}")
-    if pc_active_medication_name: 
-        sync_pc_active_med_to_arduino(pc_active_medication_name)
+    return jsonify(result)
+
+@app.after_request
+def publish_status_after_write(response):
+    # State-changing requests publish immediately instead of waiting for the next DATA line
+    device = g.get('device')
+    if request.method != 'GET' and device is not None:
+        publish_status_change(device)
+    return response
+
+@device_route('/set_mode/<mode_name>', methods=['POST'])
+def set_mode_api(device, mode_name):
+    if mode_name not in ("simulation", "real"):
+        return jsonify({"status": "error", "message": "Invalid mode."}), 400
+    with device.state.edit_inventory():
+        device.state.current_mode_is_simulation = mode_name == "simulation"
+        send_to_arduino_command(device, f"SET_MODE:{1 if device.state.current_mode_is_simulation else 0}")
+        if device.state.pc_active_medication_name:
+            sync_pc_active_med_to_arduino(device, device.state.pc_active_medication_name)
     msg = f"Switched to {mode_name.capitalize()} Mode."
     logger.info(msg)
-    return jsonify({"status": "success", "message": msg, "is_simulation": current_mode_is_simulation})
+    return jsonify({"status": "success", "message": msg, "is_simulation": mode_name == "simulation"})
 
-@app.route('/set_stage/<int:stage_id>', methods=['POST'])
-def set_stage_api(stage_id):
-    if send_to_arduino_command(f"SET_STAGE:{stage_id}"):
+@device_route('/set_stage/<int:stage_id>', methods=['POST'])
+def set_stage_api(device, stage_id):
+    if send_to_arduino_command(device, f"SET_STAGE:{stage_id}"):
         if stage_id == 2: # RESET_STAGE
-            global pc_active_medication_name, medication_session_active, medication_session_data
-            with data_lock:
+            with device.state.edit_session(), device.state.edit_inventory():
                 # Clear current active medication
-                pc_active_medication_name = None
-                
+                device.state.pc_active_medication_name = None
+
                 # Clear all medication information (if complete reset is needed)
-                pc_managed_medication_details.clear()
-                
-                # Clear local history
-                try:
-                    cursor.execute('DELETE FROM history')
-                    conn.commit()
-                    logger.info('Local medication history cleared')
-                except Exception as e:
-                    logger.error(f'Failed to clear local history: {e}')
-                
+                device.state.pc_managed_medication_details.clear()
+
+                # Clear this device's local history
+                db.write('DELETE FROM history WHERE device_id = ?', (device.device_id,))
+                db.write('DELETE FROM removal_events WHERE device_id = ?', (device.device_id,))
+                logger.info('Local medication history clear queued')
+
                 # Reset sequential medication session state
-                medication_session_active = False
-                medication_session_data = {
-                    "start_weight": 0.0,
-                    "current_medication": None,
-                    "compartment_unlocked": False,
-                    "session_start_time": None
-                }
-                
+                device.state.reset_session()
+                device.state.compartment_sessions.clear()
+
                 # Reset Arduino state
-                send_to_arduino_command("RESET_ALL")
+                send_to_arduino_command(device, "RESET_ALL")
                 
             logger.info("System completely reset: cleared all medication information and session states")
         return jsonify({"status": "success", "message": f"Stage switch command sent (Stage ID: {stage_id}).", "stage_id": stage_id})
     return jsonify({"status": "error", "message": "Stage switch command failed to send."}), 500
 
-@app.route('/add_or_update_known_medication', methods=['POST'])
-def add_or_update_known_medication_api():
-    global pc_managed_medication_details
+@device_route('/add_or_update_known_medication', methods=['POST'])
+def add_or_update_known_medication_api(device):
     data = request.json
-    med_name = data.get('name','').strip() 
+    med_name = data.get('name','').strip()  
     try:
         wpp = float(data.get('wpp', 0.0)) 
         if not med_name: 
@@ -330,88 +2082,125 @@ def add_or_update_known_medication_api():
              return jsonify({"status": "error", "message": "WPP cannot be negative."}), 400
         if wpp == 0.0 and data.get('wpp') is not None : 
             logger.info(f"WPP for '{med_name}' explicitly set to 0.0. It should be defined later via measurement or manual input.")
-        with data_lock:
-            if med_name not in pc_managed_medication_details: 
-                pc_managed_medication_details[med_name] = {'wpp': wpp, 'total_weight_in_box': 0.0, 'count_in_box': 0}
+        # Optional: fraction of a pill below which leftover weight counts as empty
+        tolerance = float(data['tolerance']) if data.get('tolerance') is not None else None
+        if tolerance is not None and not 0 < tolerance <= 1:
+            return jsonify({"status": "error", "message": "Tolerance must be between 0 and 1."}), 400
+        # Optional: compartment scale index the medication sits on (null or -1 unassigns)
+        compartment = None
+        if 'compartment' in data:
+            compartment = -1 if data['compartment'] is None else int(data['compartment'])
+            if not -1 <= compartment < PILLBOX_COMPARTMENTS:
+                return jsonify({"status": "error", "message": f"Compartment must be between 0 and {PILLBOX_COMPARTMENTS - 1}."}), 400
+        with device.state.edit_inventory():
+            table = device.state.pc_managed_medication_details
+            occupant = table.compartments().get(compartment) if compartment is not None else None
+            if occupant and occupant != med_name:
+                return jsonify({"status": "error", "message": f"Compartment {compartment} is already assigned to '{occupant}'."}), 409
+            if med_name not in table:
+                table.add(med_name, wpp=wpp, tolerance=DEFAULT_PILL_TOLERANCE if tolerance is None else tolerance,
+                          compartment=-1 if compartment is None else compartment)
                 msg = f"Added new medication: '{med_name}' (Initial WPP: {wpp:.3f}g)."
-            else: 
-                pc_managed_medication_details[med_name]['wpp'] = wpp
-                recalculate_pill_count_for_med(med_name) 
+            else:
+                table[med_name]['wpp'] = wpp
+                if tolerance is not None:
+                    table[med_name]['tolerance'] = tolerance
+                if compartment is not None:
+                    table[med_name]['compartment'] = compartment
+                recalculate_pill_count_for_med(device, med_name)
                 msg = f"Updated WPP for '{med_name}' to {wpp:.3f}g. PC pill count recalculated."
-                if med_name == pc_active_medication_name: 
-                    send_to_arduino_command(f"SET_PILL_WEIGHT:{wpp:.4f}")
+                if med_name == device.state.pc_active_medication_name:  
+                    send_to_arduino_command(device, f"SET_PILL_WEIGHT:{wpp:.4f}")
+        if compartment is not None and compartment >= 0:
+            push_simulated_compartment_weights(device, [med_name])
         logger.info(msg)
         return jsonify({"status": "success", "message": msg})
     except (TypeError, ValueError):
         return jsonify({"status": "error", "message": "Invalid WPP value (must be a number)."}), 400
 
-@app.route('/set_pc_active_medication', methods=['POST'])
-def set_pc_active_medication_api():
-    global pc_active_medication_name
+@device_route('/api/inventory', methods=['GET'])
+def inventory_api(device):
+    """The device's medication inventory column-wise (one list per field), straight from the table arrays."""
+    snap = device.state.snapshot()
+    return jsonify({
+        "device_id": device.device_id,
+        "pc_active_medication_name": snap.pc_active_medication_name,
+        "columns": snap.pc_managed_medication_details.to_columns()
+    })
+
+@device_route('/set_pc_active_medication', methods=['POST'])
+def set_pc_active_medication_api(device):
     data = request.json
     med_name = data.get('name')
-    with data_lock:
-        if med_name and med_name in pc_managed_medication_details:
-            pc_active_medication_name = med_name
-            sync_pc_active_med_to_arduino(med_name) 
+    with device.state.edit_inventory():
+        if med_name and med_name in device.state.pc_managed_medication_details:
+            device.state.pc_active_medication_name = med_name
+            sync_pc_active_med_to_arduino(device, med_name) 
             msg = f"PC active medication set to: '{med_name}'. Synced with Arduino."
             logger.info(msg)
             return jsonify({"status": "success", "message": msg, "pc_active_medication_name": med_name})
-        elif not med_name: 
-            pc_active_medication_name = None
+        elif not med_name:
+            device.state.pc_active_medication_name = None
             logger.info("PC active medication cleared.")
             return jsonify({"status": "success", "message": "PC active medication cleared."})
         return jsonify({"status": "error", "message": f"Medication '{med_name}' not found in PC's known list."}), 404
 
-@app.route('/set_simulated_total_weight_for_active_med', methods=['POST'])
-def set_simulated_total_weight_api():
-    if not current_mode_is_simulation:
+@device_route('/set_simulated_total_weight_for_active_med', methods=['POST'])
+def set_simulated_total_weight_api(device):
+    snap = device.state.snapshot()
+    if not snap.current_mode_is_simulation:
         return jsonify({"status": "error", "message": "Operation only allowed in Simulation Mode."}), 403
-    if not pc_active_medication_name:
+    if not snap.pc_active_medication_name:
         return jsonify({"status": "error", "message": "No PC active medication selected."}), 400
     try:
         weight = float(request.json.get('weight'))
         if weight < 0: return jsonify({"status": "error", "message": "Weight cannot be negative."}), 400
-        with data_lock:
-            if pc_active_medication_name in pc_managed_medication_details:
-                pc_managed_medication_details[pc_active_medication_name]['total_weight_in_box'] = weight
-                recalculate_pill_count_for_med(pc_active_medication_name) 
-                send_to_arduino_command(f"SET_WEIGHT:{weight:.2f}") 
-                details = pc_managed_medication_details[pc_active_medication_name]
-                msg = f"Sim total weight for '{pc_active_medication_name}' set to {weight:.2f}g. PC count: {details['count_in_box']}."
+        with device.state.edit_inventory():
+            med_name = device.state.pc_active_medication_name
+            if med_name in device.state.pc_managed_medication_details:
+                device.state.pc_managed_medication_details[med_name]['total_weight_in_box'] = weight
+                recalculate_pill_count_for_med(device, med_name)
+                compartment = device.state.pc_managed_medication_details[med_name]['compartment']
+                if 0 <= compartment < PILLBOX_COMPARTMENTS:
+                    send_to_arduino_command(device, f"SET_COMPARTMENT_WEIGHT:{compartment}:{weight:.2f}")
+                else:
+                    send_to_arduino_command(device, f"SET_WEIGHT:{weight:.2f}")
+                details = device.state.pc_managed_medication_details[med_name]
+                msg = f"Sim total weight for '{med_name}' set to {weight:.2f}g. PC count: {details['count_in_box']}."
                 logger.info(msg)
                 return jsonify({"status": "success", "message": msg})
             return jsonify({"status": "error", "message": "Active medication not found in details (internal error)."}), 500
     except (TypeError, ValueError):
         return jsonify({"status": "error", "message": "Invalid weight value."}), 400
 
-@app.route('/tare_arduino_sim_only', methods=['POST'])
-def tare_arduino_sim_only_api():
-    if not current_mode_is_simulation:
+@device_route('/tare_arduino_sim_only', methods=['POST'])
+def tare_arduino_sim_only_api(device):
+    if not device.state.snapshot().current_mode_is_simulation:
         logger.warning("TARE_ARDUINO_SIM_ONLY called in non-simulation mode. Sending TARE_SIM anyway.")
-    if send_to_arduino_command("TARE_SIM"): 
+    if send_to_arduino_command(device, "TARE_SIM"): 
         msg = "Arduino TARE_SIM command sent. Arduino's weight zeroed for next input."
         logger.info(msg)
         return jsonify({"status": "success", "message": msg})
     return jsonify({"status": "error", "message": "Failed to send TARE_SIM to Arduino."}), 500
 
-@app.route('/update_state_from_manual_count_for_active_med', methods=['POST'])
-def update_state_from_manual_count_api():
-    if not pc_active_medication_name:
+@device_route('/update_state_from_manual_count_for_active_med', methods=['POST'])
+def update_state_from_manual_count_api(device):
+    if not device.state.snapshot().pc_active_medication_name:
         return jsonify({"status": "error", "message": "No PC active medication selected."}), 400
     try:
         count = int(request.json.get('count'))
         if count < 0: return jsonify({"status": "error", "message": "Pill count cannot be negative."}), 400
-        with data_lock:
-            if pc_active_medication_name in pc_managed_medication_details:
-                details = pc_managed_medication_details[pc_active_medication_name]
+        with device.state.edit_inventory():
+            med_name = device.state.pc_active_medication_name
+            if med_name in device.state.pc_managed_medication_details:
+                details = device.state.pc_managed_medication_details[med_name]
                 wpp = details['wpp']
-                if wpp <= 0.0001: 
-                    return jsonify({"status": "error", "message": f"WPP for '{pc_active_medication_name}' is not valid (must be > 0.0001). Cannot calculate total weight."}), 400
+                if wpp <= 0.0001:
+                    return jsonify({"status": "error", "message": f"WPP for '{med_name}' is not valid (must be > 0.0001). Cannot calculate total weight."}), 400
                 details['count_in_box'] = count
-                details['total_weight_in_box'] = count * wpp 
-                sync_pc_active_med_to_arduino(pc_active_medication_name) 
-                msg = (f"For '{pc_active_medication_name}', count set to {count}. "
+                details['total_weight_in_box'] = count * wpp
+                sync_pc_active_med_to_arduino(device, med_name)
+                msg = (f"For '{med_name}', count set to {count}. "
                        f"Calculated total weight: {details['total_weight_in_box']:.2f}g. Synced with Arduino.")
                 logger.info(msg)
                 return jsonify({"status": "success", "message": msg})
@@ -419,83 +2208,121 @@ def update_state_from_manual_count_api():
     except (TypeError, ValueError):
         return jsonify({"status": "error", "message": "Invalid count value."}), 400
 
-@app.route('/set_wpp_for_active_med_pc_and_arduino', methods=['POST'])
-def set_wpp_for_active_med_pc_and_arduino_api():
-    if not pc_active_medication_name:
+@device_route('/set_wpp_for_active_med_pc_and_arduino', methods=['POST'])
+def set_wpp_for_active_med_pc_and_arduino_api(device):
+    if not device.state.snapshot().pc_active_medication_name:
         return jsonify({"status": "error", "message": "No PC active medication selected."}), 400
     try:
         wpp = float(request.json.get('wpp'))
         if wpp <= 0.0001: return jsonify({"status": "error", "message": "WPP must be positive and realistic (e.g. > 0.0001)."}), 400
-        with data_lock:
-            if pc_active_medication_name in pc_managed_medication_details:
-                pc_managed_medication_details[pc_active_medication_name]['wpp'] = wpp
-                recalculate_pill_count_for_med(pc_active_medication_name) 
-                send_to_arduino_command(f"SET_PILL_WEIGHT:{wpp:.4f}") 
-                details = pc_managed_medication_details[pc_active_medication_name]
-                msg = f"WPP for '{pc_active_medication_name}' updated to {wpp:.3f}g. PC count: {details['count_in_box']}. Arduino notified."
+        with device.state.edit_inventory():
+            med_name = device.state.pc_active_medication_name
+            if med_name in device.state.pc_managed_medication_details:
+                device.state.pc_managed_medication_details[med_name]['wpp'] = wpp
+                recalculate_pill_count_for_med(device, med_name)
+                send_to_arduino_command(device, f"SET_PILL_WEIGHT:{wpp:.4f}")
+                details = device.state.pc_managed_medication_details[med_name]
+                msg = f"WPP for '{med_name}' updated to {wpp:.3f}g. PC count: {details['count_in_box']}. Arduino notified."
                 logger.info(msg)
                 return jsonify({"status": "success", "message": msg})
             return jsonify({"status": "error", "message": "Active medication not found (internal error)."}), 500
     except (TypeError, ValueError):
         return jsonify({"status": "error", "message": "Invalid WPP value."}), 400
 
-@app.route('/measure_single_pill_real_mode_for_active_med', methods=['POST'])
-def measure_single_pill_real_api():
-    """Trigger Arduino to perform single pill weight measurement, and let frontend poll status to update WPP value"""
-    global pc_active_medication_name
+@device_route('/measure_single_pill_real_mode_for_active_med', methods=['POST'])
+def measure_single_pill_real_api(device):
+    """Start a single pill weight measurement job for the active medication. Returns the job id at
+    once; follow it with GET /api/measurements/<job_id>?wait=N or "measurement" stream events."""
+    snap = device.state.snapshot()
     # Ensure medication is selected
-    if not pc_active_medication_name:
+    if not snap.pc_active_medication_name:
         return jsonify({"status": "error", "message": "Please select a medication to measure first."}), 400
     # Check mode
-    if current_mode_is_simulation:
+    if snap.current_mode_is_simulation:
         return jsonify({"status": "error", "message": "Currently in simulation mode, please switch to real mode before measuring."}), 400
-    # Send measurement command to Arduino
-    if not send_to_arduino_command("MEASURE_SINGLE_PILL_WEIGHT"):
+    if not is_serial_connected(device):
         return jsonify({"status": "error", "message": "Unable to send measurement command to Arduino"}), 500
-    # Command sent, frontend will poll status to detect and update WPP
-    return jsonify({"status": "success", "message": "Measurement command sent, please wait for results."}), 200
+    try:
+        rounds = int((request.get_json(silent=True) or {}).get('rounds', 1))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "Invalid rounds value (must be an integer)."}), 400
+    if not 1 <= rounds <= MEASUREMENT_MAX_ROUNDS:
+        return jsonify({"status": "error", "message": f"Rounds must be between 1 and {MEASUREMENT_MAX_ROUNDS}."}), 400
+    with device.measurement_lock:
+        running = device.measurement_job
+        if running and running.status == "running":
+            return jsonify({"status": "error", "message": "A measurement is already in progress.", "job_id": running.job_id}), 409
+        job = MeasurementJob(device, snap.pc_active_medication_name, rounds)
+        device.measurement_job = job
+        device.measurement_jobs[job.job_id] = job
+        while len(device.measurement_jobs) > MEASUREMENT_JOBS_KEPT:
+            del device.measurement_jobs[next(iter(device.measurement_jobs))]
+    threading.Thread(target=job.run, daemon=True).start()
+    return jsonify({"status": "success", "message": "Measurement started, please wait for results.",
+                    "job_id": job.job_id, "job": job.to_dict()}), 202
+
+@device_route('/api/measurements/<job_id>', methods=['GET'])
+def measurement_job_api(device, job_id):
+    """Measurement job status. With `wait` (seconds), long-polls until the job finishes or the wait ends."""
+    job = device.measurement_jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Unknown measurement job: {job_id}"}), 404
+    wait = request.args.get('wait', 0, type=float)
+    if wait > 0:
+        job.wait(min(wait, MEASUREMENT_LONG_POLL_MAX))
+    return jsonify(job.to_dict())
+
+@device_route('/api/measurements/<job_id>/cancel', methods=['POST'])
+def cancel_measurement_job_api(device, job_id):
+    """Cancel a running measurement job; the medication keeps its previous WPP."""
+    job = device.measurement_jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Unknown measurement job: {job_id}"}), 404
+    if not job.cancel():
+        return jsonify({"status": "error", "message": f"Measurement job already {job.status}.", "job": job.to_dict()}), 409
+    return jsonify({"status": "success", "message": "Measurement cancelled.", "job": job.to_dict()})
 
-@app.route('/consume_pills_for_active_med', methods=['POST'])
-def consume_pills_pc_api():
-    if not pc_active_medication_name:
+@device_route('/consume_pills_for_active_med', methods=['POST'])
+def consume_pills_pc_api(device):
+    if not device.state.snapshot().pc_active_medication_name:
         return jsonify({"status": "error", "message": "No PC active medication selected to consume from."}), 400
     try:
         num_to_consume = int(request.json.get('count'))
         if num_to_consume <= 0: return jsonify({"status": "error", "message": "Number of pills must be positive."}), 400
-        with data_lock:
-            if pc_active_medication_name in pc_managed_medication_details:
-                details = pc_managed_medication_details[pc_active_medication_name]
+        with device.state.edit_inventory():
+            med_name = device.state.pc_active_medication_name
+            if med_name in device.state.pc_managed_medication_details:
+                details = device.state.pc_managed_medication_details[med_name]
                 wpp = details['wpp']
                 if wpp <= 0.0001: 
-                    return jsonify({"status": "error", "message": f"WPP for '{pc_active_medication_name}' is not valid. Cannot consume."}), 400
+                    return jsonify({"status": "error", "message": f"WPP for '{med_name}' is not valid. Cannot consume."}), 400
                 weight_to_reduce = num_to_consume * wpp
                 current_total_weight = details['total_weight_in_box']
                 if current_total_weight >= weight_to_reduce - (wpp / 2.0):
                     details['total_weight_in_box'] = max(0.0, current_total_weight - weight_to_reduce) 
-                    recalculate_pill_count_for_med(pc_active_medication_name) 
-                    sync_pc_active_med_to_arduino(pc_active_medication_name)
-                    time.sleep(0.1) 
-                    if send_to_arduino_command(f"CONSUME_PILLS:{num_to_consume}"): 
-                        msg = (f"{num_to_consume} pills of '{pc_active_medication_name}' consumed (PC records updated). "
+                    recalculate_pill_count_for_med(device, med_name) 
+                    if sync_pc_active_med_to_arduino(device, med_name, [f"CONSUME_PILLS:{num_to_consume}"]): 
+                        msg = (f"{num_to_consume} pills of '{med_name}' consumed (PC records updated). "
                                f"New PC total weight: {details['total_weight_in_box']:.2f}g, PC count: {details['count_in_box']}.")
                         logger.info(msg)
-                        return jsonify({"status": "success", "message": msg, "consumed_med": pc_active_medication_name, "consumed_count": num_to_consume}) # Return consumed info
+                        return jsonify({"status": "success", "message": msg, "consumed_med": med_name, "consumed_count": num_to_consume}) # Return consumed info
                     else: 
                         details['total_weight_in_box'] = current_total_weight 
-                        recalculate_pill_count_for_med(pc_active_medication_name)
+                        recalculate_pill_count_for_med(device, med_name)
                         return jsonify({"status": "error", "message": "Failed to send CONSUME_PILLS command to Arduino. PC state change reverted."}), 500
                 else:
-                    return jsonify({"status": "error", "message": f"Not enough '{pc_active_medication_name}' on PC records (by weight) to consume {num_to_consume}."}), 400
+                    return jsonify({"status": "error", "message": f"Not enough '{med_name}' on PC records (by weight) to consume {num_to_consume}."}), 400
             return jsonify({"status": "error", "message": "Active medication details not found on PC (internal error)."}), 500
     except (TypeError, ValueError) as e:
         logger.error(f"Error in consume_pills_pc_api: {e}")
         return jsonify({"status": "error", "message": "Invalid input for number of pills."}), 400
 
-@app.route('/consume_pills_by_weight_simulated', methods=['POST'])
-def consume_pills_by_weight_simulated_api():
-    if not current_mode_is_simulation:
+@device_route('/consume_pills_by_weight_simulated', methods=['POST'])
+def consume_pills_by_weight_simulated_api(device):
+    snap = device.state.snapshot()
+    if not snap.current_mode_is_simulation:
         return jsonify({"status": "error", "message": "Consume by weight is a simulation-only feature."}), 403
-    if not pc_active_medication_name:
+    if not snap.pc_active_medication_name:
         return jsonify({"status": "error", "message": "No PC active medication selected."}), 400
     
     try:
@@ -506,12 +2333,13 @@ def consume_pills_by_weight_simulated_api():
         if weight_to_reduce <= 0:
             return jsonify({"status": "error", "message": "Weight to reduce must be positive."}), 400
 
-        with data_lock:
-            if pc_active_medication_name in pc_managed_medication_details:
-                details = pc_managed_medication_details[pc_active_medication_name]
+        with device.state.edit_inventory():
+            med_name = device.state.pc_active_medication_name
+            if med_name in device.state.pc_managed_medication_details:
+                details = device.state.pc_managed_medication_details[med_name]
                 wpp = details['wpp']
                 if wpp <= 0.0001:
-                    return jsonify({"status": "error", "message": f"WPP for '{pc_active_medication_name}' is not valid ({wpp:.4f}g). Cannot calculate pills to consume."}), 400
+                    return jsonify({"status": "error", "message": f"WPP for '{med_name}' is not valid ({wpp:.4f}g). Cannot calculate pills to consume."}), 400
 
                 if weight_to_reduce < (wpp / 2.0):
                     num_to_consume = 0
@@ -526,239 +2354,359 @@ def consume_pills_by_weight_simulated_api():
 
                 if current_total_weight >= actual_weight_to_reduce - (wpp / 2.0): 
                     details['total_weight_in_box'] = max(0.0, current_total_weight - actual_weight_to_reduce)
-                    recalculate_pill_count_for_med(pc_active_medication_name)
+                    recalculate_pill_count_for_med(device, med_name)
                     
-                    sync_pc_active_med_to_arduino(pc_active_medication_name)
-                    time.sleep(0.1)
-
-                    if send_to_arduino_command(f"CONSUME_PILLS:{num_to_consume}"):
-                        msg = (f"Consumed approx. {num_to_consume} pills of '{pc_active_medication_name}' (by reducing {weight_to_reduce:.2f}g). "
+                    if sync_pc_active_med_to_arduino(device, med_name, [f"CONSUME_PILLS:{num_to_consume}"]):
+                        msg = (f"Consumed approx. {num_to_consume} pills of '{med_name}' (by reducing {weight_to_reduce:.2f}g). "
                                f"PC total weight: {details['total_weight_in_box']:.2f}g, PC count: {details['count_in_box']}.")
                         logger.info(msg)
-                        return jsonify({"status": "success", "message": msg, "consumed_med": pc_active_medication_name, "consumed_count": num_to_consume, "weight_reduced_approx": actual_weight_to_reduce })
+                        return jsonify({"status": "success", "message": msg, "consumed_med": med_name, "consumed_count": num_to_consume, "weight_reduced_approx": actual_weight_to_reduce })
                     else:
                         details['total_weight_in_box'] = current_total_weight
-                        recalculate_pill_count_for_med(pc_active_medication_name)
+                        recalculate_pill_count_for_med(device, med_name)
                         return jsonify({"status": "error", "message": "Failed to send CONSUME_PILLS command to Arduino after weight calculation. PC state reverted."}), 500
                 else:
-                    return jsonify({"status": "error", "message": f"Not enough '{pc_active_medication_name}' (calculated {num_to_consume} pills) to consume by reducing {weight_to_reduce:.2f}g."}), 400
+                    return jsonify({"status": "error", "message": f"Not enough '{med_name}' (calculated {num_to_consume} pills) to consume by reducing {weight_to_reduce:.2f}g."}), 400
             return jsonify({"status": "error", "message": "Active medication details not found on PC."}), 500
     except (TypeError, ValueError) as e:
         logger.error(f"Error in consume_pills_by_weight_simulated_api: {e}")
         return jsonify({"status": "error", "message": "Invalid input for weight to reduce."}), 400
 
 # --- Sequential Medication Session API ---
-@app.route('/start_medication_session', methods=['POST'])
-def start_medication_session_api():
-    global medication_session_active, medication_session_data
-    
+def record_consumption(device, med_name, pills_consumed, weight_consumed, session_duration):
+    """Queue a finished session for cloud sync and the local history table."""
+    # Queue for the cloud sync worker (durable outbox, batched and retried in the background)
+    cloud_sync.enqueue({
+        "device_id": device.device_id,
+        "medication_name": med_name,
+        "pills_consumed": pills_consumed,
+        "weight_consumed": weight_consumed,
+        "session_duration": session_duration,
+        "timestamp": time.time()
+    })
+
+    # Save local history record
+    # Queued for the database writer (group-committed); no disk I/O under the state locks
+    db.write(
+        'INSERT INTO history (medication_name, pills_consumed, weight_consumed, session_duration, timestamp, device_id) VALUES (?, ?, ?, ?, ?, ?)',
+        (med_name, pills_consumed, weight_consumed, session_duration, int(time.time()), device.device_id)
+    )
+    logger.info('Medication consumption record queued for local history database')
+    reminder_scheduler.medication_taken(device)
+
+def compartment_session_name(device):
+    """Medication of the compartment session a session request addresses: the body's medication_name,
+    or the only running compartment session while the box-wide session is idle. None: box-wide session."""
+    data = request.get_json(silent=True) or {}
+    snap = device.state.snapshot()
+    name = data.get('medication_name')
+    if name:
+        return name if name in snap.compartment_sessions else None
+    if not snap.medication_session_active and len(snap.compartment_sessions) == 1:
+        return next(iter(snap.compartment_sessions))
+    return None
+
+def start_compartment_session(device, medication_name, compartment):
+    """Start a session for a compartment-assigned medication: no Arduino re-selection or BOX_TARE,
+    consumption is the drop of that compartment's own settled weight."""
+    if medication_name in device.state.snapshot().compartment_sessions:
+        return jsonify({"status": "error", "message": f"There is already an active session for '{medication_name}', please finish it first"}), 400
+    # Settle outside the session lock so sessions of other compartments are not held up
+    _, start_weight = wait_for_compartment_plateau(device, compartment)
+    if start_weight is None:
+        start_weight = device.state.snapshot().arduino_raw_state["compartment_weights"][compartment]
+    with device.state.edit_session():
+        if medication_name in device.state.compartment_sessions:
+            return jsonify({"status": "error", "message": f"There is already an active session for '{medication_name}', please finish it first"}), 400
+        device.state.compartment_sessions[medication_name] = {
+            "start_weight": start_weight,
+            "current_medication": medication_name,
+            "compartment": compartment,
+            "compartment_unlocked": False,
+            "session_start_time": time.time()
+        }
+        session_data = dict(device.state.compartment_sessions[medication_name])
+    logger.info(f"Started '{medication_name}' session on compartment {compartment}, initial weight: {start_weight:.2f}g")
+    return jsonify({
+        "status": "success",
+        "message": f"Started '{medication_name}' medication session",
+        "session_data": session_data
+    })
+
+def unlock_compartment_session(device, medication_name):
+    with device.state.edit_session():
+        session = device.state.compartment_sessions.get(medication_name)
+        if session is None:
+            return jsonify({"status": "error", "message": f"No active session for '{medication_name}'"}), 400
+        if not device.state.snapshot().current_mode_is_simulation:
+            if not send_to_arduino_command(device, f"UNLOCK_COMPARTMENT:{session['compartment'] + 1}"):
+                return jsonify({"status": "error", "message": "Unable to send unlock command to Arduino"}), 500
+        session["compartment_unlocked"] = True
+        session_data = dict(session)
+    logger.info(f"Compartment {session_data['compartment']} unlocked, ready to take '{medication_name}'")
+    return jsonify({
+        "status": "success",
+        "message": f"Medication compartment unlocked for '{medication_name}'",
+        "session_data": session_data
+    })
+
+def finish_compartment_session(device, medication_name):
+    session = device.state.snapshot().compartment_sessions.get(medication_name)
+    if session is None:
+        return jsonify({"status": "error", "message": f"No active session for '{medication_name}'"}), 400
+    if not session["compartment_unlocked"]:
+        return jsonify({"status": "error", "message": "Medication compartment not unlocked, please unlock compartment first"}), 400
+    compartment = session["compartment"]
+    if not device.state.snapshot().current_mode_is_simulation:
+        if not send_to_arduino_command(device, f"LOCK_COMPARTMENT:{compartment + 1}"):
+            return jsonify({"status": "error", "message": "Unable to send lock command to Arduino"}), 500
+
+    weight_settled, end_weight = wait_for_compartment_plateau(device, compartment)
+    if not weight_settled:
+        logger.warning(f"[{device.device_id}] Compartment {compartment} did not settle within {WEIGHT_SETTLE_TIMEOUT}s, using latest filtered value")
+    if end_weight is None:
+        end_weight = session["start_weight"]
+
+    with device.state.edit_session():
+        if device.state.compartment_sessions.pop(medication_name, None) is None:
+            return jsonify({"status": "error", "message": f"No active session for '{medication_name}'"}), 400
+        with device.state.edit_inventory():
+            table = device.state.pc_managed_medication_details
+            weight_consumed = max(0.0, session["start_weight"] - end_weight)
+            wpp = table[medication_name]['wpp'] if medication_name in table else 0.0
+            pills_consumed = int(round(weight_consumed / wpp)) if wpp > 0.0001 else 0
+            if medication_name in table:
+                table[medication_name]['total_weight_in_box'] = max(0.0, end_weight)
+                table.recalculate([medication_name])
+
+    session_duration = time.time() - session["session_start_time"]
+    logger.info(f"Completed compartment {compartment} session for '{medication_name}': consumed {pills_consumed} pills, weight reduced: {weight_consumed:.2f}g, duration: {session_duration:.1f}s")
+    completed_session = dict(session)
+    completed_session.update({
+        "end_weight": end_weight,
+        "weight_settled": weight_settled,
+        "weight_consumed": weight_consumed,
+        "pills_consumed": pills_consumed,
+        "session_duration": session_duration
+    })
+    record_consumption(device, medication_name, pills_consumed, weight_consumed, session_duration)
+    return jsonify({
+        "status": "success",
+        "message": f"Completed consumption record: {medication_name} {pills_consumed} pills",
+        "completed_session": completed_session,
+        "consumed_med": medication_name,
+        "consumed_count": pills_consumed,
+        "weight_reduced_approx": weight_consumed
+    })
+
+def cancel_compartment_session(device, medication_name):
+    with device.state.edit_session():
+        session = device.state.compartment_sessions.pop(medication_name, None)
+        if session is None:
+            return jsonify({"status": "error", "message": f"No active session for '{medication_name}'"}), 400
+        if session["compartment_unlocked"] and not device.state.snapshot().current_mode_is_simulation:
+            send_to_arduino_command(device, f"LOCK_COMPARTMENT:{session['compartment'] + 1}")
+    logger.info(f"Cancelled medication session: '{medication_name}' (compartment {session['compartment']})")
+    return jsonify({
+        "status": "success",
+        "message": f"Cancelled medication session: {medication_name}",
+        "cancelled_session": session
+    })
+
+@device_route('/start_medication_session', methods=['POST'])
+def start_medication_session_api(device):
     data = request.json
     medication_name = data.get('medication_name')
-    
+
     if not medication_name:
         return jsonify({"status": "error", "message": "Must specify the medication name to be taken"}), 400
-    
-    if medication_name not in pc_managed_medication_details:
-        return jsonify({"status": "error", "message": f"Medication not found: {medication_name}"}), 404
-    
-    with data_lock:
-        if medication_session_active:
+
+    # Medications on their own compartment scale get an independent session
+    snap = device.state.snapshot()
+    details = snap.pc_managed_medication_details.get(medication_name)
+    if details and 0 <= details['compartment'] < len(snap.arduino_raw_state["compartment_weights"]):
+        return start_compartment_session(device, medication_name, details['compartment'])
+
+    with device.state.edit_session():
+        if device.state.medication_session_active:
             return jsonify({"status": "error", "message": "There is already an active medication session in progress, please finish the current session first"}), 400
-        
-        # Set PC current active medication
-        global pc_active_medication_name
-        pc_active_medication_name = medication_name
-        
-        # Sync to Arduino
-        sync_pc_active_med_to_arduino(medication_name)
-        
-        # New: Send BOX_TARE command, let Arduino record box baseline weight
-        send_to_arduino_command('BOX_TARE')
-        
+
+        with device.state.edit_inventory():
+            if medication_name not in device.state.pc_managed_medication_details:
+                return jsonify({"status": "error", "message": f"Medication not found: {medication_name}"}), 404
+
+            # Set PC current active medication
+            device.state.pc_active_medication_name = medication_name
+
+            # Sync to Arduino, then BOX_TARE so the Arduino records the box baseline weight (one batch)
+            sync_pc_active_med_to_arduino(device, medication_name, ['BOX_TARE'])
+
         # Record initial weight, set to 0 after peeling
-        medication_session_data = {
+        device.state.medication_session_data = {
             "start_weight": 0.0,
             "current_medication": medication_name,
             "compartment_unlocked": False,
             "session_start_time": time.time()
         }
-        
-        medication_session_active = True
-        
-        logger.info(f"Started '{medication_name}' medication session, initial weight: {medication_session_data['start_weight']:.2f}g")
-        
-        return jsonify({
-            "status": "success", 
-            "message": f"Started '{medication_name}' medication session",
-            "session_data": medication_session_data
-        })
 
-@app.route('/unlock_medication_compartment', methods=['POST'])
-def unlock_medication_compartment_api():
-    global medication_session_data
-    
-    if not medication_session_active:
-        return jsonify({"status": "error", "message": "No active medication session in progress, please start a session first"}), 400
-    
-    with data_lock:
+        device.state.medication_session_active = True
+        session_data = dict(device.state.medication_session_data)
+
+    logger.info(f"Started '{medication_name}' medication session, initial weight: {session_data['start_weight']:.2f}g")
+
+    return jsonify({
+        "status": "success",
+        "message": f"Started '{medication_name}' medication session",
+        "session_data": session_data
+    })
+
+@device_route('/unlock_medication_compartment', methods=['POST'])
+def unlock_medication_compartment_api(device):
+    compartment_med = compartment_session_name(device)
+    if compartment_med:
+        return unlock_compartment_session(device, compartment_med)
+    with device.state.edit_session():
+        if not device.state.medication_session_active:
+            return jsonify({"status": "error", "message": "No active medication session in progress, please start a session first"}), 400
+
         # In real mode, send unlock command to Arduino
-        if not current_mode_is_simulation:
-            if not send_to_arduino_command("UNLOCK_COMPARTMENT:1"):
+        if not device.state.snapshot().current_mode_is_simulation:
+            if not send_to_arduino_command(device, "UNLOCK_COMPARTMENT:1"):
                 return jsonify({"status": "error", "message": "Unable to send unlock command to Arduino"}), 500
-        
-        medication_session_data["compartment_unlocked"] = True
-        logger.info(f"Medication compartment unlocked, ready to take '{medication_session_data['current_medication']}'")
-        
-        return jsonify({
-            "status": "success", 
-            "message": f"Medication compartment unlocked for '{medication_session_data['current_medication']}'",
-            "session_data": medication_session_data
-        })
 
-@app.route('/lock_and_record_consumption', methods=['POST'])
-def lock_and_record_consumption_api():
-    global medication_session_active, medication_session_data, pc_managed_medication_details
-    
-    if not medication_session_active:
-        return jsonify({"status": "error", "message": "No active medication session in progress, please start a session first"}), 400
-    
-    if not medication_session_data["compartment_unlocked"]:
-        return jsonify({"status": "error", "message": "Medication compartment not unlocked, please unlock compartment first"}), 400
-    
-    with data_lock:
-        # In real mode, send lock command to Arduino
-        if not current_mode_is_simulation:
-            if not send_to_arduino_command("LOCK_COMPARTMENT:1"):
-                return jsonify({"status": "error", "message": "Unable to send lock command to Arduino"}), 500
-        
-        # Calculate consumed weight and pill count (directly use the absolute value of the current adjusted weight)
-        med_name = medication_session_data["current_medication"]
-        current_weight = arduino_raw_state["total_weight_in_box_arduino"]
-        weight_consumed = abs(current_weight)
-        
-        # Calculate consumed pill count based on WPP
-        med_details = pc_managed_medication_details[med_name]
-        wpp = med_details["wpp"]
-        pills_consumed = int(round(weight_consumed / wpp)) if wpp > 0.0001 else 0
-        
-        # Update medication inventory
-        if pills_consumed > 0:
-            med_details["count_in_box"] = max(0, med_details["count_in_box"] - pills_consumed)
-            med_details["total_weight_in_box"] = max(0, med_details["total_weight_in_box"] - (pills_consumed * wpp))
-            
-            # Sync to Arduino
-            if current_mode_is_simulation:
-                send_to_arduino_command(f"SET_WEIGHT:{med_details['total_weight_in_box']:.2f}")
-        
-        # Reset session
-        medication_session_active = False
-        session_duration = time.time() - medication_session_data["session_start_time"]
-        
-        logger.info(f"Completed medication session for '{med_name}': consumed {pills_consumed} pills, weight reduced: {weight_consumed:.2f}g, duration: {session_duration:.1f}s")
-        
-        # Save session data for return
-        completed_session = medication_session_data.copy()
-        completed_session.update({
-            "end_weight": current_weight,
-            "weight_consumed": weight_consumed,
-            "pills_consumed": pills_consumed,
-            "session_duration": session_duration
-        })
-        
-        # New: Asynchronously sync to cloud server, avoid blocking main thread
-        cloud_payload = {
-            "medication_name": med_name,
-            "pills_consumed": pills_consumed,
-            "weight_consumed": weight_consumed,
-            "session_duration": session_duration,
-            "timestamp": time.time()
-        }
-        def _sync_to_cloud(payload):
-            try:
-                # Skip default placeholder address
-                if CLOUD_SERVER_URL and "your-cloud-server.com" not in CLOUD_SERVER_URL:
-                    requests.post(CLOUD_SERVER_URL, json=payload, timeout=2)
-                    logger.info("Medication consumption record asynchronously synced to cloud server")
-                else:
-                    logger.info("Skipped default cloud sync address, please configure valid CLOUD_SERVER_URL")
-            except Exception as e:
-                logger.error(f"Asynchronous sync to cloud server failed: {e}")
-        threading.Thread(target=_sync_to_cloud, args=(cloud_payload,), daemon=True).start()
+        device.state.medication_session_data["compartment_unlocked"] = True
+        session_data = dict(device.state.medication_session_data)
+    logger.info(f"Medication compartment unlocked, ready to take '{session_data['current_medication']}'")
 
-        # Save local history record
-        try:
-            cursor.execute(
-                'INSERT INTO history (medication_name, pills_consumed, weight_consumed, session_duration, timestamp) VALUES (?, ?, ?, ?, ?)',
-                (med_name, pills_consumed, weight_consumed, session_duration, int(time.time()))
-            )
-            conn.commit()
-            logger.info('Medication consumption record saved to local history database')
-        except Exception as e:
-            logger.error(f"Failed to save local history: {e}")
-        
-        # Reset session data
-        medication_session_data = {
-            "start_weight": 0.0,
-            "current_medication": None,
-            "compartment_unlocked": False,
-            "session_start_time": None
-        }
-        
-        return jsonify({
-            "status": "success", 
-            "message": f"Completed consumption record: {med_name} {pills_consumed} pills",
-            "completed_session": completed_session,
-            "consumed_med": med_name,
-            "consumed_count": pills_consumed,
-            "weight_reduced_approx": weight_consumed
-        })
+    return jsonify({
+        "status": "success",
+        "message": f"Medication compartment unlocked for '{session_data['current_medication']}'",
+        "session_data": session_data
+    })
+
+@device_route('/lock_and_record_consumption', methods=['POST'])
+def lock_and_record_consumption_api(device):
+    compartment_med = compartment_session_name(device)
+    if compartment_med:
+        return finish_compartment_session(device, compartment_med)
+    with device.state.edit_session():
+        if not device.state.medication_session_active:
+            return jsonify({"status": "error", "message": "No active medication session in progress, please start a session first"}), 400
+
+        if not device.state.medication_session_data["compartment_unlocked"]:
+            return jsonify({"status": "error", "message": "Medication compartment not unlocked, please unlock compartment first"}), 400
+        session_start_time = device.state.medication_session_data["session_start_time"]
+
+    # In real mode, send lock command to Arduino
+    if not device.state.snapshot().current_mode_is_simulation:
+        if not send_to_arduino_command(device, "LOCK_COMPARTMENT:1"):
+            return jsonify({"status": "error", "message": "Unable to send lock command to Arduino"}), 500
+
+    # Count from the settled plateau of the filtered weight rather than one raw sample; waited
+    # for outside the session lock so other session endpoints are not held up meanwhile
+    weight_settled, current_weight = device.weight_filter.wait_for_plateau(WEIGHT_SETTLE_TIMEOUT)
+    if not weight_settled:
+        logger.warning(f"[{device.device_id}] Weight did not settle within {WEIGHT_SETTLE_TIMEOUT}s, using latest filtered value")
+    if current_weight is None:
+        current_weight = device.state.snapshot().arduino_raw_state["total_weight_in_box_arduino"]
+
+    with device.state.edit_session():
+        # The session may have been cancelled, recorded or restarted while waiting
+        if not device.state.medication_session_active or \
+                device.state.medication_session_data["session_start_time"] != session_start_time:
+            return jsonify({"status": "error", "message": "Medication session ended while waiting for the weight to settle"}), 409
+
+        with device.state.edit_inventory():
+            # Calculate consumed weight and pill count (absolute value of the adjusted weight after BOX_TARE)
+            med_name = device.state.medication_session_data["current_medication"]
+            weight_consumed = abs(current_weight)
+
+            # Calculate consumed pill count based on WPP
+            med_details = device.state.pc_managed_medication_details[med_name]
+            wpp = med_details["wpp"]
+            pills_consumed = int(round(weight_consumed / wpp)) if wpp > 0.0001 else 0
+
+            # Update medication inventory
+            if pills_consumed > 0:
+                med_details["count_in_box"] = max(0, med_details["count_in_box"] - pills_consumed)
+                med_details["total_weight_in_box"] = max(0, med_details["total_weight_in_box"] - (pills_consumed * wpp))
+
+                # Sync to Arduino
+                if device.state.current_mode_is_simulation:
+                    send_to_arduino_command(device, f"SET_WEIGHT:{med_details['total_weight_in_box']:.2f}")
+
+        # Save session data for return, then reset session
+        completed_session = dict(device.state.medication_session_data)
+        device.state.reset_session()
+
+    session_duration = time.time() - completed_session["session_start_time"]
+
+    logger.info(f"Completed medication session for '{med_name}': consumed {pills_consumed} pills, weight reduced: {weight_consumed:.2f}g, duration: {session_duration:.1f}s")
+
+    completed_session.update({
+        "end_weight": current_weight,
+        "weight_settled": weight_settled,
+        "weight_consumed": weight_consumed,
+        "pills_consumed": pills_consumed,
+        "session_duration": session_duration
+    })
+
+    record_consumption(device, med_name, pills_consumed, weight_consumed, session_duration)
+
+    return jsonify({
+        "status": "success",
+        "message": f"Completed consumption record: {med_name} {pills_consumed} pills",
+        "completed_session": completed_session,
+        "consumed_med": med_name,
+        "consumed_count": pills_consumed,
+        "weight_reduced_approx": weight_consumed
+    })
+
+@device_route('/cancel_medication_session', methods=['POST'])
+def cancel_medication_session_api(device):
+    compartment_med = compartment_session_name(device)
+    if compartment_med:
+        return cancel_compartment_session(device, compartment_med)
+    with device.state.edit_session():
+        if not device.state.medication_session_active:
+            return jsonify({"status": "error", "message": "No active medication session to cancel"}), 400
 
-@app.route('/cancel_medication_session', methods=['POST'])
-def cancel_medication_session_api():
-    global medication_session_active, medication_session_data
-    
-    if not medication_session_active:
-        return jsonify({"status": "error", "message": "No active medication session to cancel"}), 400
-    
-    with data_lock:
         # If compartment is unlocked, send lock command to Arduino
-        if medication_session_data["compartment_unlocked"] and not current_mode_is_simulation:
-            send_to_arduino_command("LOCK_COMPARTMENT:1")
-        
-        # Save session data for return
-        cancelled_session = medication_session_data.copy()
-        
-        # Reset session
-        medication_session_active = False
-        medication_session_data = {
-            "start_weight": 0.0,
-            "current_medication": None,
-            "compartment_unlocked": False,
-            "session_start_time": None
-        }
-        
-        logger.info(f"Cancelled medication session: '{cancelled_session['current_medication']}'")
-        
-        return jsonify({
-            "status": "success", 
-            "message": f"Cancelled medication session: {cancelled_session['current_medication']}",
-            "cancelled_session": cancelled_session
-        })
+        if device.state.medication_session_data["compartment_unlocked"] and not device.state.snapshot().current_mode_is_simulation:
+            send_to_arduino_command(device, "LOCK_COMPARTMENT:1")
 
-@app.route('/get_medication_session_status', methods=['GET'])
-def get_medication_session_status_api():
-    with data_lock:
-        return jsonify({
-            "session_active": medication_session_active,
-            "session_data": medication_session_data
-        })
+        # Save session data for return, then reset session
+        cancelled_session = dict(device.state.medication_session_data)
+        device.state.reset_session()
+
+    logger.info(f"Cancelled medication session: '{cancelled_session['current_medication']}'")
+
+    return jsonify({
+        "status": "success",
+        "message": f"Cancelled medication session: {cancelled_session['current_medication']}",
+        "cancelled_session": cancelled_session
+    })
+
+@device_route('/get_medication_session_status', methods=['GET'])
+def get_medication_session_status_api(device):
+    snap = device.state.snapshot()
+    return jsonify({
+        "session_active": snap.medication_session_active,
+        "session_data": snap.medication_session_data,
+        "compartment_sessions": snap.compartment_sessions
+    })
+
+@device_route('/api/compartments', methods=['GET'])
+def compartments_api(device):
+    """Live weight, assigned medication and pill count of every compartment scale."""
+    return jsonify({"device_id": device.device_id, "compartments": compartment_status(device.state.snapshot())})
 
-@app.route('/get_current_weight', methods=['GET'])
-def get_current_weight():
+@device_route('/get_current_weight', methods=['GET'])
+def get_current_weight(device):
     """Return current weight from cached state."""
-    with data_lock:
-        weight = arduino_raw_state.get('total_weight_in_box_arduino', 0.0)
-        last_update = arduino_raw_state.get('last_update', time.time())
+    raw = device.state.snapshot().arduino_raw_state
+    weight = raw['total_weight_in_box_arduino']
+    last_update = raw['last_update']
     age = time.time() - last_update
     return jsonify({
         'status': 'success',
@@ -767,85 +2715,68 @@ def get_current_weight():
         'age': age
     })
 
-@app.route('/force_refresh_weight', methods=['POST'])
-def force_refresh_weight():
+@device_route('/force_refresh_weight', methods=['POST'])
+def force_refresh_weight(device):
     """Force get latest weight data, for drug inventory setup step"""
     try:
         # Parse JSON safely
         data = request.get_json(silent=True) or {}
+        is_simulation = device.state.snapshot().current_mode_is_simulation
         # If real mode and port not connected, try reconnect
-        if not current_mode_is_simulation and (ser is None or not ser.is_open):
+        if not is_simulation and not is_serial_connected(device):
             logger.warning("force_refresh_weight: Serial port not connected, attempting to reconnect Arduino")
-            if not connect_to_arduino():
+            if not connect_to_arduino(device):
                 return jsonify({'status': 'error', 'message': 'Arduino reconnection failed'}), 500
-        if not current_mode_is_simulation and ser and ser.is_open:
-            # Clear buffer
-            ser.reset_input_buffer()
-            
-            # First execute peeling operation
+        if not is_simulation:
+            # First execute peeling operation, waiting for the Arduino's confirmation
             if data.get('tare_first', False):
                 logger.info("Force refresh before executing peeling operation")
-                ser.write(b"TARE_SIM\n")
-                time.sleep(0.5)  # Wait for peeling to complete
+                if device.serial_mux.request("TARE_SIM", ("Real mode tare complete", "Simulated tare complete"), timeout=2.0) is None:
+                    logger.warning("Force refresh: tare confirmation not received, reading weight anyway")
             
-            # Multiple attempts to get valid weight
+            # Multiple attempts to get valid weight; each is a single GET_WEIGHT round-trip
             max_attempts = 3
             for attempt in range(max_attempts):
-                # Send GET_WEIGHT command
-                ser.write(b"GET_WEIGHT\n")
-                
-                # Wait for response
-                response_timeout = 2.0  # Longer timeout time
-                start_time = time.time()
+                line = device.serial_mux.request("GET_WEIGHT", "WEIGHT:", timeout=2.0)
+                if line is None:
+                    logger.warning(f"Force refresh weight attempt {attempt+1}/{max_attempts} timed out")
+                    continue
+                logger.debug(f"Force refresh received response: {line}")
+                try:
+                    weight_value = float(line.split(':')[1].strip())
+                except (ValueError, IndexError) as e:
+                    logger.warning(f"Failed to parse weight response: {line}, error: {e}")
+                    continue
                 
-                while time.time() - start_time < response_timeout:
-                    if ser.in_waiting > 0:
-                        line = ser.readline().decode('utf-8', errors='replace').strip()
-                        logger.debug(f"Force refresh received response: {line}")
-                        
-                        if line.startswith("WEIGHT:"):
-                            try:
-                                weight_value = float(line.split(':')[1].strip())
-                                
-                                # Confirm weight is valid value
-                                if weight_value >= 0:
-                                    with data_lock:
-                                        arduino_raw_state["total_weight_in_box_arduino"] = weight_value
-                                        arduino_raw_state["last_update"] = time.time()
-                                    
-                                    # If active medication, update inventory calculation
-                                    if pc_active_medication_name and pc_active_medication_name in pc_managed_medication_details:
-                                        med_details = pc_managed_medication_details[pc_active_medication_name]
-                                        if med_details['wpp'] > 0.001:
-                                            med_details['total_weight_in_box'] = weight_value
-                                            recalculate_pill_count_for_med(pc_active_medication_name)
-                                            logger.info(f"Updated '{pc_active_medication_name}' inventory: {med_details['count_in_box']} pills (TotalW {weight_value:.3f}g)")
-                                    
-                                    return jsonify({
-                                        'status': 'success',
-                                        'weight': weight_value,
-                                        'message': f"Successfully got real-time weight: {weight_value:.3f}g",
-                                        'attempt': attempt + 1
-                                    })
-                            except (ValueError, IndexError) as e:
-                                logger.warning(f"Failed to parse weight response: {line}, error: {e}")
+                # Confirm weight is valid value (the listener already stored it in the telemetry state)
+                if weight_value >= 0:
+                    # If active medication, update inventory calculation
+                    with device.state.edit_inventory():
+                        med_name = device.state.pc_active_medication_name
+                        if med_name in device.state.pc_managed_medication_details:
+                            med_details = device.state.pc_managed_medication_details[med_name]
+                            if med_details['wpp'] > 0.001:
+                                med_details['total_weight_in_box'] = weight_value
+                                recalculate_pill_count_for_med(device, med_name)
+                                logger.info(f"Updated '{med_name}' inventory: {med_details['count_in_box']} pills (TotalW {weight_value:.3f}g)")
                     
-                    time.sleep(0.05)
-                
-                logger.warning(f"Force refresh weight attempt {attempt+1}/{max_attempts} timed out")
-                time.sleep(0.2)  # Brief delay before retrying
+                    return jsonify({
+                        'status': 'success',
+                        'weight': weight_value,
+                        'message': f"Successfully got real-time weight: {weight_value:.3f}g",
+                        'attempt': attempt + 1
+                    })
             
             # All attempts failed
             return jsonify({
                 'status': 'error',
-                'message': f"Failed to get valid weight data, please check sensor connection",
+                'message': "Failed to get valid weight data, please check sensor connection",
                 'weight': 0.0
             }), 500
         else:
             # Simulation mode, directly return current simulated weight
-            with data_lock:
-                weight = arduino_raw_state.get('total_weight_in_box_arduino', 0.0)
-            
+            weight = device.state.snapshot().arduino_raw_state['total_weight_in_box_arduino']
+                        
             return jsonify({
                 'status': 'success',
                 'weight': weight,
@@ -867,27 +2798,239 @@ def medication_setup_page():
     """Return medication setup page (if not exist, create a fake page)"""
     return render_template('inventory_setup.html')  # Temporary use same page
 
+HISTORY_MAX_PAGE_SIZE = 1000
+
+def get_table_version(table):
+    row = db.query_one('SELECT version, reset_version FROM table_versions WHERE table_name = ?', (table,))
+    return row if row else (0, 0)
+
+def versioned_json(table, build_payload, variant=None):
+    """Serve `build_payload()` as JSON tagged with the table's change version. A matching
+    If-None-Match gets an empty 304 without running the query; browsers revalidate automatically.
+    `variant` goes into the ETag for payloads that also depend on something other than the table."""
+    version, reset_version = get_table_version(table)
+    etag = f"{table}-{version}" if variant is None else f"{table}-{version}-{variant}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Table-Version'] = str(version)
+    response.headers['X-Table-Reset-Version'] = str(reset_version)
+    return response
+
+def parse_history_filters(args):
+    """Translate `device`, `medication`, `from` and `to` query args into SQL conditions for the history table."""
+    conditions, params = [], []
+    if args.get('device'):
+        conditions.append('device_id = ?')
+        params.append(args['device'])
+    if args.get('medication'):
+        conditions.append('medication_name = ?')
+        params.append(args['medication'])
+    if args.get('from') is not None:
+        conditions.append('timestamp >= ?')
+        params.append(int(float(args['from'])))
+    if args.get('to') is not None:
+        conditions.append('timestamp < ?')
+        params.append(int(float(args['to'])))
+    return conditions, params
+
 @app.route('/api/history', methods=['GET'])
 def api_history():
+    """History rows, newest first. Optional filters: device, medication, from, to (unix seconds),
+    since_id (only rows added after that id). With `limit`, pages are fetched by keyset: pass
+    the X-Next-Before / X-Next-Before-Id response headers back as `before` / `before_id`."""
     try:
-        # Use a fresh cursor/connection to avoid recursive use
-        rows = conn.execute(
-            'SELECT medication_name, pills_consumed, weight_consumed, session_duration, timestamp '
-            'FROM history ORDER BY timestamp DESC'
-        ).fetchall()
-        history_list = [{
-            'medication_name': r[0],
-            'pills_consumed': r[1],
-            'weight_consumed': r[2],
-            'session_duration': r[3],
-            'timestamp': r[4]
-        } for r in rows]
-        return jsonify(history_list)
+        conditions, params = parse_history_filters(request.args)
+        since_id = request.args.get('since_id', type=int)
+        if since_id is not None:
+            conditions.append('id > ?')
+            params.append(since_id)
+        limit = request.args.get('limit', type=int)
+        before = request.args.get('before', type=int)
+        before_id = request.args.get('before_id', type=int)
+        if before is not None:
+            if before_id is not None:
+                conditions.append('(timestamp < ? OR (timestamp = ? AND id < ?))')
+                params.extend([before, before, before_id])
+            else:
+                conditions.append('timestamp < ?')
+                params.append(before)
+        sql = 'SELECT id, medication_name, pills_consumed, weight_consumed, session_duration, timestamp, device_id FROM history'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY timestamp DESC, id DESC'
+        if limit is not None:
+            limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+            sql += ' LIMIT ?'
+            params.append(limit)
+        rows = []
+        def build_history_list():
+            rows.extend(db.query(sql, params))
+            return [{
+                'id': r[0],
+                'medication_name': r[1],
+                'pills_consumed': r[2],
+                'weight_consumed': r[3],
+                'session_duration': r[4],
+                'timestamp': r[5],
+                'device_id': r[6]
+            } for r in rows]
+        response = versioned_json('history', build_history_list)
+        if limit is not None and len(rows) == limit:
+            response.headers['X-Next-Before'] = str(rows[-1][5])
+            response.headers['X-Next-Before-Id'] = str(rows[-1][0])
+        return response
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid history filter value'}), 400
     except Exception as e:
         logger.error(f"Error querying history: {e}")
         # Return empty list on error
         return jsonify([])
 
+@app.route('/api/history/daily', methods=['GET'])
+def api_history_daily():
+    """Pills and sessions per local calendar day and medication, optionally filtered like /api/history."""
+    try:
+        conditions, params = parse_history_filters(request.args)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid history filter value'}), 400
+    sql = ("SELECT date(timestamp, 'unixepoch', 'localtime') AS day, medication_name, "
+           "SUM(pills_consumed), COUNT(*), SUM(weight_consumed) FROM history")
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' GROUP BY day, medication_name ORDER BY day DESC, medication_name'
+    return versioned_json('history', lambda: [{
+        'day': r[0],
+        'medication_name': r[1],
+        'pills_consumed': r[2],
+        'sessions': r[3],
+        'weight_consumed': r[4]
+    } for r in db.query(sql, params)])
+
+@app.route('/api/history/summary', methods=['GET'])
+def api_history_summary():
+    """Per-medication totals over the last `days` local calendar days (default 30, today included),
+    optionally filtered by `device` and `medication`. `active_day_ratio` is the share of those days
+    with at least one recorded session; see /api/adherence for adherence against reminders."""
+    days = request.args.get('days', 30, type=int)
+    if days is None or days <= 0:
+        return jsonify({'status': 'error', 'message': 'days must be a positive integer'}), 400
+    since = int(datetime.combine(datetime.now().date() - timedelta(days=days - 1), datetime.min.time()).timestamp())
+    conditions, params = parse_history_filters({'device': request.args.get('device'),
+                                                'medication': request.args.get('medication')})
+    sql = ("SELECT medication_name, COUNT(*), SUM(pills_consumed), SUM(weight_consumed), "
+           "COUNT(DISTINCT date(timestamp, 'unixepoch', 'localtime')), MAX(timestamp) "
+           "FROM history WHERE " + ' AND '.join(['timestamp >= ?'] + conditions) +
+           " GROUP BY medication_name ORDER BY medication_name")
+    # The window moves at midnight, so the ETag carries its start along with the table version
+    return versioned_json('history', lambda: {
+        'days': days,
+        'since': since,
+        'medications': [{
+            'medication_name': r[0],
+            'sessions': r[1],
+            'pills_consumed': r[2],
+            'weight_consumed': r[3],
+            'active_days': r[4],
+            'active_day_ratio': min(1.0, r[4] / days),
+            'last_taken': r[5]
+        } for r in db.query(sql, [since] + params)]
+    }, variant=since)
+
+@device_route('/api/weight_series', methods=['GET'])
+def api_weight_series(device):
+    """Weight trend between `from` and `to` (unix seconds). `resolution` is raw, 1s, 1m or 1h;
+    when omitted, the finest tier that fits in WEIGHT_SERIES_MAX_POINTS points is used."""
+    try:
+        end = float(request.args.get('to', time.time()))
+        start = float(request.args.get('from', end - 3600))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'from/to must be unix timestamps'}), 400
+    if start >= end:
+        return jsonify({'status': 'error', 'message': '`from` must be before `to`'}), 400
+    resolutions = {'raw': 0, '1s': 1, '1m': 60, '1h': 3600}
+    requested = request.args.get('resolution')
+    if requested is not None and requested not in resolutions:
+        return jsonify({'status': 'error', 'message': f"resolution must be one of {', '.join(resolutions)}"}), 400
+    if requested is None:
+        # Raw samples only if the ring still covers the whole range
+        oldest_raw = device.weight_series.oldest_timestamp()
+        raw_fits = oldest_raw is not None and oldest_raw <= start and \
+            (end - start) * device.weight_series.sample_rate() <= WEIGHT_SERIES_MAX_POINTS
+        resolution = 0 if raw_fits else next(
+            (r for r in (1, 60) if (end - start) / r <= WEIGHT_SERIES_MAX_POINTS), 3600)
+    else:
+        resolution = resolutions[requested]
+
+    if resolution == 0:
+        points = device.weight_series.window(start, end)
+    else:
+        # Rollups plus the ring's not yet flushed tail; retry if a flush commits in between
+        first_bucket = int(start // resolution) * resolution
+        for _ in range(3):
+            committed = device.weight_series.committed
+            rows = db.query(
+                'SELECT bucket, samples, weight_min, weight_max, weight_sum, weight_last, lid_open_samples '
+                'FROM weight_rollup WHERE device_id = ? AND resolution = ? AND bucket >= ? AND bucket < ? ORDER BY bucket',
+                (device.device_id, resolution, first_bucket, end)
+            )
+            tail_from, tail = device.weight_series.uncommitted()
+            if tail_from == committed:
+                break
+        buckets = {r[0]: list(r[1:]) for r in rows}
+        tail_buckets = rollup_samples((sample for sample in tail if first_bucket <= sample[0] < end), resolution)
+        for bucket, agg in tail_buckets.items():
+            stored = buckets.get(bucket)
+            if stored is None:
+                buckets[bucket] = agg
+            else:
+                buckets[bucket] = [stored[0] + agg[0], min(stored[1], agg[1]), max(stored[2], agg[2]),
+                                   stored[3] + agg[3], agg[4], stored[5] + agg[5]]
+        points = [{
+            't': bucket,
+            'samples': agg[0],
+            'min': agg[1],
+            'max': agg[2],
+            'avg': agg[3] / agg[0],
+            'last': agg[4],
+            'lid_open_ratio': agg[5] / agg[0]
+        } for bucket, agg in sorted(buckets.items())]
+    label = next(name for name, r in resolutions.items() if r == resolution)
+    return jsonify({'status': 'success', 'from': start, 'to': end, 'resolution': label, 'points': points})
+
+@device_route('/api/removal_events', methods=['GET'])
+def api_removal_events(device):
+    """The device's detected lid/pill removal events, newest first. Optional: since_id, limit (default 100)."""
+    since_id = request.args.get('since_id', type=int)
+    limit = max(1, min(request.args.get('limit', 100, type=int), HISTORY_MAX_PAGE_SIZE))
+    def build_events():
+        sql = ('SELECT id, event_type, timestamp, medication_name, pills, weight_delta, session_active '
+               'FROM removal_events WHERE device_id = ?')
+        params = [device.device_id]
+        if since_id is not None:
+            sql += ' AND id > ?'
+            params.append(since_id)
+        rows = db.query(sql + ' ORDER BY timestamp DESC, id DESC LIMIT ?', params + [limit])
+        return [{
+            'id': r[0],
+            'device_id': device.device_id,
+            'event_type': r[1],
+            'timestamp': r[2],
+            'medication_name': r[3],
+            'pills': r[4],
+            'weight_delta': r[5],
+            'session_active': bool(r[6])
+        } for r in rows]
+    return versioned_json('removal_events', build_events)
+
+@app.route('/api/cloud_sync_status', methods=['GET'])
+def cloud_sync_status_api():
+    """Outbox depth, age of the oldest unsent record and retry state of the cloud sync worker."""
+    return jsonify(cloud_sync.status())
+
 @app.route('/history')
 def history_page():
     return render_template('history.html')
@@ -899,15 +3042,20 @@ def remote_monitor_page():
 # Add messages related API
 @app.route('/api/messages', methods=['GET'])
 def get_messages():
-    cursor.execute('SELECT id, content, sender, timestamp FROM messages ORDER BY timestamp DESC LIMIT 50')
-    rows = cursor.fetchall()
-    messages = [{
-        'id': r[0],
-        'content': r[1],
-        'sender': r[2],
-        'timestamp': r[3]
-    } for r in rows]
-    return jsonify(messages)
+    since_id = request.args.get('since_id', type=int)
+    def build_messages():
+        if since_id is not None:
+            rows = db.query('SELECT id, content, sender, timestamp FROM messages WHERE id > ? '
+                            'ORDER BY timestamp DESC LIMIT 50', (since_id,))
+        else:
+            rows = db.query('SELECT id, content, sender, timestamp FROM messages ORDER BY timestamp DESC LIMIT 50')
+        return [{
+            'id': r[0],
+            'content': r[1],
+            'sender': r[2],
+            'timestamp': r[3]
+        } for r in rows]
+    return versioned_json('messages', build_messages)
 
 @app.route('/api/messages', methods=['POST'])
 def add_message():
@@ -924,16 +3072,15 @@ def add_message():
     timestamp = int(time.time())
     
     try:
-        cursor.execute(
+        message_id = db.write(
             'INSERT INTO messages (content, sender, timestamp) VALUES (?, ?, ?)',
             (content, sender, timestamp)
-        )
-        conn.commit()
+        ).result(timeout=10)
         
         return jsonify({
             'status': 'success',
             'message': 'Message added',
-            'id': cursor.lastrowid,
+            'id': message_id,
             'content': content,
             'sender': sender,
             'timestamp': timestamp
@@ -945,19 +3092,22 @@ def add_message():
 # --- Reminder related API ---
 @app.route('/api/reminders', methods=['GET'])
 def get_reminders():
-    cursor.execute('SELECT id, medication_name, start_datetime, end_datetime, frequency_type, frequency_value FROM reminders')
-    rows = cursor.fetchall()
-    reminders = []
-    for r in rows:
-        reminders.append({
-            'id': r[0],
-            'medication_name': r[1],
-            'start_datetime': r[2],
-            'end_datetime': r[3],
-            'frequency_type': r[4],
-            'frequency_value': r[5]
-        })
-    return jsonify(reminders)
+    since_id = request.args.get('since_id', type=int)
+    def build_reminders():
+        rows = db.query('SELECT id, medication_name, start_datetime, end_datetime, frequency_type, frequency_value '
+                        'FROM reminders WHERE id > ?', (since_id if since_id is not None else -1,))
+        reminders = []
+        for r in rows:
+            reminders.append({
+                'id': r[0],
+                'medication_name': r[1],
+                'start_datetime': r[2],
+                'end_datetime': r[3],
+                'frequency_type': r[4],
+                'frequency_value': r[5]
+            })
+        return reminders
+    return versioned_json('reminders', build_reminders)
 
 @app.route('/api/reminders', methods=['POST'])
 def add_reminder():
@@ -969,20 +3119,393 @@ def add_reminder():
     fval = data.get('frequency_value')
     if not name or sd is None or ed is None or ftype not in ('interval','daily') or not fval:
         return jsonify({'status':'error','message':'Invalid parameters'}), 400
-    cursor.execute('INSERT INTO reminders (medication_name,start_datetime,end_datetime,frequency_type,frequency_value) VALUES (?,?,?,?,?)',
-                   (name, int(sd), int(ed), ftype, float(fval)))
-    conn.commit()
-    return jsonify({'status':'success','id': cursor.lastrowid})
+    reminder_id = db.write('INSERT INTO reminders (medication_name,start_datetime,end_datetime,frequency_type,frequency_value) VALUES (?,?,?,?,?)',
+                           (name, int(sd), int(ed), ftype, float(fval))).result(timeout=10)
+    reminder_scheduler.wake()
+    return jsonify({'status':'success','id': reminder_id})
+
+# --- Reminder scheduling ---
+REMINDER_RELOAD_INTERVAL = 60         # Seconds between checks of the reminders table version
+REMINDER_FIRE_GRACE = 120             # Occurrences found later than this (server asleep/down) are skipped, not fired
+REMINDER_LCD_HOLD = 3600              # Seconds the Arduino shows "Time to take"/"Missed" after LCD:REMIND (30 + 30 min)
+REMINDER_UPCOMING_DEFAULT_WINDOW = 86400
+REMINDER_UPCOMING_MAX_WINDOW = 31 * 86400
+REMINDER_UPCOMING_MAX_LIMIT = 1000
+
+ReminderRule = namedtuple("ReminderRule", ["id", "medication_name", "start", "end", "frequency_type", "frequency_value"])
+
+def reminder_occurrences(rule, after):
+    """Occurrence times (epoch seconds, ascending) of one reminder rule strictly after `after`, computed
+    lazily. Same rules as calendar.html: 'interval' repeats every frequency_value hours from the start;
+    'daily' spreads frequency_value reminders over each day from hour 0, on every day from the start
+    day through the end (server local time). Occurrences outside [start, end] are dropped."""
+    if rule.frequency_value <= 0:
+        return
+    if rule.frequency_type == 'interval':
+        step = rule.frequency_value * 3600
+        k = max(0, int(math.floor((after - rule.start) / step)) + 1)
+        while rule.start + k * step <= after:
+            k += 1
+        while rule.start + k * step <= rule.end:
+            yield rule.start + k * step
+            k += 1
+    elif rule.frequency_type == 'daily':
+        per_day = int(math.ceil(rule.frequency_value))
+        hours = [int(math.floor(i * 24 / rule.frequency_value)) for i in range(per_day)]
+        start = datetime.fromtimestamp(rule.start)
+        day = max(start.date(), datetime.fromtimestamp(max(after, rule.start)).date())
+        while True:
+            day_start = datetime.combine(day, start.time())
+            if day_start.timestamp() > rule.end:
+                return
+            for hour in hours:
+                t = datetime.combine(day, datetime.min.time()).replace(hour=hour).timestamp()
+                if after < t and rule.start <= t <= rule.end:
+                    yield t
+            day += timedelta(days=1)
+
+class ReminderScheduler:
+    """Fires reminder rules on the server, with no browser open. Each rule contributes only its next
+    occurrence to a heap of (time, rule id, occurrence iterator); firing pops the earliest entry and
+    pushes that rule's following occurrence, so the heap stays one entry per rule. Rules are reloaded
+    when the reminders table version changes.
+
+    A firing sends LCD:REMIND and PLAY_REMINDER to the pillboxes whose inventory holds the medication
+    (the default pillbox if none does). Outside the Arduino's reminder/missed display window, each
+    pillbox's LCD shows the clock time of its next reminder via LCD:NEXT:HH:MM."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.rules = {}          # id -> ReminderRule
+        self.heap = []
+        self.version = None
+        self.cursor = time.time()  # Occurrences up to here have been fired or skipped
+        self.next_reload = 0.0
+        self.lcd_hold_until = {}   # device_id -> end of the Arduino's reminder display
+        self.lcd_shown = {}        # device_id -> LCD:NEXT text last sent
+        self.fired = 0
+
+    def wake(self):
+        with self.cond:
+            self.next_reload = 0.0
+            self.cond.notify()
+
+    def _reload(self, now):
+        version = get_table_version('reminders')
+        self.next_reload = now + REMINDER_RELOAD_INTERVAL
+        if version == self.version:
+            return
+        rows = db.query('SELECT id, medication_name, start_datetime, end_datetime, frequency_type, frequency_value FROM reminders')
+        self.rules = {r[0]: ReminderRule(*r) for r in rows}
+        self.version = version
+        self.heap = []
+        for rule in self.rules.values():
+            self._push(rule.id, reminder_occurrences(rule, self.cursor))
+        heapq.heapify(self.heap)
+        logger.info(f"Reminder scheduler loaded {len(self.rules)} rule(s), {len(self.heap)} with upcoming occurrences")
+
+    def _push(self, rule_id, occurrences):
+        at = next(occurrences, None)
+        if at is not None:
+            heapq.heappush(self.heap, (at, rule_id, occurrences))
+
+    def target_devices(self, medication_name):
+        targets = [device for device in devices.values()
+                   if medication_name in device.state.snapshot().pc_managed_medication_details]
+        return targets or [devices[DEFAULT_DEVICE_ID]]
+
+    def _fire(self, rule, at, now):
+        if now - at > REMINDER_FIRE_GRACE:
+            logger.warning(f"Skipping reminder for '{rule.medication_name}' due at {datetime.fromtimestamp(at):%Y-%m-%d %H:%M} ({now - at:.0f}s late)")
+            return
+        for device in self.target_devices(rule.medication_name):
+            logger.info(f"[{device.device_id}] Reminder: time to take '{rule.medication_name}'")
+            send_commands_to_arduino(device, ["LCD:REMIND", "PLAY_REMINDER"])
+            self.lcd_hold_until[device.device_id] = now + REMINDER_LCD_HOLD
+            self.lcd_shown.pop(device.device_id, None)
+            publish_device_event(device, "reminder", {"reminder_id": rule.id, "medication_name": rule.medication_name,
+                                                      "scheduled_at": at, "fired_at": now})
+        self.fired += 1
+
+    def medication_taken(self, device):
+        """A dose was recorded on `device`: end its reminder display so the next reminder time shows."""
+        with self.cond:
+            if self.lcd_hold_until.pop(device.device_id, None) is not None:
+                send_to_arduino_command(device, "LCD:TAKEN")
+            self.cond.notify()
+
+    def _update_lcds(self, now):
+        """Send LCD:NEXT to every pillbox whose next reminder time changed; returns when to check again."""
+        next_check = now + REMINDER_RELOAD_INTERVAL
+        idle = []
+        for device in devices.values():
+            hold = self.lcd_hold_until.get(device.device_id)
+            if hold is not None:
+                if hold > now:
+                    next_check = min(next_check, hold)
+                    continue
+                del self.lcd_hold_until[device.device_id]
+            idle.append(device)
+        next_at = {}  # device_id -> its earliest upcoming occurrence
+        for at, rule_id, _ in sorted(self.heap):
+            if len(next_at) == len(devices):
+                break
+            for device in self.target_devices(self.rules[rule_id].medication_name):
+                next_at.setdefault(device.device_id, at)
+        for device in idle:
+            upcoming = next_at.get(device.device_id)
+            text = f"{datetime.fromtimestamp(upcoming):%H:%M}" if upcoming is not None else None
+            if text and text != self.lcd_shown.get(device.device_id) and is_serial_connected(device):
+                send_to_arduino_command(device, f"LCD:NEXT:{text}")
+                self.lcd_shown[device.device_id] = text
+        return next_check
+
+    def run(self):
+        logger.info("Reminder scheduler thread started.")
+        while True:
+            try:
+                with self.cond:
+                    now = time.time()
+                    if now >= self.next_reload:
+                        self._reload(now)
+                    while self.heap and self.heap[0][0] <= now:
+                        at, rule_id, occurrences = heapq.heappop(self.heap)
+                        self._fire(self.rules[rule_id], at, now)
+                        self._push(rule_id, occurrences)
+                    self.cursor = now
+                    wake_at = min(self._update_lcds(now), self.next_reload)
+                    if self.heap:
+                        wake_at = min(wake_at, self.heap[0][0])
+                    self.cond.wait(max(0.0, wake_at - time.time()))
+            except Exception as e:
+                logger.error(f"Reminder scheduler error: {e}")
+                time.sleep(5)
+
+    def current_rules(self):
+        """{id: ReminderRule}, reloaded first if the reminders table changed."""
+        with self.cond:
+            if self.version != get_table_version('reminders'):
+                self._reload(time.time())
+            return dict(self.rules)
+
+    def upcoming(self, start, end, limit):
+        """Occurrences of every rule in (start, end], earliest first, at most `limit`. The per-rule
+        generators are merged lazily, so only the returned occurrences are expanded."""
+        rules = self.current_rules()
+        def tagged(rule):
+            return ((at, rule.id) for at in reminder_occurrences(rule, start))
+        merged = heapq.merge(*(tagged(rule) for rule in rules.values()))
+        result = []
+        for at, rule_id in merged:
+            if at > end or len(result) >= limit:
+                break
+            rule = rules[rule_id]
+            result.append({"reminder_id": rule_id, "medication_name": rule.medication_name, "time": at,
+                           "devices": [device.device_id for device in self.target_devices(rule.medication_name)]})
+        return result
+
+reminder_scheduler = ReminderScheduler()
+
+@app.route('/api/reminders/upcoming', methods=['GET'])
+def upcoming_reminders_api():
+    """Reminder occurrences due in the next `window` seconds (default one day), from the server-side schedule."""
+    window = request.args.get('window', REMINDER_UPCOMING_DEFAULT_WINDOW, type=int)
+    limit = request.args.get('limit', 100, type=int)
+    if not 0 < window <= REMINDER_UPCOMING_MAX_WINDOW:
+        return jsonify({"status": "error", "message": f"window must be between 1 and {REMINDER_UPCOMING_MAX_WINDOW} seconds"}), 400
+    limit = max(1, min(limit, REMINDER_UPCOMING_MAX_LIMIT))
+    now = time.time()
+    return jsonify({"now": now, "window": window, "upcoming": reminder_scheduler.upcoming(now, now + window, limit)})
+
+# --- Adherence analytics ---
+ADHERENCE_TOLERANCE = int(os.environ.get('ADHERENCE_TOLERANCE', 3600))  # Seconds a dose may be taken before/after its reminder
+ADHERENCE_DEFAULT_DAYS = 7
+ADHERENCE_MAX_DAYS = 366
+ADHERENCE_CACHE_MAX = 5000  # Cached (device, tolerance, day) results
+
+def match_doses(expected, doses, tolerance):
+    """Sorted merge of expected dose times against dose timestamps (both ascending). Each expected
+    time takes the earliest unused dose within +-tolerance; doses too early for it are skipped for
+    good, since every later expected time is later still. Returns ([(expected, taken_at or None)],
+    indexes of the matched doses)."""
+    matches, used = [], set()
+    j = 0
+    for at in expected:
+        while j < len(doses) and doses[j] < at - tolerance:
+            j += 1
+        if j < len(doses) and doses[j] <= at + tolerance:
+            matches.append((at, doses[j]))
+            used.add(j)
+            j += 1
+        else:
+            matches.append((at, None))
+    return matches, used
+
+def local_day_bounds(day):
+    start = datetime.combine(day, datetime.min.time())
+    return start.timestamp(), (start + timedelta(days=1)).timestamp()
+
+class AdherenceEngine:
+    """Per-day adherence: expected doses from the reminder rules (the scheduler's rule cache) matched
+    against history rows with pills taken. Days that are over (end + tolerance in the past) are cached;
+    new history rows evict the cached days from the earliest one they can match into onward, an
+    update/delete of history or any reminders change clears the cache (table_versions)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = {}              # (device_id or None, tolerance, date) -> {medication: day result}
+        self.history_version = None  # (version, reset_version)
+        self.reminders_version = None
+        self.last_history_id = 0
+
+    def _validate(self):
+        """Drop cache entries the tables changed under. Caller holds self.lock."""
+        reminders_version = get_table_version('reminders')
+        history_version = get_table_version('history')
+        if reminders_version != self.reminders_version or self.history_version is None or \
+                history_version[1] != self.history_version[1]:
+            self.cache.clear()
+            row = db.query_one('SELECT COALESCE(MAX(id), 0) FROM history')
+            self.last_history_id = row[0] if row else 0
+        elif history_version != self.history_version:
+            rows = db.query('SELECT id, timestamp FROM history WHERE id > ?', (self.last_history_id,))
+            if rows:
+                # Matching is one greedy pass over the span, so a new dose can move matches on every
+                # later day: evict each day from the earliest one the dose could match into onward
+                earliest = min(timestamp for _, timestamp in rows)
+                for key in [key for key in self.cache if local_day_bounds(key[2])[1] + key[1] > earliest]:
+                    del self.cache[key]
+                self.last_history_id = max(row[0] for row in rows)
+        self.reminders_version = reminders_version
+        self.history_version = history_version
+
+    def _compute_days(self, days, device_id, tolerance, now):
+        """{date: {medication: result}} for `days` (ascending). Matching runs once per medication over the
+        whole span, widened by a day on each side for context, so a dose near midnight is counted once:
+        matched doses go to their expected dose's day, unmatched ones count as extra on their own day."""
+        rules = reminder_scheduler.current_rules()
+        span_start = local_day_bounds(days[0] - timedelta(days=1))[0]
+        span_end = local_day_bounds(days[-1] + timedelta(days=1))[1]
+        sql = 'SELECT timestamp, medication_name FROM history WHERE timestamp >= ? AND timestamp < ? AND pills_consumed > 0'
+        params = [span_start - tolerance, span_end + tolerance]
+        if device_id:
+            sql += ' AND device_id = ?'
+            params.append(device_id)
+        doses_by_med = {}
+        for timestamp, name in db.query(sql + ' ORDER BY timestamp', params):
+            doses_by_med.setdefault(name, []).append(timestamp)
+        rules_by_med = {}
+        for rule in rules.values():
+            rules_by_med.setdefault(rule.medication_name, []).append(rule)
+
+        wanted = set(days)
+        results = {day: {} for day in days}
+        for name in set(rules_by_med) | set(doses_by_med):
+            expected = list(heapq.merge(*(
+                itertools.takewhile(lambda at: at < span_end, reminder_occurrences(rule, span_start - 1))
+                for rule in rules_by_med.get(name, ()))))
+            doses = doses_by_med.get(name, [])
+            matches, used = match_doses(expected, doses, tolerance)
+            matches_by_day, extra_by_day = {}, {}
+            for at, taken_at in matches:
+                day = datetime.fromtimestamp(at).date()
+                if day in wanted:
+                    matches_by_day.setdefault(day, []).append((at, taken_at))
+            for i, timestamp in enumerate(doses):
+                day = datetime.fromtimestamp(timestamp).date()
+                if i not in used and day in wanted:
+                    extra_by_day[day] = extra_by_day.get(day, 0) + 1
+            for day in set(matches_by_day) | set(extra_by_day):
+                day_matches = matches_by_day.get(day, [])
+                extra = extra_by_day.get(day, 0)
+                taken = sum(1 for _, taken_at in day_matches if taken_at is not None)
+                pending = sum(1 for at, taken_at in day_matches if taken_at is None and at + tolerance > now)
+                results[day][name] = {
+                    "expected": len(day_matches),
+                    "taken": taken,
+                    "missed": len(day_matches) - taken - pending,
+                    "pending": pending,
+                    "extra": extra,
+                    "doses": [{"expected_at": at, "taken_at": taken_at,
+                               "status": "taken" if taken_at is not None else "pending" if at + tolerance > now else "missed"}
+                              for at, taken_at in day_matches]
+                }
+        return results
+
+    def days(self, first_day, last_day, device_id=None, tolerance=ADHERENCE_TOLERANCE):
+        """[(date, {medication: result})] for every day in [first_day, last_day]."""
+        now = time.time()
+        wanted = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+        with self.lock:
+            self._validate()
+            found = {day: self.cache[(device_id, tolerance, day)] for day in wanted if (device_id, tolerance, day) in self.cache}
+        missing = [day for day in wanted if day not in found]
+        if missing:
+            computed = self._compute_days(missing, device_id, tolerance, now)
+            found.update(computed)
+            with self.lock:
+                if len(self.cache) + len(computed) > ADHERENCE_CACHE_MAX:
+                    self.cache.clear()
+                for day, result in computed.items():
+                    if local_day_bounds(day)[1] + tolerance <= now:  # Over: nothing can change but the tables
+                        self.cache[(device_id, tolerance, day)] = result
+        return [(day, found[day]) for day in wanted]
+
+adherence_engine = AdherenceEngine()
+
+@app.route('/api/adherence', methods=['GET'])
+def adherence_api():
+    """Adherence per medication and per day: reminders matched against recorded doses.
+    Optional: from / to (unix seconds, widened to whole local days; default the last 7 days),
+    device, medication, tolerance (seconds), details=1 for the individual doses."""
+    try:
+        now = time.time()
+        to_ts = float(request.args.get('to', now))
+        from_ts = float(request.args.get('from', to_ts - (ADHERENCE_DEFAULT_DAYS - 1) * 86400))
+        tolerance = int(request.args.get('tolerance', ADHERENCE_TOLERANCE))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid adherence parameter'}), 400
+    first_day = datetime.fromtimestamp(from_ts).date()
+    last_day = datetime.fromtimestamp(to_ts).date()
+    if last_day < first_day or (last_day - first_day).days >= ADHERENCE_MAX_DAYS:
+        return jsonify({'status': 'error', 'message': f'Range must cover 1 to {ADHERENCE_MAX_DAYS} days'}), 400
+    if not 0 <= tolerance <= 86400:
+        return jsonify({'status': 'error', 'message': 'tolerance must be between 0 and 86400 seconds'}), 400
+    device_id = request.args.get('device') or None
+    medication = request.args.get('medication')
+    details = request.args.get('details') in ('1', 'true')
+
+    summary, days = {}, []
+    for day, by_med in adherence_engine.days(first_day, last_day, device_id, tolerance):
+        entry = {}
+        for name, result in by_med.items():
+            if medication and name != medication:
+                continue
+            totals = summary.setdefault(name, {"expected": 0, "taken": 0, "missed": 0, "pending": 0, "extra": 0})
+            for field in totals:
+                totals[field] += result[field]
+            entry[name] = result if details else {k: v for k, v in result.items() if k != "doses"}
+        days.append({"date": day.isoformat(), "medications": entry})
+    for totals in summary.values():
+        due = totals["taken"] + totals["missed"]
+        totals["adherence"] = round(totals["taken"] / due, 4) if due else None
+    return jsonify({
+        "from": local_day_bounds(first_day)[0],
+        "to": local_day_bounds(last_day)[1],
+        "tolerance": tolerance,
+        "device": device_id,
+        "summary": summary,
+        "days": days
+    })
 
 # 新增 API: 删除所有历史、留言和提醒
 @app.route('/api/delete_all', methods=['POST'])
 def delete_all():
     try:
-        cursor.execute('DELETE FROM history')
-        cursor.execute('DELETE FROM messages')
-        cursor.execute('DELETE FROM reminders')
-        conn.commit()
-        return jsonify({'status':'success','message':'All history, messages, and reminders deleted.'})
+        db.write('DELETE FROM history')
+        db.write('DELETE FROM messages')
+        db.write('DELETE FROM removal_events')
+        db.write('DELETE FROM reminders').result(timeout=30)
+        reminder_scheduler.wake()
+        return jsonify({'status':'success','message':'All history, messages, reminders and removal events deleted.'})
     except Exception as e:
         logger.error(f"Failed to delete all data: {e}")
         return jsonify({'status':'error','message': str(e)}), 500
@@ -992,23 +3515,23 @@ def calendar_page():
     return render_template('calendar.html')
 
 # Route to play reminder music on Arduino
-@app.route('/play_reminder', methods=['POST'])
-def play_reminder():
-    send_to_arduino_command("PLAY_REMINDER")
+@device_route('/play_reminder', methods=['POST'])
+def play_reminder(device):
+    send_to_arduino_command(device, "PLAY_REMINDER")
     return jsonify({"status":"success","message":"Reminder music played."})
 
 # Route to display next medication time on LCD
-@app.route('/lcd_next', methods=['POST'])
-def lcd_next():
+@device_route('/lcd_next', methods=['POST'])
+def lcd_next(device):
     data = request.json or {}
     diff = data.get('diff', '00:00')
-    send_to_arduino_command(f"LCD:NEXT:{diff}")
+    send_to_arduino_command(device, f"LCD:NEXT:{diff}")
     return jsonify({"status":"success","message":f"Displayed next med time: {diff}."})
 
 # Route to reset LCD display to default PharmaPlan
-@app.route('/lcd_taken', methods=['POST'])
-def lcd_taken():
-    send_to_arduino_command("LCD:TAKEN")
+@device_route('/lcd_taken', methods=['POST'])
+def lcd_taken(device):
+    send_to_arduino_command(device, "LCD:TAKEN")
     return jsonify({"status":"success","message":"Display reset to default."})
 
 # --- app.py end ---
@@ -1028,11 +3551,12 @@ if __name__ == '__main__':
     except Exception as e:
         logger.error(f"Failed to create ngrok tunnel: {e}")
 
-    # 2. Start Arduino listener thread
-    if not connect_to_arduino(): 
-        logger.warning("Failed to connect to Arduino at startup, listener thread will retry continuously.")
-    threading.Thread(target=read_from_arduino_thread_function,
-                     daemon=True).start()
+    # 2. Start the serial listener and writer threads of every pillbox
+    for device in devices.values():
+        device.start()
+    threading.Thread(target=weight_series_flush_thread_function, daemon=True).start()
+    threading.Thread(target=cloud_sync.run, daemon=True).start()
+    threading.Thread(target=reminder_scheduler.run, daemon=True).start()
 
     # 3. Start Flask
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
@@ -0,0 +1,456 @@
+"""Pseudo-terminal emulator of the pillbox Arduino (project/project.ino) for load and latency testing.
+
+Each emulated box opens a pty and speaks the firmware's serial protocol: it echoes commands with
+"Arduino received:", applies SET_MODE / SELECT_MEDICATION / SET_PILL_WEIGHT / SET_WEIGHT / TARE_SIM /
+CONSUME_PILLS / BOX_TARE / GET_WEIGHT / MEASURE_SINGLE_PILL_WEIGHT / SET_DATA_FORMAT / SET_DATA_INTERVAL /
+SET_COMPARTMENTS / SET_COMPARTMENT_WEIGHT and streams DATA lines (or binary frames). Point the server at the printed device path:
+
+    python arduino_emulator.py --link /tmp/pillbox0
+    PILLBOX_DEVICES=default=/tmp/pillbox0 python app.py
+"""
+import argparse
+import binascii
+import logging
+import os
+import pty
+import random
+import select
+import signal
+import struct
+import threading
+import time
+import tty
+
+logger = logging.getLogger("arduino_emulator")
+
+STAGE_NAMES = ["Weighing", "Medication", "Resetting"]
+INPUT_BUFFER_SIZE = 64  # Arduino inputBuffer; longer commands are truncated to 63 characters
+# magic, seq, stage, flags, weight, pill count, wpp, lid distance, crc (matches DATA_FRAME in app.py)
+DATA_FRAME = struct.Struct('<2sHBBfhfhH')
+DATA_FRAME_MAGIC = b'\xaa\x55'
+COMPARTMENT_FRAME_MAGIC = b'\xaa\x56'  # DATA_FRAME without its CRC + count byte + count floats + CRC
+MAX_COMPARTMENTS = 3
+
+
+class EmulatedPillbox:
+    """Firmware state and command handling. `load_grams` is what physically sits on the scale; in
+    real mode readings are taken from it (plus noise), in simulation mode SET_WEIGHT drives them.
+    `compartment_loads` does the same for the per-compartment scales (SET_COMPARTMENT_WEIGHT)."""
+    def __init__(self, load_grams=0.0, noise=0.0, lid_distance=3, rng=None):
+        self.rng = rng or random.Random()
+        self.noise = noise
+        self.load_grams = load_grams
+        self.lid_distance = lid_distance
+        self.simulated_weight = 0.0
+        self.weight_per_pill = 0.25
+        self.pill_count = 0
+        self.is_simulation = True
+        self.selected_medication = "N/A"
+        self.stage = 0
+        self.box_tare_offset = 0.0
+        self.scale_zero = 0.0
+        self.binary_format = False
+        self.frame_seq = 0
+        self.send_interval = 0.2
+        self.lcd = ("PharmaPlan", "")
+        self.reminders_played = 0
+        self.compartment_count = 0
+        self.compartment_loads = [0.0] * MAX_COMPARTMENTS
+        self.compartment_weights = [0.0] * MAX_COMPARTMENTS
+
+    # --- Sensors ---
+    def read_weight(self):
+        """One HX711 reading (grams, relative to the last sensor tare)."""
+        return self.load_grams - self.scale_zero + self.rng.gauss(0.0, self.noise) if self.noise else \
+            self.load_grams - self.scale_zero
+
+    def current_weight(self):
+        if self.is_simulation:
+            return self.simulated_weight + (self.rng.gauss(0.0, self.noise) if self.noise else 0.0)
+        return self.read_weight()
+
+    def update(self):
+        """One pass of loop(): smooth the sensor in real mode and recount pills."""
+        if not self.is_simulation:
+            reading = self.read_weight()
+            if 0 <= reading < 1000:
+                self.simulated_weight = self.simulated_weight * 0.7 + reading * 0.3
+            for i in range(self.compartment_count):
+                reading = self.compartment_loads[i] + (self.rng.gauss(0.0, self.noise) if self.noise else 0.0)
+                if 0 <= reading < 1000:
+                    self.compartment_weights[i] = self.compartment_weights[i] * 0.7 + reading * 0.3
+        if self.weight_per_pill > 0.001:
+            self.pill_count = 0 if self.simulated_weight < self.weight_per_pill / 2.0 else \
+                int(round(self.simulated_weight / self.weight_per_pill))
+        else:
+            self.pill_count = 0
+
+    # --- Output ---
+    def data_line(self):
+        adjusted = self.current_weight() - self.box_tare_offset
+        compartments = ""
+        if self.compartment_count:
+            compartments = "," + ";".join(f"{w:.2f}" for w in self.compartment_weights[:self.compartment_count])
+        return (f"DATA:{STAGE_NAMES[self.stage]},{adjusted:.2f},{self.pill_count},{self.selected_medication},"
+                f"{self.weight_per_pill:.3f},{self.lid_distance},{1 if self.lid_distance > 5 else 0}"
+                f"{compartments}\r\n").encode()
+
+    def data_frame(self):
+        body = DATA_FRAME.pack(DATA_FRAME_MAGIC, self.frame_seq, self.stage, 0x01 if self.lid_distance > 5 else 0,
+                               self.current_weight() - self.box_tare_offset, self.pill_count, self.weight_per_pill,
+                               max(-32768, min(32767, int(self.lid_distance))), 0)
+        self.frame_seq = (self.frame_seq + 1) & 0xFFFF
+        if self.compartment_count:
+            body = COMPARTMENT_FRAME_MAGIC + body[2:-2] + struct.pack(
+                f'<B{self.compartment_count}f', self.compartment_count, *self.compartment_weights[:self.compartment_count])
+            return body + struct.pack('<H', binascii.crc_hqx(body[2:], 0xFFFF))
+        crc = binascii.crc_hqx(body[2:-2], 0xFFFF)
+        return body[:-2] + struct.pack('<H', crc)
+
+    def periodic_sample(self):
+        return self.data_frame() if self.binary_format else self.data_line()
+
+    # --- Commands ---
+    def process_command(self, command, sleep=time.sleep):
+        """Apply one command line and return the reply lines (bytes, CRLF-terminated)."""
+        command = command[:INPUT_BUFFER_SIZE - 1]
+        out = [f"Arduino received: {command}"]
+        if command.startswith("SET_MODE:"):
+            self.is_simulation = self._int(command[9:]) == 1
+            out.append(f"Mode set to: {'Simulation' if self.is_simulation else 'Real'}")
+            self.simulated_weight = 0.0
+            self.pill_count = 0
+            self.weight_per_pill = 0.25
+            self.selected_medication = "N/A"
+            if not self.is_simulation:
+                self.scale_zero = self.load_grams
+            out.append("State reset due to mode change. PC should resync active medication state.")
+        elif command.startswith("SET_STAGE:"):
+            stage_id = self._int(command[10:])
+            if 0 <= stage_id < len(STAGE_NAMES):
+                self.stage = stage_id
+                out.append(f"Stage changed to: {STAGE_NAMES[stage_id]}")
+                if stage_id == 2:
+                    self.simulated_weight = 0.0
+                    self.pill_count = 0
+                    self.weight_per_pill = 0.25
+                    self.selected_medication = "N/A"
+                    out.append("Weight, count, and pill params reset due to RESET_STAGE.")
+        elif command.startswith("SET_PILL_WEIGHT:"):
+            value = self._float(command[16:])
+            if value > 0.0001:
+                self.weight_per_pill = value
+                out.append(f"WPP for '{self.selected_medication}' set to: {value:.3f}")
+            else:
+                out.append("Invalid pill weight. Must be > 0.0001")
+        elif command.startswith("SELECT_MEDICATION:"):
+            self.selected_medication = command[18:][:31]
+            out.append(f"Arduino active medication context set to: {self.selected_medication}")
+        elif self.is_simulation and command.startswith("SET_WEIGHT:"):
+            self.simulated_weight = self._float(command[11:])
+            out.append(f"Arduino simulated total weight (for '{self.selected_medication}') set to: {self.simulated_weight:.2f}")
+        elif command.startswith("TARE_SIM"):
+            self.simulated_weight = 0.0
+            self.pill_count = 0
+            if not self.is_simulation:
+                self.scale_zero = self.load_grams
+                out.append("Real mode tare complete. HX711 sensor zeroed.")
+            else:
+                out.append("Simulated tare complete. Arduino total weight and count set to 0.")
+        elif self.stage == 1 and command.startswith("CONSUME_PILLS:"):
+            count = self._int(command[14:])
+            if count > 0 and self.weight_per_pill > 0.001 and self.selected_medication != "N/A":
+                reduce = count * self.weight_per_pill
+                if self.simulated_weight >= reduce - self.weight_per_pill / 2.0:
+                    self.simulated_weight = max(0.0, self.simulated_weight - reduce)
+                    if self.simulated_weight < 0.0001:
+                        self.simulated_weight = 0.0
+                    # The pills physically leave the box too, so real-mode readings follow
+                    self.load_grams = max(0.0, self.load_grams - reduce)
+                    out.append(f"{count} pills of '{self.selected_medication}' consumed (Arduino side).")
+                    out.append(f"Arduino weight reduced by: {reduce:.2f}, new total: {self.simulated_weight:.2f}")
+                else:
+                    out.append(f"Not enough '{self.selected_medication}' to consume or weight too low on Arduino.")
+            elif count <= 0:
+                out.append("Number of pills to consume must be positive.")
+            elif self.selected_medication == "N/A":
+                out.append("Cannot consume on Arduino: No medication selected.")
+            else:
+                out.append("Cannot consume pills on Arduino: WPP not set or is zero for current med.")
+        elif not self.is_simulation and command.startswith("MEASURE_SINGLE_PILL_WEIGHT"):
+            out.append("Starting single pill weight measurement, please wait...")
+            readings = []
+            for i in range(5):
+                reading = self.read_weight()
+                if 0.0001 <= reading < 10.0:
+                    readings.append(reading)
+                    out.append(f"Measurement sample {i + 1}: {reading:.3f}g")
+                sleep(0.1)
+            measured = sum(readings) / len(readings) if readings else 0.0
+            if measured > 0.0001 and self.selected_medication != "N/A":
+                self.weight_per_pill = measured
+                out.append(f"Measured single pill weight for '{self.selected_medication}': {measured:.3f}g")
+            elif self.selected_medication == "N/A":
+                out.append("Error: No medication selected for measurement")
+            else:
+                out.append("Error: Measured weight too small or invalid (< 0.0001g)")
+                out.append(f"Current reading: {measured:.3f}g")
+        elif not self.is_simulation and command.startswith("CANCEL_MEASURE"):
+            out.append("Measurement cancelled")
+        elif command.startswith("GET_WEIGHT"):
+            if self.is_simulation:
+                out.append(f"WEIGHT:{self.simulated_weight:.3f}")
+            else:
+                readings = [r for r in (self.read_weight() for _ in range(5)) if 0 <= r < 1000]
+                sleep(0.05)
+                if readings:
+                    out.append(f"WEIGHT:{sum(readings) / len(readings):.3f}")
+                else:
+                    out.append("WEIGHT:0.000")
+                    out.append("Error: No valid weight readings")
+        elif command.startswith("BOX_TARE"):
+            self.box_tare_offset = self.read_weight()
+            out.append("BOX_TARE complete")
+        elif command.startswith("LCD:REMIND"):
+            self.lcd = ("Time to take", "medication")
+        elif command.startswith("LCD:TAKEN"):
+            self.lcd = ("PharmaPlan", "")
+        elif command.startswith("LCD:NEXT:") or command.startswith("LCD:TIME:"):
+            text = command[9:][:5]
+            self.lcd = ("PharmaPlan", f"Next: {text}" if command.startswith("LCD:NEXT:") else text)
+        elif command.startswith("SET_DATA_FORMAT:"):
+            self.binary_format = self._int(command[16:]) == 1
+            self.frame_seq = 0
+            out.append(f"DATA_FORMAT:{1 if self.binary_format else 0}")
+        elif command.startswith("SET_DATA_INTERVAL:"):
+            interval = self._int(command[18:])
+            if interval >= 20:
+                self.send_interval = interval / 1000.0
+            out.append(f"DATA_INTERVAL:{int(round(self.send_interval * 1000))}")
+        elif command.startswith("SET_COMPARTMENTS:"):
+            count = max(0, min(MAX_COMPARTMENTS, self._int(command[17:])))
+            for i in range(self.compartment_count, count):
+                self.compartment_weights[i] = 0.0
+            self.compartment_count = count
+            out.append(f"COMPARTMENTS:{count}")
+        elif self.is_simulation and command.startswith("SET_COMPARTMENT_WEIGHT:"):
+            index = self._int(command[23:])
+            _, separator, weight = command[23:].partition(":")
+            if 0 <= index < self.compartment_count and separator:
+                self.compartment_weights[index] = self._float(weight)
+                out.append(f"Compartment {index} simulated weight set to: {self.compartment_weights[index]:.2f}")
+            else:
+                out.append("Invalid compartment")
+        elif command.startswith("PLAY_REMINDER"):
+            self.reminders_played += 1
+            sleep(3.0)  # The firmware blocks while the track plays
+        self.update()
+        return [line.encode() + b"\r\n" for line in out] + [self.data_line()]
+
+    @staticmethod
+    def _int(text):
+        # atoi(): leading integer, 0 if none
+        digits = ""
+        for ch in text.strip():
+            if ch.isdigit() or (not digits and ch in "+-"):
+                digits += ch
+            else:
+                break
+        try:
+            return int(digits)
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def _float(text):
+        try:
+            return float(text.strip())
+        except ValueError:
+            return 0.0
+
+
+class PtyEmulator:
+    """Serves one EmulatedPillbox on a pty, with optional baud-rate pacing, line corruption and disconnects."""
+    def __init__(self, box, name="pillbox", link=None, baud=9600, corrupt_rate=0.0, disconnect_every=0.0,
+                 disconnect_duration=5.0, disconnect_mode="silent", lid_cycle=0.0, rng=None):
+        self.box = box
+        self.name = name
+        self.link = link
+        self.baud = baud
+        self.corrupt_rate = corrupt_rate
+        self.disconnect_every = disconnect_every
+        self.disconnect_duration = disconnect_duration
+        self.disconnect_mode = disconnect_mode
+        self.lid_cycle = lid_cycle
+        self.rng = rng or random.Random()
+        self.master = None
+        self.path = None
+        self.stopped = threading.Event()
+        self.stats = {"samples": 0, "commands": 0, "bytes_out": 0, "corrupted": 0, "disconnects": 0}
+
+    def open(self):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.master = master
+        self.slave = slave  # Kept open so the master does not see EIO while the server reconnects
+        self.path = os.ttyname(slave)
+        if self.link:
+            tmp_link = f"{self.link}.tmp"
+            if os.path.lexists(tmp_link):
+                os.remove(tmp_link)
+            os.symlink(self.path, tmp_link)
+            os.replace(tmp_link, self.link)
+        logger.info(f"[{self.name}] Emulated Arduino on {self.path}" + (f" (link {self.link})" if self.link else ""))
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.master = None
+
+    def write(self, payload):
+        if self.corrupt_rate and self.rng.random() < self.corrupt_rate:
+            payload = self.corrupt(payload)
+            self.stats["corrupted"] += 1
+        try:
+            os.write(self.master, payload)
+        except OSError as e:
+            logger.warning(f"[{self.name}] Write failed: {e}")
+            return
+        self.stats["bytes_out"] += len(payload)
+        if self.baud:
+            time.sleep(len(payload) * 10.0 / self.baud)  # 8N1: 10 bits per byte on the wire
+
+    def corrupt(self, payload):
+        data = bytearray(payload)
+        if self.rng.random() < 0.5 and len(data) > 1:
+            # Truncated line: tail (and newline) lost, so it merges with the next line
+            return bytes(data[:self.rng.randrange(1, len(data))])
+        index = self.rng.randrange(len(data))
+        data[index] ^= 1 << self.rng.randrange(8)
+        return bytes(data)
+
+    def next_disconnect(self, now):
+        return now + self.rng.expovariate(1.0 / self.disconnect_every) if self.disconnect_every else float('inf')
+
+    def disconnect(self):
+        self.stats["disconnects"] += 1
+        logger.info(f"[{self.name}] Simulated {self.disconnect_mode} disconnect for {self.disconnect_duration:.1f}s")
+        if self.disconnect_mode == "hangup":
+            self.close()
+            self.stopped.wait(self.disconnect_duration)
+            self.open()
+        else:
+            # USB cable still attached but the board is unresponsive: drop input, send nothing
+            deadline = time.monotonic() + self.disconnect_duration
+            while not self.stopped.is_set() and time.monotonic() < deadline:
+                readable, _, _ = select.select([self.master], [], [], 0.1)
+                if readable:
+                    try:
+                        os.read(self.master, 4096)
+                    except OSError:
+                        pass
+        self.box.__init__(load_grams=self.box.load_grams, noise=self.box.noise,
+                          lid_distance=self.box.lid_distance, rng=self.box.rng)  # Board resets on reconnect
+        self.write(b"Arduino Pillbox Ready.\r\nMode: Simulation\r\nWaiting for commands from PC...\r\n")
+
+    def run(self):
+        if self.master is None:
+            self.open()
+        self.write(b"Arduino Pillbox Ready.\r\nMode: Simulation\r\nWaiting for commands from PC...\r\n")
+        buffer = bytearray()
+        now = time.monotonic()
+        next_sample = now
+        next_disconnect = self.next_disconnect(now)
+        next_lid_toggle = now + self.lid_cycle if self.lid_cycle else float('inf')
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            if now >= next_disconnect:
+                self.disconnect()
+                buffer.clear()
+                now = time.monotonic()
+                next_sample = now
+                next_disconnect = self.next_disconnect(now)
+            if now >= next_lid_toggle:
+                self.box.lid_distance = 3 if self.box.lid_distance > 5 else 12
+                next_lid_toggle = now + self.lid_cycle
+            timeout = max(0.0, min(next_sample, next_disconnect, next_lid_toggle) - now)
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                try:
+                    chunk = os.read(self.master, 4096)
+                except OSError:
+                    chunk = b""
+                buffer += chunk
+                while b"\n" in buffer:
+                    raw, _, rest = bytes(buffer).partition(b"\n")
+                    buffer[:] = rest
+                    command = raw.decode("utf-8", errors="replace").strip("\r")
+                    self.stats["commands"] += 1
+                    for line in self.box.process_command(command, sleep=self.stopped.wait):
+                        self.write(line)
+            if time.monotonic() >= next_sample:
+                self.box.update()
+                self.write(self.box.periodic_sample())
+                self.stats["samples"] += 1
+                next_sample = max(next_sample + self.box.send_interval, time.monotonic())
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate pillbox Arduinos on pseudo-terminals.")
+    parser.add_argument("--count", type=int, default=1, help="Number of emulated boxes")
+    parser.add_argument("--link", help="Symlink to the pty (with --count > 1, '{n}' is replaced by the box index)")
+    parser.add_argument("--interval-ms", type=int, default=200, help="DATA period until SET_DATA_INTERVAL changes it")
+    parser.add_argument("--baud", type=int, default=9600, help="Pace output like a UART at this baud rate (0: unpaced)")
+    parser.add_argument("--noise", type=float, default=0.0, help="Std dev (g) of Gaussian noise on weight readings")
+    parser.add_argument("--load", type=float, default=0.0, help="Grams physically on the scale (real mode)")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0, help="Probability that an emitted line/frame is corrupted")
+    parser.add_argument("--disconnect-every", type=float, default=0.0, help="Mean seconds between disconnects (0: never)")
+    parser.add_argument("--disconnect-duration", type=float, default=5.0, help="Seconds each disconnect lasts")
+    parser.add_argument("--disconnect-mode", choices=("silent", "hangup"), default="silent",
+                        help="silent: board stops responding; hangup: the pty is closed and recreated (use --link)")
+    parser.add_argument("--lid-cycle", type=float, default=0.0, help="Toggle the lid open/closed every N seconds")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible noise/corruption")
+    parser.add_argument("--stats-interval", type=float, default=10.0, help="Seconds between stats log lines")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    emulators = []
+    for n in range(args.count):
+        rng = random.Random(None if args.seed is None else args.seed + n)
+        box = EmulatedPillbox(load_grams=args.load, noise=args.noise, rng=rng)
+        box.send_interval = args.interval_ms / 1000.0
+        link = args.link.replace("{n}", str(n)) if args.link and args.count > 1 else args.link
+        if link and args.count > 1 and link == args.link:
+            link = f"{args.link}{n}"
+        emulator = PtyEmulator(box, name=f"box{n}", link=link, baud=args.baud, corrupt_rate=args.corrupt_rate,
+                               disconnect_every=args.disconnect_every, disconnect_duration=args.disconnect_duration,
+                               disconnect_mode=args.disconnect_mode, lid_cycle=args.lid_cycle, rng=rng)
+        emulator.open()
+        print(f"box{n}={link or emulator.path}", flush=True)
+        emulators.append(emulator)
+
+    threads = [threading.Thread(target=e.run, daemon=True) for e in emulators]
+    for thread in threads:
+        thread.start()
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        while not stop.wait(args.stats_interval):
+            for e in emulators:
+                logger.info(f"[{e.name}] {e.stats}")
+    except KeyboardInterrupt:
+        pass
+    for e in emulators:
+        e.stopped.set()
+    for thread in threads:
+        thread.join(timeout=2)
+    for e in emulators:
+        logger.info(f"[{e.name}] final {e.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""End-to-end benchmark of the pillbox server against emulated Arduinos (arduino_emulator.py).
+
+Starts the emulator and app.py's Flask server in child processes (or targets --url), then runs N
+dashboard clients that poll like index.html (/get_status and /get_current_weight every 200 ms,
+/api/history now and then) plus one session client per device cycling start / unlock /
+lock_and_record. Reports per-endpoint p50/p99 latency and throughput and writes them as JSON:
+
+    python benchmark.py --clients 20 --duration 30 --output benchmarks/baseline.json
+    python benchmark.py --clients 20 --duration 30 --compare benchmarks/baseline.json
+"""
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCH_MED = "BenchMed"
+
+
+def serve_app(port, env):
+    """Child process: run app.py's server threads on 127.0.0.1:port (no ngrok tunnel, no reloader)."""
+    os.environ.update(env)
+    sys.path.insert(0, HERE)
+    import app as pillbox_app
+    for device in pillbox_app.devices.values():
+        device.start()
+    threading.Thread(target=pillbox_app.weight_series_flush_thread_function, daemon=True).start()
+    threading.Thread(target=pillbox_app.cloud_sync.run, daemon=True).start()
+    pillbox_app.app.run(host='127.0.0.1', port=port, threaded=True, use_reloader=False)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(base_url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status, _, _ = Client(base_url).request("GET", "/api/devices")
+            if status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+class Client:
+    """One browser tab: a persistent HTTP connection (reopened when the server closes it)."""
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+        self.prefix = parts.path.rstrip('/')
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.conn.request(method, self.prefix + path, body=payload, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            raise
+        if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+            self.conn.close()
+        return response.status, response.getheader('ETag'), data
+
+
+class Recorder:
+    """Latency samples per endpoint, kept per thread and merged at the end."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def timed(self, name, call, ok=lambda status: status < 400):
+        started = time.perf_counter()
+        try:
+            result = call()
+            failed = not ok(result[0])
+        except (http.client.HTTPException, OSError):
+            result, failed = None, True
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            if failed:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            else:
+                self.samples.setdefault(name, []).append(elapsed)
+        return result
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder, duration):
+    results = {}
+    for name in sorted(set(recorder.samples) | set(recorder.errors)):
+        values = sorted(recorder.samples.get(name, []))
+        ms = lambda v: None if v is None else round(v * 1000.0, 3)
+        results[name] = {
+            "count": len(values),
+            "errors": recorder.errors.get(name, 0),
+            "throughput_rps": round(len(values) / duration, 2) if duration > 0 else 0.0,
+            "mean_ms": ms(sum(values) / len(values)) if values else None,
+            "p50_ms": ms(percentile(values, 50)),
+            "p90_ms": ms(percentile(values, 90)),
+            "p99_ms": ms(percentile(values, 99)),
+            "max_ms": ms(values[-1]) if values else None
+        }
+    return results
+
+
+def dashboard_client(base_url, device_path, recorder, stop, poll_interval, history_every):
+    client = Client(base_url)
+    history_etag = None
+    polls = 0
+    next_poll = time.monotonic()
+    while not stop.is_set():
+        recorder.timed("get_status", lambda: client.request("GET", f"{device_path}/get_status"))
+        recorder.timed("get_current_weight", lambda: client.request("GET", f"{device_path}/get_current_weight"))
+        if history_every and polls % history_every == 0:
+            headers = {'If-None-Match': history_etag} if history_etag else None
+            result = recorder.timed("api_history", lambda: client.request("GET", "/api/history?limit=50", headers=headers),
+                                    ok=lambda status: status in (200, 304))
+            if result and result[1]:
+                history_etag = result[1]
+        polls += 1
+        if poll_interval:
+            next_poll += poll_interval
+            stop.wait(max(0.0, next_poll - time.monotonic()))
+
+
+def session_client(base_url, device_path, recorder, stop, pause):
+    client = Client(base_url)
+    setup = [
+        ("POST", "/set_mode/simulation", None),
+        ("POST", "/add_or_update_known_medication", {"name": BENCH_MED, "wpp": 0.25}),
+        ("POST", "/set_pc_active_medication", {"name": BENCH_MED}),
+        ("POST", "/set_simulated_total_weight_for_active_med", {"weight": 25.0})
+    ]
+    for method, path, body in setup:
+        client.request(method, device_path + path, body)
+    client.request("POST", f"{device_path}/cancel_medication_session")  # Leftover session from an aborted run
+    while not stop.is_set():
+        started = time.perf_counter()
+        steps = [
+            ("session_start", "/start_medication_session", {"medication_name": BENCH_MED}),
+            ("session_unlock", "/unlock_medication_compartment", None),
+            ("session_lock_and_record", "/lock_and_record_consumption", None)
+        ]
+        completed = True
+        for name, path, body in steps:
+            result = recorder.timed(name, lambda: client.request("POST", device_path + path, body if body is not None else {}))
+            if result is None or result[0] >= 400:
+                completed = False
+                client.request("POST", f"{device_path}/cancel_medication_session")
+                break
+        if completed:
+            with recorder.lock:
+                recorder.samples.setdefault("session_cycle", []).append(time.perf_counter() - started)
+        if pause:
+            stop.wait(pause)
+
+
+def run_phase(base_url, device_ids, args, duration):
+    recorder = Recorder()
+    stop = threading.Event()
+    paths = [f"/devices/{device_id}" for device_id in device_ids] or [""]
+    threads = [threading.Thread(target=dashboard_client, daemon=True,
+                                args=(base_url, paths[i % len(paths)], recorder, stop, args.poll_interval, args.history_every))
+               for i in range(args.clients)]
+    if args.sessions:
+        threads += [threading.Thread(target=session_client, daemon=True,
+                                     args=(base_url, path, recorder, stop, args.session_pause)) for path in paths]
+    for thread in threads:
+        thread.start()
+    started = time.monotonic()
+    stop.wait(duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=15)
+    return recorder, time.monotonic() - started
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_report(results, baseline=None):
+    print(f"{'endpoint':<26}{'count':>8}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, r in results.items():
+        fmt = lambda v: "-" if v is None else f"{v:.1f}"
+        line = f"{name:<26}{r['count']:>8}{r['errors']:>6}{r['throughput_rps']:>9.1f}{fmt(r['p50_ms']):>10}{fmt(r['p99_ms']):>10}{fmt(r['max_ms']):>10}"
+        old = (baseline or {}).get(name)
+        if old and old.get('p99_ms') and r['p99_ms'] is not None:
+            line += f"   p99 {100.0 * (r['p99_ms'] - old['p99_ms']) / old['p99_ms']:+.0f}% vs baseline"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pillbox server's HTTP and serial hot paths.")
+    parser.add_argument("--url", help="Benchmark an already running server instead of starting one")
+    parser.add_argument("--clients", type=int, default=10, help="Concurrent dashboard clients")
+    parser.add_argument("--devices", type=int, default=1, help="Emulated pillboxes (clients are spread across them)")
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Unmeasured seconds before the run")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="Dashboard poll period (0: closed loop)")
+    parser.add_argument("--history-every", type=int, default=25, help="Fetch /api/history every N polls (0: never)")
+    parser.add_argument("--no-sessions", dest="sessions", action="store_false", help="Skip the session cycle clients")
+    parser.add_argument("--session-pause", type=float, default=0.0, help="Seconds between session cycles")
+    parser.add_argument("--data-interval-ms", type=int, default=200, help="Emulated DATA period")
+    parser.add_argument("--data-format", choices=("text", "binary"), default="text")
+    parser.add_argument("--baud", type=int, default=9600, help="Emulated UART speed (0: unpaced)")
+    parser.add_argument("--noise", type=float, default=0.0, help="Emulated weight noise (g)")
+    parser.add_argument("--label", help="Free-form label stored with the results")
+    parser.add_argument("--output", help="Write results JSON here")
+    parser.add_argument("--compare", help="Baseline results JSON to compare p99 latencies against")
+    args = parser.parse_args()
+
+    children = []
+    try:
+        device_ids = []
+        base_url = args.url
+        if not base_url:
+            workdir = tempfile.mkdtemp(prefix="pillbox-bench-")
+            emulator = subprocess.Popen(
+                [sys.executable, os.path.join(HERE, "arduino_emulator.py"), "--count", str(args.devices),
+                 "--link", os.path.join(workdir, "pillbox{n}" if args.devices > 1 else "pillbox"),
+                 "--interval-ms", str(args.data_interval_ms), "--baud", str(args.baud), "--noise", str(args.noise),
+                 "--stats-interval", "3600"],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            children.append(emulator)
+            ports = [emulator.stdout.readline().strip().split("=", 1) for _ in range(args.devices)]
+            device_ids = [name for name, _ in ports]
+            env = {
+                "PILLBOX_DEVICES": ",".join(f"{name}={path}" for name, path in ports),
+                "PILLBOX_DATA_FORMAT": args.data_format,
+                "PILLBOX_DATA_INTERVAL_MS": str(args.data_interval_ms),
+                "HISTORY_DB": os.path.join(workdir, "history.db"),
+                "CLOUD_SERVER_URL": ""
+            }
+            port = free_port()
+            server = multiprocessing.Process(target=serve_app, args=(port, env), daemon=True)
+            server.start()
+            children.append(server)
+            base_url = f"http://127.0.0.1:{port}"
+            if not wait_for_server(base_url):
+                sys.exit("Server did not come up")
+
+        if args.warmup:
+            run_phase(base_url, device_ids, args, args.warmup)
+        recorder, elapsed = run_phase(base_url, device_ids, args, args.duration)
+        results = summarize(recorder, elapsed)
+
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f).get("results")
+        print_report(results, baseline)
+
+        if args.output:
+            report = {
+                "label": args.label,
+                "timestamp": time.time(),
+                "git_revision": git_revision(),
+                "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+                "duration_s": round(elapsed, 3),
+                "results": results
+            }
+            os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Results written to {args.output}")
+    finally:
+        for child in children:
+            child.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,10 +10,31 @@
   @date  2021-1-29
   @url https://github.com/DFRobot/DFRobot_HX711_I2C
 """
-import serial
 import time
-import smbus
 import struct
+import threading
+from array import array
+from collections import deque
+try:
+  import smbus                  # optional when smbus2 is installed or an SMBus-like object is passed in
+except ImportError:
+  smbus = None
+try:
+  import smbus2                 # optional: plain I2C reads (i2c_rdwr) for the fast acquisition mode
+except ImportError:
+  smbus2 = None
+
+def _open_bus(bus, prefer_smbus2):
+  '''!
+    @brief Return bus itself if it is already an SMBus-like object, else open I2C bus number bus
+  '''
+  if hasattr(bus, 'write_byte'):
+    return bus
+  if smbus2 is not None and (prefer_smbus2 or smbus is None):
+    return smbus2.SMBus(bus)
+  if smbus is None:
+    raise ImportError('DFRobot_HX711_I2C needs the smbus or smbus2 package to open I2C bus %s' % bus)
+  return smbus.SMBus(bus)
 
 class DFRobot_HX711_I2C(object):
 
@@ -27,18 +48,48 @@ class DFRobot_HX711_I2C(object):
   REG_DATA_GET_PEEL_FLAG     = 0x69  #Module initialization
   REG_SET_CAL_THRESHOLD      = 0x71  #Set the calibration trigger threshold
   REG_SET_TRIGGER_WEIGHT     = 0x72  #Set calibration weight
+
+  DATA_READY                 = 0x12  #First byte of a valid raw data frame
+  SETTLE_TIME                = 0.03  #Register settle time of the legacy read path (s)
+  POLL_INTERVAL              = 0.002 #Readiness poll period of the fast read path (s)
+  READY_TIMEOUT              = 0.1   #Give up on a raw data frame after this long (s)
+  SAMPLE_RATE                = 80    #HX711 native output rate in its fast setting (Hz)
+  RING_CAPACITY              = 256   #Background sampler ring size (samples)
+  FLAG_INTERVAL              = 1.0   #Background sampler peel/calibration flag check period (s)
+  START_TIMEOUT              = 1.0   #Longest start_sampler() wait for the first sample (s)
+  STOP_TIMEOUT               = 1.0   #Longest stop_sampler() wait for the sampler thread (s)
+  FAILURE_BACKOFF            = 0.5   #First sampler retry delay after an I/O error (s), doubled per failure
+  MAX_BACKOFF                = 30.0  #Longest sampler retry delay (s)
   
   ''' Conversion data '''
-  rxbuf      = [0,0,0,0]
   _calibration = 2210.0
   _offset = 0
   #_addr      =  0x50
   #_mode      =  0
   #   idle =    0
-  def __init__(self ,bus,address):
-    self.i2cbus = smbus.SMBus(bus)
+  def __init__(self ,bus,address, fast = False, sample_rate = SAMPLE_RATE, bus_lock = None):
+    '''!
+      @fn __init__
+      @param bus I2C bus number, or an already open SMBus object to share
+      @param address I2C device address
+      @param fast Use block reads and readiness polling instead of fixed register settle sleeps
+      @param sample_rate Default rate of sample() (Hz)
+      @param bus_lock Lock shared by all users of a shared SMBus object
+    '''
+    self.fast = fast
+    self.i2cbus = _open_bus(bus, prefer_smbus2 = fast)
+    # Plain reads (no register write in front) can poll a pending conversion without restarting it
+    self.plain_reads = smbus2 is not None and hasattr(self.i2cbus, 'i2c_rdwr')
     self._addr = address
     self.idle =    0
+    self.rxbuf = [0,0,0,0]
+    self.settle_time = self.SETTLE_TIME
+    self.poll_interval = self.POLL_INTERVAL
+    self.ready_timeout = self.READY_TIMEOUT
+    self.sample_rate = sample_rate
+    self._bus_lock = bus_lock or threading.RLock()
+    self._sampler = None
+    self._latest = None
 
   def begin(self):
     '''!
@@ -47,7 +98,8 @@ class DFRobot_HX711_I2C(object):
       @return return 1 if initialization succeeds, otherwise return non-zero and error code.
     '''
     self._offset = self.average(20)
-    time.sleep(0.05)
+    if not self.fast:
+      time.sleep(0.05)
     
 
   def read_weight(self,times):
@@ -57,18 +109,65 @@ class DFRobot_HX711_I2C(object):
       @param times Take the average several times
       @return return the read weight value, unit: g
     '''
+    sampler = self._sampler
+    if sampler is not None and sampler.is_alive() and not self.sampler_failures:
+      weight = self.window_mean(times)
+      if weight is not None:
+        return weight
+    # No sampler, ring still empty, or the sampler is failing: read synchronously rather than
+    # serve a stale window (an I/O error is raised to the caller)
     value = self.average(times)
-    time.sleep(0.05)
+    if not self.fast:
+      time.sleep(0.05)
+    self._check_flags(times)
+    return self.to_weight(value)
+
+  def _check_flags(self, times):
     ppFlag = self.peel_flag()
     if ppFlag == 1:
       self._offset = self.average(times)
     elif ppFlag == 2:
-      b = self.getCalibration()
+      b = self.get_calibration()
       self._calibration = b[0]
-    #Serial.println("pppppppppppppppppppppp----------------------");
-    #print(value);
-    print(self._calibration)
-    return ((value - self._offset)/self._calibration) 
+
+  def to_weight(self, value):
+    '''!
+      @fn to_weight
+      @brief Convert a raw reading to grams with the current offset and calibration
+      @param value raw value, as returned by get_value() or average()
+      @return the weight, unit: g
+    '''
+    return ((value - self._offset)/self._calibration)
+
+  def sample(self, rate = None, count = None, stop = None):
+    '''!
+      @fn sample
+      @brief Read the weight at a fixed rate
+      @details Readings are paced against a monotonic deadline; a slot missed because the bus was
+      @n slow is dropped rather than caught up, and frames that never became ready are skipped.
+      @param rate samples per second, default sample_rate
+      @param count stop after this many samples, default never
+      @param stop threading.Event that ends the generator; checked between readings and while pacing,
+      @n so it works even when no frame ever becomes ready
+      @return generator of (timestamp, weight) tuples, weight unit: g
+    '''
+    period = 1.0 / (rate or self.sample_rate)
+    deadline = time.monotonic()
+    taken = 0
+    while (count is None or taken < count) and not (stop is not None and stop.is_set()):
+      value = self.get_value()
+      if value != 0:
+        taken += 1
+        yield (time.time(), self.to_weight(value))
+      deadline += period
+      delay = deadline - time.monotonic()
+      if delay > 0:
+        if stop is not None:
+          stop.wait(delay)
+        else:
+          time.sleep(delay)
+      else:
+        deadline = time.monotonic()
 
    
 
@@ -110,8 +209,16 @@ class DFRobot_HX711_I2C(object):
         
   def get_value(self):
       data = self.read_reg(self.REG_DATA_GET_RAM_DATA,4);
+      return self.decode_value(data)
+
+  def decode_value(self, data):
+      '''!
+        @fn decode_value
+        @brief Decode a raw data frame read from REG_DATA_GET_RAM_DATA
+        @return the raw value, 0 if the frame was not ready
+      '''
       value = 0;
-      if(data[0] == 0x12):
+      if(data[0] == self.DATA_READY):
         value = (data[1])
         value = ((value << 8) | data[2])
         value = ((value << 8) | data[3])
@@ -197,19 +304,479 @@ class DFRobot_HX711_I2C(object):
 
 
 
+  def start_sampler(self, rate = None, capacity = RING_CAPACITY, flag_interval = FLAG_INTERVAL, timeout = START_TIMEOUT):
+    '''!
+      @fn start_sampler
+      @brief Sample continuously in a background thread into a preallocated ring buffer
+      @details While the sampler runs, read_weight() returns the mean of the latest samples without
+      @n touching the bus, and the peel/calibration flag is checked every flag_interval seconds
+      @n instead of on every read. An I/O error does not end the sampler: it is counted in
+      @n sampler_errors (last one in sampler_error), and sampling resumes after a backoff of
+      @n FAILURE_BACKOFF doubled per consecutive failure (sampler_failures). Until a sample arrives
+      @n again, read_weight() reads synchronously.
+      @param rate samples per second, default sample_rate
+      @param capacity ring buffer size (samples)
+      @param flag_interval seconds between peel/calibration flag checks
+      @param timeout longest wait for the first sample (s); read_weight() reads synchronously until then
+      @return True once the ring holds a sample, False if none arrived within timeout
+    '''
+    if self._sampler is not None:
+      return self._first_sample.wait(timeout)
+    self._capacity = capacity
+    self._ring_time = array('d', bytes(8 * capacity))
+    self._ring_weight = array('d', bytes(8 * capacity))
+    self._written = 0
+    self._drained = 0
+    self.dropped = 0
+    self.sampler_errors = 0
+    self.sampler_failures = 0
+    self.sampler_error = None
+    self._sampler_stop = threading.Event()
+    self._first_sample = threading.Event()
+    self._sampler = threading.Thread(target=self._sampler_loop, args=(rate, flag_interval), daemon=True)
+    self._sampler.start()
+    return self._first_sample.wait(timeout)
+
+  def stop_sampler(self, timeout = STOP_TIMEOUT):
+    '''!
+      @fn stop_sampler
+      @brief Stop the background sampler thread
+      @param timeout longest wait for the thread to finish its current bus transfer (s)
+      @return True if the thread has ended, False if it was still inside a transfer after timeout
+    '''
+    if self._sampler is None:
+      return True
+    self._sampler_stop.set()
+    self._sampler.join(timeout)
+    stopped = not self._sampler.is_alive()
+    self._sampler = None
+    return stopped
+
+  def _sampler_loop(self, rate, flag_interval):
+    next_flag_check = time.monotonic() + flag_interval
+    while not self._sampler_stop.is_set():
+      try:
+        for timestamp, weight in self.sample(rate, stop = self._sampler_stop):
+          index = self._written % self._capacity
+          self._ring_time[index] = timestamp
+          self._ring_weight[index] = weight
+          # Publish only after the slot is filled: readers never lock, they trust _written
+          self._written += 1
+          self._latest = (timestamp, weight)
+          self.sampler_failures = 0
+          self._first_sample.set()
+          if time.monotonic() >= next_flag_check:
+            self._check_flags(10)
+            next_flag_check = time.monotonic() + flag_interval
+      except (IOError, OSError) as e:
+        self.sampler_errors += 1
+        self.sampler_failures += 1
+        self.sampler_error = str(e)
+        self._sampler_stop.wait(min(self.MAX_BACKOFF, self.FAILURE_BACKOFF * 2 ** (self.sampler_failures - 1)))
+
+  def latest(self):
+    '''!
+      @fn latest
+      @brief Most recent sample of the background sampler, without blocking
+      @return (timestamp, weight) tuple, or None before the first sample, weight unit: g
+    '''
+    return self._latest
+
+  def window_mean(self, n):
+    '''!
+      @fn window_mean
+      @brief Mean weight of the last n samples of the background sampler, without blocking
+      @param n number of samples, should stay well below the ring capacity
+      @return the weight, unit: g, or None before the first sample
+    '''
+    written = self._written
+    n = min(n, written, self._capacity)
+    if n <= 0:
+      return None
+    total = 0.0
+    for i in range(written - n, written):
+      total += self._ring_weight[i % self._capacity]
+    return total / n
+
+  def drain(self):
+    '''!
+      @fn drain
+      @brief Samples taken since the previous drain(), oldest first (single consumer)
+      @details If the reader falls more than the ring capacity behind, the oldest samples are lost
+      @n and counted in dropped.
+      @return list of (timestamp, weight) tuples, weight unit: g
+    '''
+    written = self._written
+    start = self._drained
+    if written - start > self._capacity:
+      self.dropped += written - start - self._capacity
+      start = written - self._capacity
+    self._drained = written
+    return [(self._ring_time[i % self._capacity], self._ring_weight[i % self._capacity])
+            for i in range(start, written)]
+
   def write_data(self, data):
-    self.i2cbus.write_byte(self._addr ,data)
+    with self._bus_lock:
+      self.i2cbus.write_byte(self._addr ,data)
     
   def write_reg(self, reg, data):
-    self.i2cbus.write_byte(self._addr ,reg)
-    self.i2cbus.write_byte(self._addr ,data)
+    with self._bus_lock:
+      self.i2cbus.write_byte(self._addr ,reg)
+      self.i2cbus.write_byte(self._addr ,data)
 
   def read_reg(self, reg ,len):
+    with self._bus_lock:
+      if self.fast:
+        return self.read_reg_block(reg, len)
+      self.i2cbus.write_byte(self._addr,reg)
+      time.sleep(self.settle_time)
+      for i in range(len):
+        #time.sleep(0.03)
+        self.rxbuf[i] = self.i2cbus.read_byte(self._addr)
+      #print(self.rxbuf)
+      return self.rxbuf[:len]
+
+  def read_reg_block(self, reg, len):
+    '''!
+      @fn read_reg_block
+      @brief Request a register once and read its answer, polling until the module has it ready
+      @details The register is written only once: writing it again (as an SMBus block read does)
+      @n restarts the conversion. Raw data frames are then polled with plain reads (i2c_rdwr) until
+      @n their first byte is DATA_READY. Other registers have no ready marker, and without i2c_rdwr
+      @n the answer is read byte by byte, so both are read after settle_time.
+      @param reg register address
+      @param len number of bytes
+      @return list of len bytes (the last attempt if the module was not ready within ready_timeout)
+    '''
+    self.i2cbus.write_byte(self._addr, reg)
+    if reg != self.REG_DATA_GET_RAM_DATA or not self.plain_reads:
+      time.sleep(self.settle_time)
+      return self._read_block(len)
+    deadline = time.monotonic() + self.ready_timeout
+    while True:
+      time.sleep(self.poll_interval)
+      data = self._read_block(len)
+      if data[0] == self.DATA_READY or time.monotonic() >= deadline:
+        return data
+
+  def _read_block(self, len):
+    '''!
+      @brief Read the answer to the pending request without writing a register
+    '''
+    if self.plain_reads:
+      msg = smbus2.i2c_msg.read(self._addr, len)
+      self.i2cbus.i2c_rdwr(msg)
+      data = list(msg)
+    else:
+      data = [self.i2cbus.read_byte(self._addr) for i in range(len)]
+    self.rxbuf[:len] = data
+    return self.rxbuf[:len]
+
+
+class DFRobot_HX711_I2C_Bus(object):
+  '''!
+    @brief Several HX711 modules sharing one I2C bus
+    @details Each module needs settle_time between a register request and its answer. Instead of
+    @n sleeping through it per module, the scheduler requests a reading from every module and then
+    @n reads whichever answer is due first, so one module settles while another is read. Peel and
+    @n calibration flags are requested the same way every flag_interval seconds. A module that
+    @n raises an I/O error (unplugged, wrong address) is backed off and retried without stopping
+    @n the others.
+  '''
+  ADDRESSES                  = (0x64, 0x65, 0x66, 0x67)  #Every address the module can be switched to
+  RATE_WINDOW                = 64    #Samples used for the per-device rate estimate
+  RETARE_SAMPLES             = 10    #Samples averaged for the new offset after a peel
+  BEGIN_TIMEOUT              = 2.0   #Longest begin() wait for every module to tare (s)
+  FAILURE_BACKOFF            = 0.5   #First retry delay of a module after an I/O error (s), doubled per failure
+  MAX_BACKOFF                = 30.0  #Longest retry delay of a failing module (s)
+
+  def __init__(self, bus, addresses = ADDRESSES, flag_interval = DFRobot_HX711_I2C.FLAG_INTERVAL):
+    '''!
+      @fn __init__
+      @param bus I2C bus number, or an SMBus-like object (e.g. FakeSMBus)
+      @param addresses I2C addresses of the modules on the bus
+      @param flag_interval seconds between peel/calibration flag checks of each module
+    '''
+    self.i2cbus = _open_bus(bus, prefer_smbus2 = True)
+    self._bus_lock = threading.RLock()
+    self.flag_interval = flag_interval
+    self.sensors = {}
+    self._slots = []
+    for address in addresses:
+      sensor = DFRobot_HX711_I2C(self.i2cbus, address, fast = True, bus_lock = self._bus_lock)
+      self.sensors[address] = sensor
+      self._slots.append(_BusSlot(sensor, self.RATE_WINDOW))
+    self._thread = None
+    self._stop = threading.Event()
+
+  def begin(self, timeout = BEGIN_TIMEOUT):
+    '''!
+      @fn begin
+      @brief Tare every module with its current load
+      @param timeout longest wait for every module to tare (s)
+      @exception IOError a module did not deliver RETARE_SAMPLES readings within timeout
+    '''
+    deadline = time.monotonic() + timeout
+    for slot in self._slots:
+      slot.retare = []
+    while any(slot.retare is not None for slot in self._slots):
+      if time.monotonic() >= deadline:
+        pending = [slot for slot in self._slots if slot.retare is not None]
+        for slot in pending:
+          slot.retare = None
+        raise IOError('HX711 module(s) %s did not tare within %.1f s (%s)' % (
+          ', '.join('0x%02x' % slot.sensor._addr for slot in pending), timeout,
+          '; '.join(slot.error or 'no data' for slot in pending)))
+      self.run_once()
+
+  def start(self):
+    '''!
+      @fn start
+      @brief Run the scheduler in a background thread
+    '''
+    if self._thread is not None:
+      return
+    self._stop.clear()
+    self._thread = threading.Thread(target=self.run, daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    '''!
+      @fn stop
+      @brief Stop the background thread
+    '''
+    if self._thread is None:
+      return
+    self._stop.set()
+    self._thread.join()
+    self._thread = None
+
+  def run(self):
+    while not self._stop.is_set():
+      self.run_once()
+
+  def run_once(self):
+    '''!
+      @fn run_once
+      @brief One scheduling step: send requests to idle modules, then read the answer due first
+    '''
+    now = time.monotonic()
+    for slot in self._slots:
+      if slot.reg is None and slot.retry_at <= now:
+        try:
+          if slot.next_flag_check <= now and slot.retare is None:
+            self._request(slot, DFRobot_HX711_I2C.REG_DATA_GET_PEEL_FLAG, 1)
+          else:
+            self._request(slot, DFRobot_HX711_I2C.REG_DATA_GET_RAM_DATA, 4)
+        except (IOError, OSError) as e:
+          self._fail(slot, e)
+    waiting = [s for s in self._slots if s.reg is not None]
+    if not waiting:
+      # Every module is backed off: sleep until the first retry (bounded so stop() stays responsive)
+      retry_at = min(s.retry_at for s in self._slots)
+      self._stop.wait(min(max(0.0, retry_at - time.monotonic()), 0.1))
+      return
+    slot = min(waiting, key = lambda s: s.ready_at)
+    delay = slot.ready_at - time.monotonic()
+    if delay > 0:
+      time.sleep(delay)
+    try:
+      with self._bus_lock:
+        data = slot.sensor._read_block(slot.length)
+      self._complete(slot, data)
+    except (IOError, OSError) as e:
+      self._fail(slot, e)
+
+  def _fail(self, slot, error):
+    slot.reg = None
+    slot.errors += 1
+    slot.failures += 1
+    slot.error = str(error)
+    slot.retry_at = time.monotonic() + min(self.MAX_BACKOFF, self.FAILURE_BACKOFF * 2 ** (slot.failures - 1))
+
+  def _request(self, slot, reg, length):
+    with self._bus_lock:
+      self.i2cbus.write_byte(slot.sensor._addr, reg)
+    now = time.monotonic()
+    slot.reg = reg
+    slot.length = length
+    slot.ready_at = now + slot.sensor.settle_time
+    slot.deadline = now + slot.sensor.ready_timeout
+
+  def _complete(self, slot, data):
+    sensor = slot.sensor
+    reg = slot.reg
+    if reg == DFRobot_HX711_I2C.REG_DATA_GET_RAM_DATA:
+      value = sensor.decode_value(data)
+      if value == 0:
+        if sensor.plain_reads and time.monotonic() < slot.deadline:
+          # Poll the same conversion again; a new request would restart it
+          slot.ready_at = time.monotonic() + sensor.poll_interval
+          return
+        if time.monotonic() >= slot.deadline:
+          slot.timeouts += 1
+      else:
+        slot.failures = 0
+        slot.error = None
+        self._record(slot, value)
+    elif reg == DFRobot_HX711_I2C.REG_DATA_GET_PEEL_FLAG:
+      slot.next_flag_check = time.monotonic() + self.flag_interval
+      if data[0] == 0x01 or data[0] == 129:
+        slot.retare = []
+      elif data[0] == 0x02:
+        slot.reg = None
+        self._request(slot, DFRobot_HX711_I2C.REG_DATA_GET_CALIBRATION, 4)
+        return
+    elif reg == DFRobot_HX711_I2C.REG_DATA_GET_CALIBRATION:
+      sensor._calibration = struct.unpack('>f', bytearray(data))[0]
+    slot.reg = None
+
+  def _record(self, slot, value):
+    if slot.retare is not None:
+      slot.retare.append(value)
+      if len(slot.retare) < self.RETARE_SAMPLES:
+        return
+      slot.sensor._offset = sum(slot.retare) / len(slot.retare)
+      slot.retare = None
+      return
+    timestamp = time.time()
+    slot.latest = (timestamp, slot.sensor.to_weight(value))
+    slot.samples += 1
+    slot.stamps.append(time.monotonic())
+
+  def latest(self, address):
+    '''!
+      @fn latest
+      @brief Most recent reading of one module
+      @param address I2C address of the module
+      @return (timestamp, weight) tuple, or None before the first sample, weight unit: g
+    '''
+    return self._slot(address).latest
+
+  def read_weights(self):
+    '''!
+      @fn read_weights
+      @brief Most recent weight of every module
+      @return dict of address: weight (g), None for modules without a sample yet or currently failing
+    '''
+    return dict((slot.sensor._addr, slot.latest[1] if slot.latest and not slot.failures else None) for slot in self._slots)
+
+  def rates(self):
+    '''!
+      @fn rates
+      @brief Per-module sample rate over the last RATE_WINDOW samples
+      @return dict of address: {"rate_hz", "samples", "timeouts", "errors", "error"}
+    '''
+    report = {}
+    for slot in self._slots:
+      stamps = list(slot.stamps)
+      rate = 0.0
+      if len(stamps) > 1 and stamps[-1] > stamps[0]:
+        rate = (len(stamps) - 1) / (stamps[-1] - stamps[0])
+      report[slot.sensor._addr] = {"rate_hz": round(rate, 2), "samples": slot.samples, "timeouts": slot.timeouts,
+                                   "errors": slot.errors, "error": slot.error}
+    return report
+
+  def _slot(self, address):
+    for slot in self._slots:
+      if slot.sensor._addr == address:
+        return slot
+    raise KeyError(address)
+
+
+class _BusSlot(object):
+  def __init__(self, sensor, window):
+    self.sensor = sensor
+    self.reg = None
+    self.length = 0
+    self.ready_at = 0.0
+    self.deadline = 0.0
+    self.next_flag_check = 0.0
+    self.retare = None
+    self.latest = None
+    self.samples = 0
+    self.timeouts = 0
+    self.errors = 0
+    self.failures = 0         #Consecutive I/O errors; the module is skipped until retry_at
+    self.retry_at = 0.0
+    self.error = None
+    self.stamps = deque(maxlen = window)
+
+
+class FakeSMBus(object):
+  '''!
+    @brief In-memory stand-in for smbus.SMBus with HX711 modules attached, for running without hardware
+    @details Each module answers a register request only after conversion_time, and every transfer
+    @n occupies the bus for transfer_time. Writing a register (again) restarts the conversion, and
+    @n so does read_i2c_block_data(), which writes the register before reading like a real SMBus
+    @n block read. Plain reads through i2c_rdwr() and read_byte() do not. Transfers are logged in
+    @n transactions as (start, end, address, kind) for checking how requests were interleaved.
+  '''
+  def __init__(self, weights, conversion_time = DFRobot_HX711_I2C.SETTLE_TIME, transfer_time = 0.0005,
+               calibration = 2210.0, offset = 8000000):
+    '''!
+      @param weights dict of address: load in grams
+      @param conversion_time time a module needs before its answer is ready (s)
+      @param transfer_time bus time of one transfer (s)
+    '''
+    self.weights = dict(weights)
+    self.conversion_time = conversion_time
+    self.transfer_time = transfer_time
+    self.calibration = calibration
+    self.offset = offset
+    self.peel_flags = dict((address, 0) for address in weights)
+    self.transactions = []
+    self._requests = {}
+    self._lock = threading.Lock()
+
+  def _transfer(self, address, kind):
+    if address not in self.weights:
+      raise IOError(121, 'Remote I/O error')
+    with self._lock:
+      start = time.monotonic()
+      if self.transfer_time:
+        time.sleep(self.transfer_time)
+      self.transactions.append((start, time.monotonic(), address, kind))
+
+  def write_byte(self, address, value):
+    self._transfer(address, 'write')
+    self._requests[address] = (value, time.monotonic(), 0)
+
+  def read_byte(self, address):
+    self._transfer(address, 'read')
+    reg, requested, index = self._requests.get(address, (None, 0.0, 0))
+    self._requests[address] = (reg, requested, index + 1)
+    return self._answer(address, reg, requested, index + 1)[index]
+
+  def read_i2c_block_data(self, address, reg, length):
+    self.write_byte(address, reg)
+    self._transfer(address, 'read')
+    _, requested, _ = self._requests[address]
+    return self._answer(address, reg, requested, length)[:length]
+
+  def i2c_rdwr(self, *msgs):
+    '''!
+      @brief Plain reads of the pending answer (smbus2.i2c_msg.read messages)
+    '''
+    for msg in msgs:
+      self._transfer(msg.addr, 'read')
+      reg, requested, _ = self._requests.get(msg.addr, (None, 0.0, 0))
+      for i, byte in enumerate(self._answer(msg.addr, reg, requested, msg.len)[:msg.len]):
+        msg.buf[i] = bytes([byte])
+
+  def close(self):
+    pass
 
-    self.i2cbus.write_byte(self._addr,reg)
-    time.sleep(0.03)
-    for i in range(len):
-      #time.sleep(0.03)
-      self.rxbuf[i] = self.i2cbus.read_byte(self._addr)
-    #print(self.rxbuf)
-    return self.rxbuf
\ No newline at end of file
+  def _answer(self, address, reg, requested, length):
+    if time.monotonic() - requested < self.conversion_time:
+      return [0] * max(length, 4)
+    if reg == DFRobot_HX711_I2C.REG_DATA_GET_RAM_DATA:
+      value = (int(self.weights[address] * self.calibration + self.offset) & 0xFFFFFF) ^ 0x800000
+      return [DFRobot_HX711_I2C.DATA_READY, (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF]
+    if reg == DFRobot_HX711_I2C.REG_DATA_GET_PEEL_FLAG:
+      flag = self.peel_flags[address]
+      self.peel_flags[address] = 0
+      return [flag, 0, 0, 0]
+    if reg == DFRobot_HX711_I2C.REG_DATA_GET_CALIBRATION:
+      return list(bytearray(struct.pack('>f', self.calibration)))
+    return [0] * max(length, 4)
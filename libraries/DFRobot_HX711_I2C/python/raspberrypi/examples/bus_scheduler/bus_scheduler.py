@@ -0,0 +1,29 @@
+# -*- coding:utf-8 -*-
+"""
+  @file bus_scheduler.py
+  @brief Read four weight modules (0x64-0x67) sharing one I2C bus and print their weights and
+  @n sample rates. Run with --fake to use the in-memory bus instead of hardware.
+  @License     The MIT License (MIT)
+"""
+import sys
+import time
+sys.path.append("../..")
+from DFRobot_HX711_I2C import *
+
+IIC_MODE         = 0x01            # default use IIC1
+
+if "--fake" in sys.argv:
+  bus = FakeSMBus({0x64: 0.0, 0x65: 0.0, 0x66: 0.0, 0x67: 0.0})
+else:
+  bus = IIC_MODE
+scheduler = DFRobot_HX711_I2C_Bus(bus, (0x64, 0x65, 0x66, 0x67))
+scheduler.begin()
+scheduler.start()
+if "--fake" in sys.argv:
+  bus.weights.update({0x64: 12.5, 0x65: 40.0, 0x66: 3.2, 0x67: 0.0})
+while(1):
+  time.sleep(2)
+  rates = scheduler.rates()
+  for address, weight in sorted(scheduler.read_weights().items()):
+    print('0x%02x weight %s g, %.1f samples/s' % (address, 'n/a' if weight is None else '%.1f' % weight,
+                                                 rates[address]['rate_hz']))
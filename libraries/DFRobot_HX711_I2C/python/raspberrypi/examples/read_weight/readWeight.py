@@ -33,6 +33,8 @@ print("start\r\n")
 hx711.set_calibration(2210.0)
 #peel
 hx711.peel();
+#Sample in the background so read_weight returns the latest average without waiting on the bus
+hx711.start_sampler()
 while(1):
   # Get the weight of the object
   data = hx711.read_weight(10)
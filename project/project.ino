@@ -23,7 +23,29 @@ const char* stageNames[] = {"Weighing", "Medication", "Resetting"};
 
 // 串口通信定时
 unsigned long lastSerialSendTime = 0;
-const long serialSendInterval = 200; // 每200ms发送数据到 PC
+long serialSendInterval = 200; // 每200ms发送数据到 PC (SET_DATA_INTERVAL 可修改)
+
+// Binary DATA frame mode (SET_DATA_FORMAT:1). Periodic samples are sent as a fixed 20-byte
+// frame; replies to commands still end with a text DATA line so the PC learns the medication name.
+const uint8_t DATA_FRAME_MAGIC0 = 0xAA;
+const uint8_t DATA_FRAME_MAGIC1 = 0x55;
+struct __attribute__((packed)) DataFrame {
+  uint8_t magic[2];
+  uint16_t seq;         // Incremented per frame so the PC can detect drops
+  uint8_t stage;        // Index into stageNames
+  uint8_t flags;        // bit0: lid open
+  float weight;         // Weight corrected based on BOX_TARE
+  int16_t pillCount;
+  float weightPerPill;
+  int16_t lidDistance;  // cm
+  uint16_t crc;         // CRC-16/CCITT-FALSE over seq..lidDistance
+};
+bool binaryDataFormat = false;
+uint16_t dataFrameSeq = 0;
+// With compartments enabled (SET_COMPARTMENTS:n) every sample also carries one weight per
+// compartment: text DATA lines get a trailing "w0;w1;..." field, binary frames use magic 0xAA 0x56
+// and append a count byte and the weights before the CRC.
+const uint8_t COMPARTMENT_FRAME_MAGIC1 = 0x56;
 // 注意：serialSendInterval 与 weightDisplayInterval 保持一致，以保证整体频率一致
 
 char inputBuffer[64]; // 使用固定大小的缓冲区而不是String
@@ -33,6 +55,19 @@ boolean stringComplete = false;
 // 创建HX711传感器对象
 DFRobot_HX711_I2C MyScale;
 
+// Per-compartment HX711 modules. The module only answers at 0x64..0x67 (set with its address
+// DIP switches); the box scale keeps 0x64, so compartments use 0x65, 0x66 and 0x67.
+const uint8_t MAX_COMPARTMENTS = 3;
+DFRobot_HX711_I2C compartmentScales[MAX_COMPARTMENTS] = {
+  DFRobot_HX711_I2C(&Wire, 0x65), DFRobot_HX711_I2C(&Wire, 0x66), DFRobot_HX711_I2C(&Wire, 0x67)
+};
+uint8_t compartmentCount = 0;                       // 0: single-scale DATA format
+float compartmentWeights[MAX_COMPARTMENTS] = {0.0}; // Smoothed (real) or simulated weights (g)
+// Compartments are read one per loop pass with a short average, so the loop (serial commands,
+// DATA pacing) is not held up by several full 12-sample reads in a row.
+const uint8_t COMPARTMENT_READ_SAMPLES = 3;
+uint8_t nextCompartment = 0;
+
 // 添加测量模式标志
 bool isMeasuringMode = false;
 unsigned long lastWeightDisplayTime = 0;
@@ -140,6 +175,15 @@ void loop() {
       simulatedWeight = simulatedWeight * 0.7 + newWeight * 0.3;
     }
     
+    if (compartmentCount > 0) {
+      if (nextCompartment >= compartmentCount) nextCompartment = 0;
+      float reading = compartmentScales[nextCompartment].readWeight(COMPARTMENT_READ_SAMPLES);
+      if (reading >= 0 && reading < 1000) {
+        compartmentWeights[nextCompartment] = compartmentWeights[nextCompartment] * 0.7 + reading * 0.3;
+      }
+      nextCompartment++;
+    }
+
     // Display weight in real-time during measurement mode
     if (isMeasuringMode && (millis() - lastWeightDisplayTime >= weightDisplayInterval)) {
       lastWeightDisplayTime = millis();
@@ -164,7 +208,11 @@ void loop() {
   // Periodically send current status to PC
   if (millis() - lastSerialSendTime >= serialSendInterval) {
     lastSerialSendTime = millis();
-    sendDataToPC();
+    if (binaryDataFormat) {
+      sendDataFrameToPC();
+    } else {
+      sendDataToPC();
+    }
   }
   delay(10); // Short delay to keep loop stable
 
@@ -224,7 +272,61 @@ void sendDataToPC() {
   Serial.print(F(","));
   Serial.print(lidDistance);              // Distance between pillbox lid and sensor
   Serial.print(F(","));
-  Serial.println(lidDistance > 5 ? 1 : 0); // Distance > 5cm indicates open (1), otherwise closed (0)
+  Serial.print(lidDistance > 5 ? 1 : 0); // Distance > 5cm indicates open (1), otherwise closed (0)
+  // Per-compartment weights
+  for (uint8_t i = 0; i < compartmentCount; i++) {
+    Serial.print(i == 0 ? F(",") : F(";"));
+    Serial.print(compartmentWeights[i], 2);
+  }
+  Serial.println();
+}
+
+uint16_t crc16Ccitt(const uint8_t* data, size_t len) {
+  uint16_t crc = 0xFFFF;
+  for (size_t i = 0; i < len; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+void sendDataFrameToPC() {
+  float rawWeight = 0.0;
+  if (!isSimulationMode) {
+    rawWeight = MyScale.readWeight();
+  } else {
+    rawWeight = simulatedWeight;
+  }
+  long lidDistance = ultrasonic.MeasureInCentimeters();
+
+  DataFrame frame;
+  frame.magic[0] = DATA_FRAME_MAGIC0;
+  frame.magic[1] = DATA_FRAME_MAGIC1;
+  frame.seq = dataFrameSeq++;
+  frame.stage = (uint8_t)currentStage;
+  frame.flags = lidDistance > 5 ? 0x01 : 0x00;
+  frame.weight = rawWeight - boxTareOffset;
+  frame.pillCount = (int16_t)pill_count;
+  frame.weightPerPill = weight_per_pill;
+  frame.lidDistance = (int16_t)constrain(lidDistance, -32768L, 32767L);
+  if (compartmentCount == 0) {
+    frame.crc = crc16Ccitt((const uint8_t*)&frame.seq, sizeof(DataFrame) - 4);
+    Serial.write((const uint8_t*)&frame, sizeof(DataFrame));
+    return;
+  }
+  // Compartment frame: DataFrame without its CRC, count, weights, CRC over seq..weights
+  uint8_t buffer[sizeof(DataFrame) + 1 + MAX_COMPARTMENTS * sizeof(float)];
+  frame.magic[1] = COMPARTMENT_FRAME_MAGIC1;
+  size_t length = sizeof(DataFrame) - 2;
+  memcpy(buffer, &frame, length);
+  buffer[length++] = compartmentCount;
+  memcpy(buffer + length, compartmentWeights, compartmentCount * sizeof(float));
+  length += compartmentCount * sizeof(float);
+  uint16_t crc = crc16Ccitt(buffer + 2, length - 2);
+  memcpy(buffer + length, &crc, sizeof(crc));
+  Serial.write(buffer, length + sizeof(crc));
 }
 
 // 检查串口输入
@@ -489,6 +591,45 @@ void processCommand(const char* command) {
     lcd.setCursor(0,1);
     lcd.print(nextMedicationTime);
   }
+  else if (commandStartsWith(command, "SET_DATA_FORMAT:")) {
+    // 0: text DATA lines, 1: binary DataFrame
+    binaryDataFormat = (extractInt(command, 16) == 1);
+    dataFrameSeq = 0;
+    Serial.print(F("DATA_FORMAT:")); Serial.println(binaryDataFormat ? 1 : 0);
+  }
+  else if (commandStartsWith(command, "SET_DATA_INTERVAL:")) {
+    long interval = extractInt(command, 18);
+    if (interval >= 20) {
+      serialSendInterval = interval;
+    }
+    Serial.print(F("DATA_INTERVAL:")); Serial.println(serialSendInterval);
+  }
+  else if (commandStartsWith(command, "SET_COMPARTMENTS:")) {
+    // Number of compartment scales to read and report (0 disables)
+    int count = extractInt(command, 17);
+    count = constrain(count, 0, MAX_COMPARTMENTS);
+    for (uint8_t i = compartmentCount; i < count; i++) {
+      compartmentWeights[i] = 0.0;
+      if (!isSimulationMode && compartmentScales[i].begin()) {
+        compartmentScales[i].setCalibration(2236.f);
+        compartmentScales[i].peel();
+      }
+    }
+    compartmentCount = count;
+    Serial.print(F("COMPARTMENTS:")); Serial.println(compartmentCount);
+  }
+  else if (isSimulationMode && commandStartsWith(command, "SET_COMPARTMENT_WEIGHT:")) {
+    // SET_COMPARTMENT_WEIGHT:<index>:<grams>
+    int index = extractInt(command, 23);
+    const char* separator = strchr(command + 23, ':');
+    if (index >= 0 && index < compartmentCount && separator != NULL) {
+      compartmentWeights[index] = atof(separator + 1);
+      Serial.print(F("Compartment ")); Serial.print(index); Serial.print(F(" simulated weight set to: "));
+      Serial.println(compartmentWeights[index], 2);
+    } else {
+      Serial.println(F("Invalid compartment"));
+    }
+  }
   else if (commandStartsWith(command, "PLAY_REMINDER")) {
     // Play reminder music for 3 seconds
     playTrack(0x02);
@@ -0,0 +1,77 @@
+"""Shared fixtures: app.py imported against a temporary history database, and one emulated pillbox
+(arduino_emulator.py on a pty, in this process) for the tests that need a serial peer."""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORKDIR = tempfile.mkdtemp(prefix="pillbox-tests-")
+EMULATOR_LINK = os.path.join(WORKDIR, "pillbox")
+
+sys.path.insert(0, ROOT)
+# app.py reads its configuration at import time
+os.environ.update({
+    "PILLBOX_DEVICES": f"box={EMULATOR_LINK}",
+    "HISTORY_DB": os.path.join(WORKDIR, "history.db"),
+    "CLOUD_SERVER_URL": "",
+    "PILLBOX_DATA_FORMAT": "text",
+    "PILLBOX_DATA_INTERVAL_MS": "50",
+})
+for name in ("PILLBOX_COMPARTMENTS", "INVENTORY_SNAPSHOT_EVERY", "ADHERENCE_TOLERANCE"):
+    os.environ.pop(name, None)
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    from pyngrok import ngrok
+    with pytest.MonkeyPatch.context() as patch:
+        # app.py stores the ngrok token at import; tests never open a tunnel
+        patch.setattr(ngrok, "set_auth_token", lambda *args, **kwargs: None)
+        import app
+    return app
+
+
+@pytest.fixture(scope="session")
+def emulator():
+    pytest.importorskip("pty")
+    import arduino_emulator
+    box = arduino_emulator.EmulatedPillbox()
+    box.send_interval = 0.05
+    emulator = arduino_emulator.PtyEmulator(box, link=EMULATOR_LINK, baud=0)
+    emulator.open()
+    thread = threading.Thread(target=emulator.run, daemon=True)
+    thread.start()
+    yield emulator
+    emulator.stopped.set()
+    thread.join(timeout=2)
+
+
+@pytest.fixture(scope="session")
+def device(app_module, emulator):
+    """The app's pillbox, connected to the emulator and reporting DATA."""
+    device = app_module.devices["box"]
+    device.start()
+    deadline = time.monotonic() + 15
+    while device.state.snapshot().arduino_raw_state["stage_name"] in ("Initializing", "Disconnected"):
+        if time.monotonic() > deadline:
+            pytest.fail("Emulated pillbox did not connect")
+        time.sleep(0.05)
+    return device
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def wait_for(condition, timeout=5.0, interval=0.02):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(interval)
+    return True
@@ -0,0 +1,104 @@
+"""match_doses and the /api/adherence day bucketing and cache."""
+from datetime import datetime, timedelta
+
+import pytest
+
+HOUR = 3600
+
+
+def day_start(days_ago):
+    return int(datetime.combine(datetime.now().date() - timedelta(days=days_ago), datetime.min.time()).timestamp())
+
+
+def test_match_doses_is_a_greedy_sorted_merge(app_module):
+    expected = [100, 200, 300, 400]
+    doses = [10, 95, 190, 210, 460]
+    matches, used = app_module.match_doses(expected, doses, 20)
+    assert matches == [(100, 95), (200, 190), (300, None), (400, None)]
+    assert used == {1, 2}  # 10 too early, 210 left over after 190 took the 200 dose, 460 too late
+
+
+def test_match_doses_uses_each_dose_once(app_module):
+    matches, used = app_module.match_doses([100, 110], [105], 20)
+    assert matches == [(100, 105), (110, None)]
+    assert used == {0}
+
+
+@pytest.fixture
+def history(app_module):
+    inserted = []
+
+    def add(timestamp, medication, pills=1):
+        inserted.append(app_module.db.write(
+            'INSERT INTO history (medication_name, pills_consumed, weight_consumed, session_duration, timestamp, device_id) '
+            'VALUES (?, ?, ?, ?, ?, ?)', (medication, pills, 0.25 * pills, 10, timestamp, 'box')).result(timeout=5))
+    yield add
+    app_module.db.write(f"DELETE FROM history WHERE id IN ({','.join(map(str, inserted)) or '0'})").result(timeout=5)
+
+
+@pytest.fixture
+def reminder(app_module, client):
+    created = []
+
+    def add(**fields):
+        response = client.post('/api/reminders', json=fields)
+        assert response.status_code == 200
+        created.append(response.json["id"])
+    yield add
+    for reminder_id in created:
+        app_module.db.write('DELETE FROM reminders WHERE id = ?', (reminder_id,)).result(timeout=5)
+
+
+def test_dose_before_midnight_counts_once(client, history, reminder):
+    first = day_start(5)
+    reminder(medication_name="Midnight", start_datetime=first, end_datetime=first + 3 * 86400 - 1,
+             frequency_type='daily', frequency_value=1)
+    history(first + 600, "Midnight")            # Day 0, 00:10
+    history(first + 86400 - 600, "Midnight")    # Day 0, 23:50 for day 1's 00:00 reminder
+    response = client.get(f'/api/adherence?from={first}&to={first + 3 * 86400 - 1}&medication=Midnight')
+    assert response.status_code == 200
+    days = [day["medications"].get("Midnight") for day in response.json["days"]]
+    assert [(d["expected"], d["taken"], d["missed"], d["extra"]) for d in days] == [(1, 1, 0, 0), (1, 1, 0, 0), (1, 0, 1, 0)]
+    assert response.json["summary"]["Midnight"]["adherence"] == pytest.approx(2 / 3, abs=1e-4)
+
+
+def test_new_history_refreshes_cached_days(client, history, reminder):
+    first = day_start(4)
+    reminder(medication_name="Interval", start_datetime=first + 8 * HOUR, end_datetime=first + 86400 - 1,
+             frequency_type='interval', frequency_value=8)
+    history(first + 8 * HOUR + 300, "Interval")
+    history(first + 12 * HOUR, "Interval")      # Between reminders: extra
+    query = f'/api/adherence?from={first}&to={first + 86400 - 1}&medication=Interval&details=1'
+    summary = client.get(query).json["summary"]["Interval"]
+    assert (summary["expected"], summary["taken"], summary["missed"], summary["extra"]) == (2, 1, 1, 1)
+
+    history(first + 16 * HOUR - 900, "Interval")
+    day = client.get(query).json["days"][0]["medications"]["Interval"]
+    assert (day["taken"], day["missed"]) == (2, 0)
+    assert [dose["status"] for dose in day["doses"]] == ["taken", "taken"]
+
+
+def test_new_dose_shifts_matches_on_later_cached_days(client, history, reminder):
+    first = day_start(5)
+    reminder(medication_name="Chain", start_datetime=first, end_datetime=first + 3 * 86400 - 1,
+             frequency_type='daily', frequency_value=1)
+    for day in range(3):
+        history(first + day * 86400 + 5 * HOUR, "Chain")
+    # Windows overlap at this tolerance, so each 05:00 dose can match its own day's or the next day's reminder
+    query = f'/api/adherence?from={first}&to={first + 3 * 86400 - 1}&medication=Chain&tolerance={20 * HOUR}'
+
+    def counts():
+        days = [day["medications"]["Chain"] for day in client.get(query).json["days"]]
+        return [(d["taken"], d["extra"]) for d in days]
+    assert counts() == [(1, 0), (1, 0), (1, 0)]
+
+    # An earlier dose on day 0 takes day 0's reminder and pushes every later match back a day,
+    # so the last 05:00 dose, two cached days later, is left over
+    history(first + 4 * HOUR + 1800, "Chain")
+    assert counts() == [(1, 0), (1, 0), (1, 1)]
+
+
+def test_adherence_rejects_bad_ranges(client):
+    assert client.get('/api/adherence?from=abc').status_code == 400
+    assert client.get('/api/adherence?from=1000000&to=10').status_code == 400
+    assert client.get('/api/adherence?tolerance=-5').status_code == 400
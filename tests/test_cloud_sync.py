@@ -0,0 +1,142 @@
+"""CloudSyncWorker against a local HTTP stub: drain on 2xx, back off on 5xx and refused
+connections, and keep every record in the outbox across a restart."""
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import wait_for
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+            self.server.posts.append((time.monotonic(), status, body["records"]))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.statuses = []  # Status codes for the next POSTs, then 200
+    server.posts = []     # (received_at, status, records)
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/api/consumption"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cloud(app_module, stub, monkeypatch):
+    monkeypatch.setattr(app_module, "CLOUD_SERVER_URL", stub.url)
+    monkeypatch.setattr(app_module, "CLOUD_SYNC_BATCH_SIZE", 2)
+    monkeypatch.setattr(app_module, "CLOUD_SYNC_BACKOFF_BASE", 0.2)
+    monkeypatch.setattr(app_module, "CLOUD_SYNC_TIMEOUT", (1, 2))
+    app_module.db.write('DELETE FROM cloud_outbox').result(timeout=5)
+    yield app_module
+    app_module.db.write('DELETE FROM cloud_outbox').result(timeout=5)
+
+
+@pytest.fixture
+def running(cloud):
+    """Start a worker's run loop; it has no stop, so it is left with nothing to send afterwards."""
+    workers = []
+
+    def start():
+        workers.append(cloud.CloudSyncWorker())
+        threading.Thread(target=workers[-1].run, daemon=True).start()
+        return workers[-1]
+    yield start
+    for worker in workers:
+        worker.send_pending_batch = lambda: 0
+
+
+def enqueue(app_module, worker, n):
+    for i in range(n):
+        worker.enqueue({"medication_name": f"Med{i}", "pills_consumed": 1})
+    app_module.db.write('SELECT 1').result(timeout=5)  # Outbox inserts are queued; wait for them
+
+
+def outbox(app_module):
+    return app_module.db.query('SELECT id, attempts FROM cloud_outbox ORDER BY id')
+
+
+def sent_records(stub, status=200):
+    return [record for _, code, records in stub.posts if code == status for record in records]
+
+
+def test_outbox_drains_on_2xx(cloud, stub, running):
+    worker = running()
+    enqueue(cloud, worker, 5)
+    assert wait_for(lambda: not outbox(cloud))
+    assert all(len(records) <= 2 for _, _, records in stub.posts)  # CLOUD_SYNC_BATCH_SIZE per POST
+    assert [record["medication_name"] for record in sent_records(stub)] == [f"Med{i}" for i in range(5)]
+    assert all("outbox_id" in record for record in sent_records(stub))
+    assert (worker.records_sent, worker.batches_sent, worker.consecutive_failures) == (5, len(stub.posts), 0)
+
+
+def test_server_errors_back_off_and_keep_the_records(cloud, stub):
+    stub.statuses = [500, 503]
+    worker = cloud.CloudSyncWorker()
+    enqueue(cloud, worker, 1)
+    assert worker.send_pending_batch() is None
+    first_delay = worker.next_attempt_at - time.time()
+    assert worker.send_pending_batch() is None
+    assert worker.next_attempt_at - time.time() > first_delay * 1.5  # Exponential backoff
+    cloud.db.write('SELECT 1').result(timeout=5)
+    assert [attempts for _, attempts in outbox(cloud)] == [2]
+    assert worker.status()["consecutive_failures"] == 2 and "503" in worker.last_error
+    assert worker.send_pending_batch() == 1
+    assert not outbox(cloud) and worker.consecutive_failures == 0
+
+
+def test_worker_retries_after_the_backoff(cloud, stub, running):
+    stub.statuses = [502]
+    worker = running()
+    enqueue(cloud, worker, 1)
+    assert wait_for(lambda: not outbox(cloud))
+    (failed_at, first, _), (retried_at, second, records) = stub.posts
+    assert (first, second) == (502, 200)
+    assert retried_at - failed_at >= cloud.CLOUD_SYNC_BACKOFF_BASE * 0.9
+    assert records[0]["medication_name"] == "Med0"
+
+
+def test_connection_refused_keeps_the_records(cloud, monkeypatch):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        closed_port = probe.getsockname()[1]
+    monkeypatch.setattr(cloud, "CLOUD_SERVER_URL", f"http://127.0.0.1:{closed_port}/api/consumption")
+    worker = cloud.CloudSyncWorker()
+    enqueue(cloud, worker, 3)
+    assert worker.send_pending_batch() is None
+    assert worker.consecutive_failures == 1 and worker.next_attempt_at > time.time()
+    cloud.db.write('SELECT 1').result(timeout=5)
+    assert [attempts for _, attempts in outbox(cloud)] == [1, 1, 0]
+
+
+def test_nothing_is_lost_across_a_restart(cloud, stub):
+    stub.statuses = [500]
+    before = cloud.CloudSyncWorker()
+    enqueue(cloud, before, 3)
+    queued_ids = [row_id for row_id, _ in outbox(cloud)]
+    assert before.send_pending_batch() is None  # The server fails, then the process "restarts"
+
+    after = cloud.CloudSyncWorker()
+    while after.send_pending_batch():
+        pass
+    assert not outbox(cloud)
+    # Every record arrives exactly once, with the outbox ids the server uses to drop duplicates
+    assert [record["outbox_id"] for record in sent_records(stub)] == queued_ids
+    assert [record["outbox_id"] for record in sent_records(stub, 500)] == queued_ids[:2]
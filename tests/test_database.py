@@ -0,0 +1,59 @@
+"""Database writer queue: group commit of queued writes, and per-statement savepoint rollback."""
+import sqlite3
+from concurrent.futures import Future
+
+import pytest
+
+
+@pytest.fixture
+def database(app_module, tmp_path):
+    """A Database on its own file, with every statement the writer connection runs recorded."""
+    database = app_module.Database(str(tmp_path / "writer.db"))
+    setup = database.open_connection(isolation_level=None)
+    setup.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+    setup.close()
+    statements = []
+    open_connection = database.open_connection
+
+    def traced(isolation_level=''):
+        connection = open_connection(isolation_level)
+        if isolation_level is None:  # The writer's connection
+            connection.set_trace_callback(statements.append)
+        return connection
+    database.open_connection = traced
+    return database, statements
+
+
+def queue_writes(database, writes):
+    """Queue writes before the writer starts, so they are drained as one batch."""
+    futures = []
+    for sql, params, many in writes:
+        futures.append(Future())
+        database.writes.put((sql, params, many, futures[-1]))
+    database._ensure_writer()
+    return futures
+
+
+def test_queued_writes_share_one_commit(database):
+    database, statements = database
+    futures = queue_writes(database, [('INSERT INTO items (name) VALUES (?)', (f"item{i}",), False) for i in range(5)])
+    assert [future.result(timeout=5) for future in futures] == [1, 2, 3, 4, 5]
+    assert statements.count('BEGIN') == 1 and statements.count('COMMIT') == 1
+    assert database.query_one('SELECT COUNT(*) FROM items') == (5,)
+
+
+def test_failed_statement_is_rolled_back_alone(database):
+    database, statements = database
+    futures = queue_writes(database, [
+        ('INSERT INTO items (name) VALUES (?)', ("a",), False),
+        ('INSERT INTO items (name) VALUES (?)', [("b",), ("a",)], True),  # Fails on its second row
+        ('INSERT INTO items (name) VALUES (?)', ("c",), False),
+    ])
+    assert futures[0].result(timeout=5) == 1
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5) is not None
+    # "b" went in with the failing statement and was rolled back with it; the batch still committed
+    assert [name for (name,) in database.query('SELECT name FROM items ORDER BY id')] == ["a", "c"]
+    assert statements.count('ROLLBACK TO queued_write') == 1 and statements.count('COMMIT') == 1
+    assert database.write('INSERT INTO items (name) VALUES (?)', ("d",)).result(timeout=5) is not None
@@ -0,0 +1,48 @@
+"""/api/history/summary: calendar-day window, device filter and table-version ETag."""
+import time
+
+import pytest
+
+
+@pytest.fixture
+def history(app_module):
+    inserted = []
+
+    def add(timestamp, medication, device_id, pills=1):
+        inserted.append(app_module.db.write(
+            'INSERT INTO history (medication_name, pills_consumed, weight_consumed, session_duration, timestamp, device_id) '
+            'VALUES (?, ?, ?, ?, ?, ?)', (medication, pills, 0.25 * pills, 10, timestamp, device_id)).result(timeout=5))
+    yield add
+    app_module.db.write(f"DELETE FROM history WHERE id IN ({','.join(map(str, inserted)) or '0'})").result(timeout=5)
+
+
+def summary_for(response, medication):
+    return next(m for m in response.json["medications"] if m["medication_name"] == medication)
+
+
+def test_summary_filters_by_device(client, history):
+    now = int(time.time())
+    history(now - 60, "Summary", "ward1", pills=2)
+    history(now - 86400, "Summary", "ward1")
+    history(now - 60, "Summary", "ward2", pills=5)
+    response = client.get('/api/history/summary?days=4&device=ward1&medication=Summary')
+    assert response.status_code == 200
+    row = summary_for(response, "Summary")
+    assert (row["sessions"], row["pills_consumed"], row["active_days"]) == (2, 3, 2)
+    assert row["active_day_ratio"] == pytest.approx(0.5)
+    assert "adherence" not in row
+    assert summary_for(client.get('/api/history/summary?days=4&medication=Summary'), "Summary")["pills_consumed"] == 8
+
+
+def test_summary_is_served_with_a_table_etag(client, history):
+    first = client.get('/api/history/summary')
+    assert first.headers['ETag']
+    assert client.get('/api/history/summary', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    history(int(time.time()), "Summary", "box")
+    changed = client.get('/api/history/summary', headers={'If-None-Match': first.headers['ETag']})
+    assert changed.status_code == 200
+    assert summary_for(changed, "Summary")["sessions"] >= 1
+
+
+def test_summary_rejects_bad_days(client):
+    assert client.get('/api/history/summary?days=0').status_code == 400
@@ -0,0 +1,109 @@
+"""DFRobot_HX711_I2C_Bus scheduling over FakeSMBus: interleaving, per-module rate, retare and failures."""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "libraries", "DFRobot_HX711_I2C", "python", "raspberrypi"))
+from DFRobot_HX711_I2C import DFRobot_HX711_I2C, DFRobot_HX711_I2C_Bus, FakeSMBus  # noqa: E402
+
+ADDRESSES = (0x64, 0x65, 0x66, 0x67)
+LOADS = {0x64: 10.0, 0x65: 20.0, 0x66: 30.0, 0x67: 40.0}
+
+
+@pytest.fixture
+def bus():
+    return FakeSMBus(LOADS)
+
+
+@pytest.fixture
+def scheduler(bus):
+    scheduler = DFRobot_HX711_I2C_Bus(bus, ADDRESSES, flag_interval=0.05)
+    scheduler.begin()
+    yield scheduler
+    scheduler.stop()
+
+
+def run_for(scheduler, seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        scheduler.run_once()
+
+
+def test_requests_are_interleaved(bus, scheduler):
+    del bus.transactions[:]
+    run_for(scheduler, 0.3)
+    # While one module converts, the others are requested or read: between a module's request
+    # and the read that answers it there are transfers to other modules
+    requested_at = {}
+    answers = []
+    for index, (_, _, address, kind) in enumerate(bus.transactions):
+        if kind == 'write':
+            requested_at[address] = index
+        elif address in requested_at:
+            between = bus.transactions[requested_at.pop(address) + 1:index]
+            answers.append(any(a != address for _, _, a, _ in between))
+    assert len(answers) > 20
+    assert sum(answers) >= 0.9 * len(answers)
+    # No two transfers ever overlap on the bus
+    for (_, end, _, _), (start, _, _, _) in zip(bus.transactions, bus.transactions[1:]):
+        assert start >= end
+
+
+def test_every_module_is_sampled_faster_than_sequential_reads(scheduler):
+    run_for(scheduler, 1.0)
+    sequential_rate = 1.0 / (len(ADDRESSES) * DFRobot_HX711_I2C.SETTLE_TIME)
+    rates = scheduler.rates()
+    for address in ADDRESSES:
+        assert rates[address]["rate_hz"] > 1.5 * sequential_rate
+        assert rates[address]["errors"] == 0
+    slowest = min(r["rate_hz"] for r in rates.values())
+    fastest = max(r["rate_hz"] for r in rates.values())
+    assert slowest > 0.7 * fastest
+
+
+def test_weights_are_relative_to_the_tare(bus, scheduler):
+    bus.weights[0x65] += 5.0
+    run_for(scheduler, 0.3)
+    weights = scheduler.read_weights()
+    assert weights[0x65] == pytest.approx(5.0, abs=0.01)
+    for address in (0x64, 0x66, 0x67):
+        assert weights[address] == pytest.approx(0.0, abs=0.01)
+
+
+def test_peel_flag_retares_only_that_module(bus, scheduler):
+    for address in ADDRESSES:
+        bus.weights[address] += 3.0
+    run_for(scheduler, 0.2)
+    bus.peel_flags[0x66] = 1
+    run_for(scheduler, 0.5)
+    weights = scheduler.read_weights()
+    assert weights[0x66] == pytest.approx(0.0, abs=0.01)
+    for address in (0x64, 0x65, 0x67):
+        assert weights[address] == pytest.approx(3.0, abs=0.01)
+
+
+def test_calibration_flag_reloads_the_calibration(bus, scheduler):
+    bus.calibration = 1000.0
+    bus.peel_flags[0x64] = 2
+    run_for(scheduler, 0.3)
+    assert scheduler.sensors[0x64]._calibration == pytest.approx(1000.0)
+    assert scheduler.sensors[0x65]._calibration == pytest.approx(2210.0)
+
+
+def test_missing_module_fails_begin_but_not_the_others():
+    bus = FakeSMBus({0x64: 10.0, 0x65: 20.0})
+    scheduler = DFRobot_HX711_I2C_Bus(bus, ADDRESSES)
+    with pytest.raises(IOError, match="0x66, 0x67"):
+        scheduler.begin(timeout=0.3)
+    scheduler.start()
+    try:
+        time.sleep(0.5)
+        assert scheduler._thread.is_alive()
+        rates = scheduler.rates()
+        assert rates[0x64]["samples"] > 0 and rates[0x65]["samples"] > 0
+        assert rates[0x66]["errors"] > 0 and rates[0x66]["samples"] == 0
+        assert scheduler.read_weights()[0x67] is None
+    finally:
+        scheduler.stop()
@@ -0,0 +1,93 @@
+"""DFRobot_HX711_I2C fast read path over FakeSMBus: one register request per reading, then plain reads."""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "libraries", "DFRobot_HX711_I2C", "python", "raspberrypi"))
+import DFRobot_HX711_I2C as driver  # noqa: E402
+
+ADDRESS = 0x64
+LOAD = 12.5
+
+
+@pytest.fixture
+def bus():
+    return driver.FakeSMBus({ADDRESS: LOAD}, conversion_time=0.02)
+
+
+def sensor_on(bus, **options):
+    sensor = driver.DFRobot_HX711_I2C(bus, ADDRESS, fast=True, **options)
+    sensor._offset = bus.offset
+    sensor._calibration = bus.calibration
+    return sensor
+
+
+def kinds(bus):
+    return [kind for _, _, address, kind in bus.transactions if address == ADDRESS]
+
+
+def test_fake_block_read_restarts_the_conversion(bus):
+    # An SMBus block read writes the register first, so polling with it never sees the answer
+    deadline = time.monotonic() + 0.1
+    while time.monotonic() < deadline:
+        assert bus.read_i2c_block_data(ADDRESS, driver.DFRobot_HX711_I2C.REG_DATA_GET_RAM_DATA, 4)[0] == 0
+        time.sleep(0.002)
+
+
+def test_polling_uses_plain_reads_after_one_request(bus):
+    if driver.smbus2 is None:
+        pytest.skip("plain reads (i2c_rdwr) need smbus2")
+    sensor = sensor_on(bus)
+    assert sensor.plain_reads
+    assert sensor.to_weight(sensor.get_value()) == pytest.approx(LOAD, abs=0.001)
+    transfers = kinds(bus)
+    assert transfers.count('write') == 1 and transfers[0] == 'write'
+    assert transfers.count('read') > 1  # Polled while converting, without re-sending the register
+
+
+def test_without_plain_reads_the_answer_is_read_once_after_settling(bus):
+    sensor = sensor_on(bus)
+    sensor.plain_reads = False
+    for _ in range(3):
+        assert sensor.to_weight(sensor.get_value()) == pytest.approx(LOAD, abs=0.001)
+    assert kinds(bus) == ['write', 'read', 'read', 'read', 'read'] * 3
+
+
+@pytest.fixture
+def sampled(bus):
+    sensor = sensor_on(bus, sample_rate=200)
+    sensor.FAILURE_BACKOFF = 0.05
+    yield sensor
+    sensor.stop_sampler()
+
+
+def test_stop_works_while_no_frame_is_ready(sampled, bus):
+    bus.conversion_time = 60.0  # The module never has an answer
+    assert not sampled.start_sampler(timeout=0.1)
+    started = time.monotonic()
+    assert sampled.stop_sampler()
+    assert time.monotonic() - started < 0.5
+
+
+def test_sampler_survives_io_errors_and_never_serves_a_stale_window(sampled, bus):
+    assert sampled.start_sampler()
+    assert sampled.read_weight(5) == pytest.approx(LOAD, abs=0.001)
+    del bus.weights[ADDRESS]  # Unplugged
+    deadline = time.monotonic() + 2
+    while not sampled.sampler_failures and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sampled.sampler_errors > 0 and "Remote I/O error" in sampled.sampler_error
+    with pytest.raises(IOError):
+        sampled.read_weight(5)  # Read directly instead of returning the last good window
+
+    bus.weights[ADDRESS] = 20.0  # Plugged back in with a new load
+    deadline = time.monotonic() + 2
+    while sampled.sampler_failures and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sampled._sampler.is_alive() and not sampled.sampler_failures
+    recovered_at = sampled._written
+    while sampled._written < recovered_at + 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sampled.read_weight(5) == pytest.approx(20.0, abs=0.001)
@@ -0,0 +1,87 @@
+"""InventoryJournal: change log replay, compaction into snapshots, and restore into a fresh state."""
+import itertools
+
+import pytest
+
+_ids = itertools.count()
+
+
+@pytest.fixture
+def journal(app_module):
+    """A fresh state journaled under its own device id, and a way to restore a copy of it."""
+    device_id = f"journal-{next(_ids)}"
+    state = app_module.PillboxState()
+    journal = app_module.InventoryJournal(device_id)
+    state.on_inventory_change = journal.record
+
+    def restore():
+        app_module.db.write('SELECT 1').result(timeout=5)  # Journal writes are queued; wait for them
+        restored = app_module.PillboxState()
+        found = app_module.InventoryJournal(device_id).restore(restored)
+        return found, restored.snapshot()
+    return state, journal, restore
+
+
+def test_restore_replays_the_change_log(journal):
+    state, _, restore = journal
+    with state.edit_inventory():
+        state.current_mode_is_simulation = False
+        state.pc_managed_medication_details.add("A", 0.25, 10.0, 40)
+        state.pc_managed_medication_details.add("B", 0.5, 5.0, 10, 0.3, 2)
+        state.pc_active_medication_name = "B"
+    with state.edit_inventory():
+        state.pc_managed_medication_details["A"]["count_in_box"] = 38
+    found, snap = restore()
+    assert found
+    assert not snap.current_mode_is_simulation
+    assert snap.pc_active_medication_name == "B"
+    assert snap.pc_managed_medication_details.to_dict() == state.snapshot().pc_managed_medication_details.to_dict()
+
+
+def test_removal_and_clear_are_replayed(journal):
+    state, _, restore = journal
+    with state.edit_inventory():
+        for name in ("A", "B", "C"):
+            state.pc_managed_medication_details.add(name, 0.25)
+        state.pc_active_medication_name = "B"
+    with state.edit_inventory():
+        state.pc_managed_medication_details.clear()
+        state.pc_managed_medication_details.add("C", 0.1)
+    _, snap = restore()
+    assert list(snap.pc_managed_medication_details) == ["C"]
+    assert snap.pc_managed_medication_details["C"]["wpp"] == pytest.approx(0.1)
+
+
+def test_compaction_keeps_the_state(app_module, journal, monkeypatch):
+    monkeypatch.setattr(app_module, "INVENTORY_SNAPSHOT_EVERY", 3)
+    state, writer, restore = journal
+    with state.edit_inventory():
+        state.pc_managed_medication_details.add("A", 0.25, 25.0, 100)
+    for count in range(99, 90, -1):
+        with state.edit_inventory():
+            state.pc_managed_medication_details["A"]["count_in_box"] = count
+    found, snap = restore()
+    assert found
+    assert snap.pc_managed_medication_details["A"]["count_in_box"] == 91
+    log_rows = app_module.db.query_one('SELECT COUNT(*) FROM inventory_log WHERE device_id = ?', (writer.device_id,))[0]
+    assert log_rows < 3
+
+
+def test_snapshots_without_newer_fields_get_defaults(app_module, journal):
+    state, writer, restore = journal
+    # A snapshot written before the tolerance and compartment columns existed
+    app_module.db.write('INSERT INTO inventory_snapshot (device_id, log_id, taken_at, state) VALUES (?, 0, 0, ?)',
+                        (writer.device_id, '{"is_simulation": true, "active": "A", "columns": '
+                         '{"names": ["A"], "wpp": [0.25], "total_weight_in_box": [2.5], "count_in_box": [10]}}'))
+    _, snap = restore()
+    row = snap.pc_managed_medication_details["A"]
+    assert (row["count_in_box"], row["compartment"]) == (10, -1)
+    assert row["tolerance"] == pytest.approx(app_module.DEFAULT_PILL_TOLERANCE)
+    assert snap.pc_active_medication_name == "A"
+
+
+def test_nothing_to_restore(journal):
+    _, _, restore = journal
+    found, snap = restore()
+    assert not found
+    assert len(snap.pc_managed_medication_details) == 0
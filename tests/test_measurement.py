@@ -0,0 +1,123 @@
+"""MeasurementJob lifecycle against a scripted Arduino: outlier rejection, failures and cancellation."""
+import itertools
+import statistics
+import threading
+import time
+
+import pytest
+
+from conftest import wait_for
+
+MED = "MeasureMed"
+_ids = itertools.count()
+
+
+class ScriptedArduino:
+    """Stands in for the serial link: records commands and answers MEASURE_SINGLE_PILL_WEIGHT with
+    the next scripted round of readings (None: the round never finishes)."""
+    def __init__(self, rounds):
+        self.rounds = list(rounds)
+        self.commands = []
+        self.job = None
+
+    def send(self, device, command):
+        self.commands.append(command)
+        if command == "MEASURE_SINGLE_PILL_WEIGHT":
+            threading.Thread(target=self.measure, args=(self.rounds.pop(0),), daemon=True).start()
+        return True
+
+    def send_many(self, device, commands):
+        for command in commands:
+            self.send(device, command)
+        return True
+
+    def measure(self, readings):
+        self.job.feed("Starting single pill weight measurement, please wait...")
+        for i, reading in enumerate(readings or []):
+            time.sleep(0.005)
+            self.job.feed(f"Measurement sample {i + 1}: {reading:.3f}g")
+        if readings:
+            self.job.feed(f"Measured single pill weight for '{MED}': {statistics.fmean(readings):.3f}g")
+        elif readings is not None:
+            self.job.feed("Error: Measured weight too small or invalid (< 0.0001g)")
+
+
+@pytest.fixture
+def measure(app_module, monkeypatch):
+    """Run a job for MED on a fresh, unconnected device whose Arduino answers with `rounds`."""
+    def start(rounds, active=False):
+        device = app_module.PillboxDevice(f"measure-{next(_ids)}", "unused")
+        monkeypatch.setitem(app_module.devices, device.device_id, device)
+        with device.state.edit_inventory():
+            device.state.pc_managed_medication_details.add(MED, 0.25, 5.0, 20)
+            device.state.pc_active_medication_name = MED if active else None
+        arduino = ScriptedArduino(rounds)
+        monkeypatch.setattr(app_module, "send_to_arduino_command", arduino.send)
+        monkeypatch.setattr(app_module, "send_commands_to_arduino", arduino.send_many)
+        job = arduino.job = app_module.MeasurementJob(device, MED, len(rounds))
+        device.measurement_jobs[job.job_id] = device.measurement_job = job
+        thread = threading.Thread(target=job.run, daemon=True)
+        thread.start()
+        return device, job, arduino, thread
+    return start
+
+
+def wpp(device):
+    return device.state.snapshot().pc_managed_medication_details[MED]["wpp"]
+
+
+def test_outliers_are_rejected_and_the_wpp_applied(measure):
+    device, job, arduino, thread = measure([[0.200, 0.201, 0.950, 0.199, 0.200],
+                                            [0.202, 0.198, 0.200, 0.002, 0.201]], active=True)
+    thread.join(timeout=5)
+    assert job.status == "completed", job.error
+    assert sorted(job.result["rejected"]) == [0.002, 0.95]
+    assert (job.result["used"], job.result["samples"]) == (8, 10)
+    assert job.result["mean"] == pytest.approx(0.200125)
+    assert wpp(device) == pytest.approx(0.200125)
+    # 5 g recounted at the new WPP, and the Arduino gets the filtered value instead of its own plain mean
+    assert device.state.snapshot().pc_managed_medication_details[MED]["count_in_box"] == 25
+    assert arduino.commands == ["MEASURE_SINGLE_PILL_WEIGHT", "MEASURE_SINGLE_PILL_WEIGHT", "SET_PILL_WEIGHT:0.2001"]
+    assert job.to_dict()["wpp"] == pytest.approx(0.200125)
+
+
+def test_too_few_inliers_fails_without_changing_the_wpp(measure):
+    device, job, _, thread = measure([[0.20, 0.20, 0.20, 0.35, 0.50]])
+    thread.join(timeout=5)
+    assert job.status == "failed"
+    assert job.error == "Readings too unstable: only 3 of 5 samples agree"
+    assert sorted(job.result["rejected"]) == [0.35, 0.5]
+    assert job.to_dict()["wpp"] is None
+    assert wpp(device) == 0.25
+
+
+def test_arduino_error_fails_the_job(measure):
+    device, job, _, thread = measure([[]])
+    thread.join(timeout=5)
+    assert (job.status, job.error) == ("failed", "Error: Measured weight too small or invalid (< 0.0001g)")
+    assert wpp(device) == 0.25
+
+
+def test_cancel_stops_the_job_and_restores_the_arduino_wpp(app_module, measure):
+    device, job, arduino, thread = measure([None], active=True)
+    assert wait_for(lambda: arduino.commands == ["MEASURE_SINGLE_PILL_WEIGHT"])
+    client = app_module.app.test_client()
+    response = client.post(f'/devices/{device.device_id}/api/measurements/{job.job_id}/cancel')
+    assert response.status_code == 200
+    assert response.json["job"]["status"] == "cancelled"
+    thread.join(timeout=2)
+    assert not thread.is_alive()  # The round timeout is not waited out
+    assert arduino.commands == ["MEASURE_SINGLE_PILL_WEIGHT", "CANCEL_MEASURE", "SET_PILL_WEIGHT:0.2500"]
+    # Late lines from the cancelled round are not taken, and the WPP is untouched
+    assert not job.feed("Measured single pill weight for 'MeasureMed': 0.300g")
+    assert wpp(device) == 0.25
+    again = client.post(f'/devices/{device.device_id}/api/measurements/{job.job_id}/cancel')
+    assert again.status_code == 409
+
+
+def test_finished_job_cannot_be_cancelled(measure):
+    device, job, arduino, thread = measure([[0.25] * 5])
+    thread.join(timeout=5)
+    assert job.status == "completed"
+    assert not job.cancel()
+    assert job.status == "completed" and "CANCEL_MEASURE" not in arduino.commands
@@ -0,0 +1,35 @@
+"""reminder_occurrences expansion of interval and daily reminder rules."""
+from datetime import datetime, timedelta
+
+HOUR = 3600
+
+
+def day_start(days_ago):
+    return int(datetime.combine(datetime.now().date() - timedelta(days=days_ago), datetime.min.time()).timestamp())
+
+
+def rule(app_module, frequency_type, frequency_value, start, end, name="Med"):
+    return app_module.ReminderRule(1, name, start, end, frequency_type, frequency_value)
+
+
+def take(iterator, n):
+    return [next(iterator) for _ in range(n)]
+
+
+def test_interval_occurrences_follow_the_start(app_module):
+    start = day_start(10) + 8 * HOUR
+    r = rule(app_module, 'interval', 8, start, start + 2 * 86400)
+    assert take(app_module.reminder_occurrences(r, start - 1), 3) == [start, start + 8 * HOUR, start + 16 * HOUR]
+    # Strictly after `after`, and never past the end
+    assert next(app_module.reminder_occurrences(r, start)) == start + 8 * HOUR
+    assert list(app_module.reminder_occurrences(r, start + 2 * 86400)) == []
+
+
+def test_daily_occurrences_spread_over_the_day(app_module):
+    start = day_start(10) + 9 * HOUR  # Reminders before the start time on the first day are dropped
+    r = rule(app_module, 'daily', 3, start, day_start(8) + 23 * HOUR)
+    times = list(app_module.reminder_occurrences(r, 0))
+    first = day_start(10)
+    assert times == [first + 16 * HOUR,
+                     first + 86400, first + 86400 + 8 * HOUR, first + 86400 + 16 * HOUR,
+                     first + 2 * 86400, first + 2 * 86400 + 8 * HOUR, first + 2 * 86400 + 16 * HOUR]
@@ -0,0 +1,93 @@
+"""SerialLineFramer and binary DATA / compartment frame decoding against the emulator's encoder."""
+import binascii
+
+import pytest
+
+arduino_emulator = pytest.importorskip("arduino_emulator")  # Unix only (pty)
+
+
+@pytest.fixture
+def box():
+    box = arduino_emulator.EmulatedPillbox()
+    box.simulated_weight = 12.5
+    box.weight_per_pill = 0.25
+    box.pill_count = 50
+    return box
+
+
+def feed_bytewise(framer, payload):
+    units = []
+    for i in range(len(payload)):
+        units += framer.feed(payload[i:i + 1], float(i))
+    return [unit for unit, _ in units]
+
+
+def test_frame_crc_is_ccitt_false():
+    # CRC-16/CCITT-FALSE check value, the CRC project.ino computes over seq..lid distance
+    assert binascii.crc_hqx(b"123456789", 0xFFFF) == 0x29B1
+
+
+def test_data_frame_round_trip(app_module, box):
+    frame = app_module.decode_data_frame(memoryview(box.data_frame()))
+    assert frame is not None
+    assert (frame.seq, frame.stage_name, frame.weight, frame.pill_count) == (0, "Weighing", 12.5, 50)
+    assert frame.wpp == pytest.approx(0.25)
+    assert frame.compartments == ()
+
+
+def test_corrupt_frame_is_rejected(app_module, box):
+    payload = bytearray(box.data_frame())
+    payload[8] ^= 0x10
+    assert app_module.decode_data_frame(memoryview(payload)) is None
+
+
+def test_compartment_frame_decoding(app_module, box):
+    box.compartment_count = app_module.MAX_COMPARTMENTS
+    box.compartment_weights = [1.5, 2.25, 0.0]
+    payload = box.data_frame()
+    assert payload[:2] == app_module.COMPARTMENT_FRAME_MAGIC
+    assert app_module.data_frame_size(payload) == len(payload)
+    frame = app_module.decode_data_frame(memoryview(payload))
+    assert frame.compartments == (1.5, 2.25, 0.0)
+    assert frame.weight == 12.5
+
+
+def test_framer_splits_lines_and_frames(app_module, box):
+    framer = app_module.SerialLineFramer()
+    first, second = box.data_frame(), box.data_frame()
+    units = feed_bytewise(framer, b"Arduino received: GET_WEIGHT\r\n" + first + box.data_line() + second)
+    assert len(units) == 4
+    assert units[0] == "Arduino received: GET_WEIGHT"
+    assert [units[1].seq, units[3].seq] == [0, 1]
+    assert units[2].startswith("DATA:Weighing,12.50,50,")
+    assert framer.frames == 2 and framer.crc_errors == 0
+
+
+def test_framer_resyncs_after_corrupt_frames(app_module, box):
+    framer = app_module.SerialLineFramer()
+    corrupt = bytearray(box.data_frame())
+    corrupt[10] ^= 0xFF
+    bad_crc = bytearray(box.data_frame())
+    bad_crc[-1] ^= 0x01
+    good = box.data_frame()
+    units = feed_bytewise(framer, bytes(corrupt) + bytes(bad_crc) + b"\r\n" + good + b"OK\r\n")
+    frames = [unit for unit in units if isinstance(unit, app_module.DataFrame)]
+    assert [frame.seq for frame in frames] == [2]
+    assert units[-1] == "OK"
+    assert framer.crc_errors == 2
+
+
+def test_framer_resyncs_after_an_impossible_compartment_count(app_module, box):
+    framer = app_module.SerialLineFramer()
+    count = app_module.MAX_COMPARTMENTS + 1
+    impossible = app_module.COMPARTMENT_FRAME_MAGIC + bytes(app_module.COMPARTMENT_FRAME_HEADER.size - 3) + bytes([count])
+    units = feed_bytewise(framer, impossible + b"\r\n" + box.data_frame() + b"OK\r\n")
+    frames = [unit for unit in units if isinstance(unit, app_module.DataFrame)]
+    assert [frame.seq for frame in frames] == [0]
+    assert units[-1] == "OK"
+
+
+def test_framer_drops_runaway_lines(app_module):
+    framer = app_module.SerialLineFramer(max_line_length=16)
+    assert framer.feed(b"x" * 40, 0.0) == []
+    assert framer.feed(b"ready\n", 1.0) == [("ready", 1.0)]
@@ -0,0 +1,87 @@
+"""SerialCommandMux against a fake port: reply routing to waiters and ack-based flow control."""
+import threading
+import types
+
+import pytest
+
+from conftest import wait_for
+
+
+class FakePort:
+    """Records each write() as one chunk."""
+    is_open = True
+
+    def __init__(self):
+        self.writes = []
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        with self.lock:
+            self.writes.append(bytes(data))
+        return len(data)
+
+    def lines(self):
+        with self.lock:
+            return b"".join(self.writes).decode().splitlines()
+
+
+@pytest.fixture
+def mux(app_module):
+    device = types.SimpleNamespace(device_id="mux-test", ser=FakePort())
+    mux = app_module.SerialCommandMux(device)
+    threading.Thread(target=mux.writer_loop, daemon=True).start()
+    return mux
+
+
+def test_replies_go_to_the_oldest_matching_waiter(mux):
+    weight = mux.send("GET_WEIGHT", expect="WEIGHT:")
+    first = mux.send("GET_STATUS", expect=("STATUS:", "ERROR:"))
+    second = mux.send("GET_STATUS", expect="STATUS:")
+    assert not mux.dispatch_line("DATA:Weighing,1.00,0,0.25")  # Unclaimed lines go to the state parser
+    assert mux.dispatch_line("STATUS:idle")
+    assert mux.dispatch_line("WEIGHT:1.25")
+    assert mux.dispatch_line("STATUS:busy")
+    assert (first.result(timeout=1), weight.result(timeout=1), second.result(timeout=1)) == \
+        ("STATUS:idle", "WEIGHT:1.25", "STATUS:busy")
+    assert wait_for(lambda: mux.device.ser.lines()[:3] == ["GET_WEIGHT", "GET_STATUS", "GET_STATUS"])
+
+
+def test_request_times_out_and_forgets_its_waiter(mux):
+    assert mux.request("GET_WEIGHT", "WEIGHT:", timeout=0.1) is None
+    assert not any(prefixes == ("WEIGHT:",) for prefixes, _ in mux.waiters)
+    assert not mux.dispatch_line("WEIGHT:1.25")  # A late reply is not taken by a stale waiter
+
+
+def test_request_without_a_port_returns_none(mux):
+    mux.device.ser = None
+    assert mux.request("GET_WEIGHT", "WEIGHT:") is None
+
+
+def ack(mux, command):
+    assert mux.dispatch_line(f"Arduino received: {command}")
+
+
+def test_batch_waits_for_acks_when_the_buffer_is_full(app_module, mux):
+    commands = [f"SET_MED:{'X' * 20}{i}" for i in range(4)]  # 30 bytes each with the newline
+    per_write = app_module.ARDUINO_RX_BUFFER_BYTES // 30
+    mux.send_batch(commands)
+    port = mux.device.ser
+    assert wait_for(lambda: port.lines() == commands[:per_write])
+    assert len(port.writes) == 1  # Everything that fits goes out in one write
+    ack(mux, commands[0])
+    assert wait_for(lambda: port.lines() == commands[:per_write + 1])
+    ack(mux, commands[1])
+    ack(mux, commands[2])
+    assert wait_for(lambda: port.lines() == commands)
+
+
+def test_missing_ack_releases_its_credit(app_module, mux, monkeypatch):
+    monkeypatch.setattr(app_module, "ARDUINO_ACK_TIMEOUT", 0.2)
+    command = "LCD:" + "Y" * (app_module.ARDUINO_RX_BUFFER_BYTES - 10)
+    mux.send(command)
+    mux.send("GET_WEIGHT")
+    port = mux.device.ser
+    assert wait_for(lambda: port.lines() == [command])
+    assert not wait_for(lambda: len(port.lines()) > 1, timeout=0.1)  # Held back until the ack...
+    assert wait_for(lambda: port.lines() == [command, "GET_WEIGHT"], timeout=1.0)  # ...or its timeout
+    assert not any(prefixes[0].startswith("Arduino received: LCD:") for prefixes, _ in mux.waiters)
@@ -0,0 +1,78 @@
+"""Medication session cycle against the emulated pillbox (real mode)."""
+import threading
+import time
+
+import pytest
+
+from conftest import wait_for
+
+MED = "SessionMed"
+
+
+@pytest.fixture
+def stocked(client, device, emulator):
+    """Real mode with 25 g of MED on the emulated scale."""
+    emulator.box.load_grams = 0.0
+    assert client.post('/set_mode/real').status_code == 200
+    assert client.post('/add_or_update_known_medication', json={"name": MED, "wpp": 0.25}).status_code == 200
+    assert client.post('/set_pc_active_medication', json={"name": MED}).status_code == 200
+    with device.state.edit_inventory():
+        device.state.pc_managed_medication_details[MED]["total_weight_in_box"] = 25.0
+        device.state.pc_managed_medication_details[MED]["count_in_box"] = 100
+    # Commands are queued; SET_MODE must reach the box (it zeroes the scale) before the load goes on
+    assert wait_for(lambda: not emulator.box.is_simulation and emulator.box.selected_medication == MED)
+    emulator.box.load_grams = 25.0
+    client.post('/cancel_medication_session')
+    yield emulator.box
+    client.post('/cancel_medication_session')
+
+
+def raw_weight(device):
+    return device.state.snapshot().arduino_raw_state["total_weight_in_box_arduino"]
+
+
+def test_start_unlock_lock_and_record(app_module, client, device, stocked):
+    box = stocked
+    assert client.post('/start_medication_session', json={"medication_name": MED}).json["status"] == "success"
+    assert wait_for(lambda: box.box_tare_offset == pytest.approx(25.0))
+    assert client.post('/unlock_medication_compartment', json={}).json["status"] == "success"
+
+    box.load_grams = 24.5  # Two pills taken out
+    assert wait_for(lambda: raw_weight(device) == pytest.approx(-0.5))
+    response = client.post('/lock_and_record_consumption', json={})
+    assert response.status_code == 200, response.json
+    assert response.json["consumed_count"] == 2
+    assert response.json["weight_reduced_approx"] == pytest.approx(0.5, abs=0.02)
+
+    snap = device.state.snapshot()
+    assert not snap.medication_session_active
+    assert snap.pc_managed_medication_details[MED]["count_in_box"] == 98
+    app_module.db.write('SELECT 1').result(timeout=5)  # The history insert is queued; wait for it
+    rows = app_module.db.query('SELECT pills_consumed, device_id FROM history WHERE medication_name = ? ORDER BY id', (MED,))
+    assert rows[-1] == (2, "box")
+
+
+def test_lock_requires_an_unlocked_session(client, device, stocked):
+    assert client.post('/lock_and_record_consumption', json={}).status_code == 400
+    assert client.post('/start_medication_session', json={"medication_name": MED}).json["status"] == "success"
+    assert client.post('/lock_and_record_consumption', json={}).status_code == 400
+
+
+def test_cancel_while_settling_is_not_recorded(app_module, client, device, stocked, monkeypatch):
+    assert client.post('/start_medication_session', json={"medication_name": MED}).json["status"] == "success"
+    assert client.post('/unlock_medication_compartment', json={}).json["status"] == "success"
+
+    def unsettled(timeout):
+        time.sleep(0.5)
+        return False, None
+    monkeypatch.setattr(device.weight_filter, "wait_for_plateau", unsettled)
+    result = {}
+    worker = threading.Thread(target=lambda: result.setdefault(
+        "response", app_module.app.test_client().post('/lock_and_record_consumption', json={})))
+    worker.start()
+    time.sleep(0.1)
+    started = time.monotonic()
+    assert client.post('/cancel_medication_session', json={}).status_code == 200
+    assert time.monotonic() - started < 0.3  # The session lock is not held while the weight settles
+    worker.join()
+    assert result["response"].status_code == 409
@@ -0,0 +1,89 @@
+"""PillboxState under concurrent writers: every snapshot shows each part as one writer left it."""
+import copy
+import threading
+import time
+
+import pytest
+
+DURATION = 0.5
+
+
+def hammer(state, n):
+    """One writer per part; each edit changes several fields that must stay in step."""
+    with state.edit_telemetry():
+        state.arduino_raw_state["total_weight_in_box_arduino"] = float(n)
+        time.sleep(0)  # Let readers in between the two fields
+        state.arduino_raw_state["pill_count_arduino_current_med"] = n * 4
+    with state.edit_inventory():
+        row = state.pc_managed_medication_details["A"]
+        row["count_in_box"] = n
+        time.sleep(0)
+        row["total_weight_in_box"] = n * 0.25
+        state.current_mode_is_simulation = n % 2 == 0
+        state.pc_active_medication_name = "A" if n % 2 == 0 else None
+    with state.edit_session():
+        state.medication_session_active = n % 2 == 1
+        state.medication_session_data["start_weight"] = float(n)
+        time.sleep(0)
+        state.medication_session_data["current_medication"] = "A" if n % 2 == 1 else None
+        state.compartment_sessions = {"A": {"start_weight": float(n)}} if n % 2 == 1 else {}
+
+
+def check(snap):
+    raw = snap.arduino_raw_state
+    assert raw["pill_count_arduino_current_med"] == raw["total_weight_in_box_arduino"] * 4
+    row = snap.pc_managed_medication_details.to_dict()["A"]
+    assert row["total_weight_in_box"] == pytest.approx(row["count_in_box"] * 0.25)
+    assert (snap.pc_active_medication_name == "A") == snap.current_mode_is_simulation
+    data = snap.medication_session_data
+    assert (data["current_medication"] == "A") == snap.medication_session_active
+    if snap.medication_session_active:
+        assert snap.compartment_sessions == {"A": {"start_weight": data["start_weight"]}}
+    else:
+        assert snap.compartment_sessions == {}
+
+
+def frozen(snap):
+    return copy.deepcopy((snap.arduino_raw_state, snap.pc_managed_medication_details.to_dict(),
+                          snap.pc_active_medication_name, snap.medication_session_data, snap.compartment_sessions))
+
+
+def test_snapshots_are_never_torn(app_module):
+    state = app_module.PillboxState()
+    with state.edit_inventory():
+        state.pc_managed_medication_details.add("A", 0.25, 0.0, 0)
+    stop = threading.Event()
+    errors, kept = [], []
+
+    def writer(offset):
+        n = offset
+        while not stop.is_set():
+            hammer(state, n)
+            n += 4
+
+    def reader():
+        checked = 0
+        while not stop.is_set():
+            snap = state.snapshot()
+            try:
+                check(snap)
+            except AssertionError as e:
+                errors.append(e)
+                return
+            checked += 1
+            if checked % 500 == 0:
+                kept.append((snap, frozen(snap)))
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(4)] + \
+              [threading.Thread(target=reader) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert not errors, errors[0]
+    assert kept
+    # Published copies are not mutated by later edits
+    for snap, values in kept:
+        assert frozen(snap) == values
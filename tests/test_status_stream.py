@@ -0,0 +1,46 @@
+"""/stream_status: Last-Event-ID replay of buffered events, and a fresh snapshot when the backlog is gone."""
+import json
+
+
+def read_events(response, until=None, count=None):
+    """Parse SSE messages off a streaming response until one has id `until` or `count` were read."""
+    events = []
+    for chunk in response.response:
+        text = chunk.decode() if isinstance(chunk, bytes) else chunk
+        fields = dict(line.split(": ", 1) for line in text.strip().splitlines() if ": " in line and not line.startswith(":"))
+        if "data" not in fields:
+            continue  # retry: and heartbeat comments
+        events.append((int(fields["id"]), fields.get("event"), json.loads(fields["data"])))
+        if (until is not None and events[-1][0] >= until) or (count is not None and len(events) >= count):
+            break
+    response.close()
+    return events
+
+
+def publish(app_module, device, n):
+    ids = []
+    for i in range(n):
+        app_module.publish_device_event(device, "test", {"n": i})
+        ids.append(device.status_event_id)
+    return ids
+
+
+def test_reconnect_replays_missed_events(app_module, client):
+    device = app_module.devices["box"]
+    first, second, third = publish(app_module, device, 3)
+    response = client.get('/stream_status', headers={'Last-Event-ID': str(first)}, buffered=False)
+    events = read_events(response, until=third)
+    # Everything after the client's last id, in order and without gaps (deltas may interleave)
+    assert [eid for eid, _, _ in events] == list(range(first + 1, third + 1))
+    assert [(eid, data) for eid, event, data in events if event == "test"] == [(second, {"n": 1}), (third, {"n": 2})]
+
+
+def test_reconnect_past_the_backlog_gets_a_snapshot(app_module, client):
+    device = app_module.devices["box"]
+    ids = publish(app_module, device, app_module.STATUS_EVENT_BACKLOG + 1)
+    for last_id in (ids[0] - 1, ids[-1] + 100):  # Evicted from the backlog; from a previous server run
+        response = client.get('/stream_status', headers={'Last-Event-ID': str(last_id)}, buffered=False)
+        [(eid, event, data)] = read_events(response, count=1)
+        assert event == "snapshot"
+        assert eid >= ids[-1]
+        assert {"arduino_state", "pc_managed_medication_details"} <= data.keys()
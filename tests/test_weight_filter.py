@@ -0,0 +1,63 @@
+"""Median and Kalman filter stages, and WeightFilter step / plateau detection."""
+import random
+import statistics
+import threading
+import time
+
+import pytest
+
+
+def test_running_median_matches_the_window(app_module):
+    median = app_module.RunningMedian(5)
+    values = [random.Random(i).uniform(0, 10) for i in range(50)]
+    for i, value in enumerate(values):
+        assert median(value) == pytest.approx(statistics.median(values[max(0, i - 4):i + 1]))
+
+
+def test_kalman_holds_through_a_spike_and_jumps_on_a_step(app_module):
+    kalman = app_module.ScalarKalman(0.00005, 0.0004)
+    for _ in range(20):
+        estimate = kalman(10.0)
+    assert kalman(12.0) == pytest.approx(estimate)  # One sample far off: held as a possible spike
+    assert kalman(10.0) == pytest.approx(10.0, abs=0.01)
+    kalman(9.5)
+    assert kalman(9.5) == 9.5  # Confirmed on the second sample: the estimate jumps instead of creeping
+
+
+def test_plateau_and_step_detection(app_module):
+    weight_filter = app_module.WeightFilter(stages=['median'], plateau_seconds=0.5, tolerance=0.05)
+    started = time.time() - 5
+    for i in range(20):
+        _, settled = weight_filter.update(started + i * 0.05, 10.0 + (0.01 if i % 2 else -0.01))
+    assert settled
+    settled, weight = weight_filter.plateau()
+    assert settled and weight == pytest.approx(10.0, abs=0.01)
+
+    for i in range(20, 24):
+        _, settled = weight_filter.update(started + i * 0.05, 9.5)
+    assert not settled  # A new run has started and is not yet long enough
+    step_at, change = weight_filter.last_step
+    assert change == pytest.approx(-0.5, abs=0.02)
+    assert step_at == pytest.approx(started + 22 * 0.05)  # The median turns on the third low sample
+
+
+def test_wait_for_plateau_needs_fresh_samples(app_module):
+    weight_filter = app_module.WeightFilter(stages=[], plateau_seconds=0.2)
+    old = time.time() - 10
+    for i in range(10):
+        weight_filter.update(old + i * 0.05, 5.0)
+    assert weight_filter.wait_for_plateau(0.1) == (False, 5.0)  # Settled, but only on old samples
+
+    def feed():
+        for _ in range(15):
+            weight_filter.update(time.time(), 5.0)
+            time.sleep(0.03)
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    assert weight_filter.wait_for_plateau(2.0) == (True, pytest.approx(5.0))
+    feeder.join()
+
+
+def test_unknown_stage_is_rejected(app_module):
+    with pytest.raises(ValueError):
+        app_module.WeightFilter(stages=['median', 'lowpass'])